@@ -28,7 +28,6 @@ Something like that..
 Log everything...
 
 Comments:
-def deleteInMemory by Ben Zank
 """
 
 
@@ -40,8 +39,16 @@ def deleteInMemory by Ben Zank
 
 from __future__ import division # Integer division is lame - use // instead
 
-import datetime, logging, os, re, sys, traceback
+import datetime, logging, multiprocessing, os, re, shutil, sys, tempfile, traceback
 import arcpy
+import acreage
+import restriction_matrix
+import restriction_tiles
+import restriction_raster
+import scratch_workspace
+import run_planner
+import criteria_generalize
+import duplicate_geometry
 from arcpy import env
 import copy, csv, math
 #import numpy as np
@@ -80,20 +87,6 @@ arcpy.env.workspace = env_workspace
 ##
 #######################################################################################################################
 
-def deleteInMemory():
-    # Set the workspace to in_memory
-    env.workspace = "in_memory"
-    # Delete all in memory feature classes
-    fcs = arcpy.ListFeatureClasses()
-    if len(fcs) > 0:
-        for fc in fcs:
-            arcpy.Delete_management(fc)
-    # Delete all in memory tables 
-    tbls = arcpy.ListTables()
-    if len(tbls) > 0:
-        for tbl in tbls:
-            arcpy.Delete_management(tbl)
-  
 def buildWhereClauseFromList(table, field, valueList):
     """Takes a list of values and constructs a SQL WHERE
     clause to select those values within a given field and table."""
@@ -465,10 +458,50 @@ class NSO_CSU_Analysis(object):
             datatype="String",
             parameterType="Required",
             direction="Input")
-                
+
+        # Overlay the criteria tile by tile, side by side - for areas too big for one union
+        param33=arcpy.Parameter(
+            displayName="Overlay Tiling",
+            name="Overlay_Tiling",
+            datatype="String",
+            parameterType="Optional",
+            direction="Input")
+
+        # Quick raster acreage estimate at this cell size instead of the vector overlay
+        param34=arcpy.Parameter(
+            displayName="Raster Estimate Cell Size",
+            name="Raster_Estimate_Cell_Size",
+            datatype="Double",
+            parameterType="Optional",
+            direction="Input")
+
+        # Estimate the run up front - AUTO also picks tiling or raster to suit it
+        param35=arcpy.Parameter(
+            displayName="Execution Strategy",
+            name="Execution_Strategy",
+            datatype="String",
+            parameterType="Optional",
+            direction="Input")
+
+        # Simplify the dissolved criteria under this tolerance (in data units) before the overlay
+        param36=arcpy.Parameter(
+            displayName="Generalization Tolerance",
+            name="Generalization_Tolerance",
+            datatype="Double",
+            parameterType="Optional",
+            direction="Input")
+
+        param37=arcpy.Parameter(
+            displayName="Generalization Method",
+            name="Generalization_Method",
+            datatype="String",
+            parameterType="Optional",
+            direction="Input")
+
         parameters = [param00, param01, param02, param03, param04, param05, param06, param07, param08, param09, param10,
                       param11, param12, param13, param14, param15, param16, param17, param18, param19, param20, param21,
-                      param22, param23, param24, param25, param26, param27, param28, param29, param30, param31, param32]
+                      param22, param23, param24, param25, param26, param27, param28, param29, param30, param31, param32,
+                      param33, param34, param35, param36, param37]
                           
         return parameters
 
@@ -491,6 +524,21 @@ class NSO_CSU_Analysis(object):
         parameters[32].filter.list = ['NSO', 'CSU', 'ROW_EX', 'ROW_AV', 'CFML', 'CLOT'] #missing one
         if not parameters[32].altered:
             parameters[32].value = "NSO"
+
+        parameters[33].filter.type = "ValueList"
+        parameters[33].filter.list = restriction_tiles.TILING_OPTIONS
+        if not parameters[33].altered:
+            parameters[33].value = 'NONE'
+
+        parameters[35].filter.type = "ValueList"
+        parameters[35].filter.list = ['AS SET', 'AUTO']
+        if not parameters[35].altered:
+            parameters[35].value = 'AS SET'
+
+        parameters[37].filter.type = "ValueList"
+        parameters[37].filter.list = list(criteria_generalize.METHODS)
+        if not parameters[37].altered:
+            parameters[37].value = 'DOUGLAS_PEUCKER'
         return
 
 
@@ -503,10 +551,9 @@ class NSO_CSU_Analysis(object):
     def execute(self, parameters, messages):
         """The source code of the tool."""
 
+        # Every intermediate gets a unique in_memory name, deleted when the run ends
+        scratch = scratch_workspace.ScratchWorkspace(log=arcpy.AddMessage)
         try:
-            
-            # Clear memory JIC
-            deleteInMemory()
 
 #######################################################################################################################
 ##
@@ -574,13 +621,16 @@ class NSO_CSU_Analysis(object):
             auto_log('Creating geodatabase', output_path)
 
             # Secure a copy of the input analysis area
-            arcpy.MakeFeatureLayer_management(parameters[0].value, "in_memory\\_")
+            area_layer = scratch.layer('analysis_area')
+            arcpy.MakeFeatureLayer_management(parameters[0].value, area_layer)
             
             # Dissolve everything to prevent overlapping input polygons
             auto_log('Dissolving input polygon')
-            arcpy.Dissolve_management("in_memory\\_", "in_memory\\__")
+            area_dissolve = scratch.feature_class('analysis_dissolve')
+            arcpy.Dissolve_management(area_layer, area_dissolve)
             analysis_area = output_path+"\\Analysis_Area"
-            arcpy.CopyFeatures_management("in_memory\\__", analysis_area)
+            arcpy.CopyFeatures_management(scratch.use(area_dissolve), analysis_area)
+            scratch.release(area_dissolve)
 
             # Set the workspace to the output database
             arcpy.env.workspace = output_path
@@ -677,17 +727,44 @@ class NSO_CSU_Analysis(object):
             # Function to copy the unioned layers and dissolve to input data - deletes attribute data!
             def union_inputs(name, dest, fc_list):
                 union_output = output_path+"\\Input_"+dest+"\\"+name
-                arcpy.Union_analysis(fc_list, "in_memory\\dissolve")
-                arcpy.Dissolve_management("in_memory\\dissolve", union_output)
+                union = scratch.feature_class('union_' + name)
+                arcpy.Union_analysis(fc_list, union)
+                arcpy.Dissolve_management(scratch.use(union), union_output)
+                scratch.release(union)
                 # Uncomment below and comment 2  llines above to choose to not dissolve / delete attribute data
                 # Note: overlapping polygon errors are possible in acreage counts!
                 #arcpy.Union_analysis(fc_list, union_output)
                 return 
                    
+            # Sample the inputs and estimate each way of running them - see run_planner.py
+            # The criteria are dissolved one at a time here, only the tiles run side by side
+            tiling = parameters[33].valueAsText
+            raster_cell = parameters[34].value
+            plan = run_planner.plan_run(analysis_area, [(id[2:], data[0]) for id, data in sorted_inputs],
+                                        1, raster_cell,
+                                        tile_workers=max(1, multiprocessing.cpu_count() - 1))
+            for line in run_planner.format_plan(plan):
+                auto_log(line)
+            if parameters[35].valueAsText == 'AUTO':
+                settings = plan['strategies'][plan['recommended']]['settings']
+                tiling, raster_cell = settings['tiling'], settings['raster_cell']
+                auto_log('Execution strategy', plan['recommended'], settings)
+
             # Iterate across sorted items and create union output
             auto_log('Creating and dissolving criteria unions      ---this will probably be slow---     ')
             for id, data in sorted_inputs:
                 union_output = union_inputs(id[2:], data[1], data[0])
+
+            # Fewer vertices for the union - see criteria_generalize.py
+            generalize_tolerance = parameters[36].value
+            if generalize_tolerance:
+                generalize_method = parameters[37].valueAsText or 'DOUGLAS_PEUCKER'
+                auto_log('Generalizing criteria - {} at {}'.format(generalize_method, generalize_tolerance))
+                generalized = criteria_generalize.generalize_criteria(
+                    [(id[2:], output_path+"\\Input_"+data[1]+"\\"+id[2:]) for id, data in sorted_inputs],
+                    generalize_tolerance, generalize_method, auto_log)
+                for line in criteria_generalize.format_report(generalized):
+                    auto_log(line)
                 
 ### At this point, we have created the gdb and feature datasets, sorted the inputs, and created the unioned criteria layers
                 
@@ -731,117 +808,110 @@ class NSO_CSU_Analysis(object):
                 for fc in fc_input_list:
                     output_fc_name = nso_csu+"_"+os.path.basename(fc)
                     output_fc_path = output_path+"\\Results_"+category+"\\"+output_fc_name
-                    arcpy.Clip_analysis(analysis_area, fc, "in_memory\\clip")
+                    clip = scratch.feature_class('clip')
+                    arcpy.Clip_analysis(analysis_area, fc, clip)
                     # Dissolve the clips
-                    arcpy.Dissolve_management("in_memory\\clip", output_fc_path)
+                    arcpy.Dissolve_management(scratch.use(clip), output_fc_path)
+                    scratch.release(clip)
                     
             fc_id_map = defaultdict(str)
             for key, value in sorted_inputs:
                 fc_id_map[key[2:]] = value[2]
+
+            # Raster estimate - acreage figures in seconds, no union or matrix
+            if raster_cell:
+                auto_log('Estimating acres on a {} cell raster'.format(raster_cell))
+                estimate = restriction_raster.raster_estimate(
+                    analysis_area,
+                    [(fc_id_map[str(fc)], arcpy.Describe(fc).catalogPath) for fc in all_fcs_list],
+                    raster_cell, log=auto_log)
+                outCSV = database_path+"\\"+os.path.basename(parameters[1].valueAsText)+"_"+date_time_stamp+'_Raster_Estimate.csv'
+                restriction_raster.write_estimate_csv(outCSV, nso_csu, estimate)
+                auto_log('Estimated {:.2f} restricted acres +/- {:.2f}'.format(
+                    estimate['markup'], estimate['bounds']['markup']))
+                auto_log('Done..')
+                return
+
                        
             # Collapse geometry union [will be slow with full input]
-            auto_log('Unioning criteria inputs   ---this will probably be slow---   ')
             output_aggregate_feature = output_path+"\\Aggregate_Results"
-            all_fcs_list_copy = copy.deepcopy(all_fcs_list)
+            criteria_fcs = [(fc_id_map[str(fc)], arcpy.Describe(fc).catalogPath) for fc in all_fcs_list]
+            tiles, tile_extent = restriction_tiles.make_tiles(tiling, analysis_area, criteria_fcs)
+            if tiles:
+                # Clip, union and matrix per tile on a process pool, then stitch the tiles
+                auto_log('Overlaying criteria by tile         ---this will probably be slow---')
+                criteria = criteria_fcs
+                tile_folder = tempfile.mkdtemp(prefix='tiles_', dir=database_path)
+                try:
+                    acre_field, tallies = restriction_tiles.tiled_overlay(analysis_area, criteria,
+                                                                          output_aggregate_feature,
+                                                                          tiles, tile_extent, tile_folder,
+                                                                          max(1, multiprocessing.cpu_count() - 1),
+                                                                          log=auto_log, scratch=scratch)
+                finally:
+                    shutil.rmtree(tile_folder, ignore_errors=True)
+            else:
+                auto_log('Unioning criteria inputs   ---this will probably be slow---   ')
+                all_fcs_list_copy = copy.deepcopy(all_fcs_list)
             
-            # Add input analysis area to list of union and union it all
-            all_fcs_list_copy.append(u'Analysis_Area')
-            arcpy.Union_analysis(all_fcs_list_copy, "in_memory\\agg_union")
+                # Add input analysis area to list of union and union it all
+                all_fcs_list_copy.append(u'Analysis_Area')
+                # ONLY_FID keeps the lineage - one FID_ field per input, -1 where a piece is outside it
+                agg_union = scratch.feature_class('agg_union')
+                arcpy.Union_analysis(all_fcs_list_copy, agg_union, "ONLY_FID")
+                lineage = restriction_matrix.lineage_fields(scratch.use(agg_union), all_fcs_list_copy)
             
-            # Clip the union and output it
-            arcpy.Clip_analysis("in_memory\\agg_union", analysis_area, "in_memory\\clip_")
-
-            # Make sure everything is in single-part format for later analysis - JIC
-            arcpy.MultipartToSinglepart_management("in_memory\\clip_", output_aggregate_feature)
-
-            # Erase all the other fields - sometimes its easier to ask for forgiveness than permission [ietafftp]
-            erase_fields_lst = [field.name for field in arcpy.ListFields(output_aggregate_feature)]
-            auto_log('Creating matrix    ---this will probably be slow---   ', erase_fields_lst)
-            # Union creates very messy tables - clean them
-            for field in erase_fields_lst:
-                try:
-                    arcpy.DeleteField_management(output_aggregate_feature, field)
-                except:
-                    logging.debug("Delete field failed: "+str(field)) # Should minimally fail on OID, Shape, Shape_area, and Shape_length
+                # Clip the union and output it
+                agg_clip = scratch.feature_class('agg_clip')
+                arcpy.Clip_analysis(scratch.use(agg_union), analysis_area, agg_clip)
+                scratch.release(agg_union)
+
+                # Make sure everything is in single-part format for later analysis - JIC
+                arcpy.MultipartToSinglepart_management(scratch.use(agg_clip), output_aggregate_feature)
+                scratch.release(agg_clip)
+
+                # Erase all the other fields - sometimes its easier to ask for forgiveness than permission [ietafftp]
+                erase_fields_lst = [field.name for field in arcpy.ListFields(output_aggregate_feature)
+                                    if field.name not in lineage.values()]
+                auto_log('Creating matrix    ---this will probably be slow---   ', erase_fields_lst)
+                # Union creates very messy tables - clean them
+                for field in erase_fields_lst:
+                    try:
+                        arcpy.DeleteField_management(output_aggregate_feature, field)
+                    except:
+                        logging.debug("Delete field failed: "+str(field)) # Should minimally fail on OID, Shape, Shape_area, and Shape_length
                 
-            # Delete identical features within output_aggregate_feature to prevent double counting acres
-            auto_log('Checking for identical features')
-            try:
-                arcpy.DeleteIdentical_management(output_aggregate_feature, ["SHAPE"])
-            except:
-                logging.debug("Delete identical failed") # This will usually fail - it's ok
+                # Delete identical features within output_aggregate_feature to prevent double counting acres
+                # - their lineage is kept on the surviving copy
+                auto_log('Checking for identical features')
+                duplicates = duplicate_geometry.delete_duplicates(output_aggregate_feature,
+                                                                  merge_fields=lineage.values())
+                auto_log(*duplicate_geometry.format_report(duplicates))
                 
-            # Calculate acreage
-            auto_log('Calculating acres')
-            # Add ACRES field to analysis area - check if exists
-            # If ACRES/Acres/acres exists in table, flag for calculation instead
-            field_list = [field.name for field in arcpy.ListFields(output_aggregate_feature) if field.name.upper() == "ACRES"]            
-            if field_list:
-                acre_field = field_list[0] # select the suitable 'acres' variant
-            else:
-                arcpy.AddField_management(output_aggregate_feature, "ACRES", "DOUBLE", 15, 2)
-                acre_field = "ACRES"
-            arcpy.CalculateField_management(output_aggregate_feature, acre_field, "!shape.area@ACRES!", "PYTHON_9.3")
+                # Populate the matrix from the union lineage - every criterion column, the acres
+                # and the acreage tallies in one cursor sweep, no select by location per criterion
+                auto_log('Populating matrix')
+                criteria = [(fc_id_map[str(fc)], lineage[fc]) for fc in all_fcs_list]
+                acre_field, tallies = restriction_matrix.populate_matrix(output_aggregate_feature, criteria)
+
+                # The lineage fields have done their job
+                arcpy.DeleteField_management(output_aggregate_feature, list(lineage.values()))
 
             # Create a defaultdict to store acreages - default dictionaries are awesome
             acreage_counts = defaultdict(int)
-            
-            # Iterate across all_fcs_list and add field, select by location and calculate field with ID, remove null
-            arcpy.MakeFeatureLayer_management(output_aggregate_feature, "in_memory\\mem_agg_layer")
-
-            # Create a list to store all added field ids    
-            fc_field_list = []
-                        
-            auto_log('Populating matrix')                             
-            for fc in all_fcs_list:
-                fc_ID = fc_id_map[str(fc)]
-                
-                # Copy the created fields for later use in fields summary
-                fc_field_list.append(fc_ID)
-                
-                # Add field, select, and calculate
-                arcpy.AddField_management("in_memory\\mem_agg_layer", fc_ID, "Text", field_length=20)
-                arcpy.SelectLayerByLocation_management("in_memory\\mem_agg_layer", "WITHIN", fc, selection_type="NEW_SELECTION")
-                arcpy.CalculateField_management("in_memory\\mem_agg_layer", fc_ID, '"'+fc_ID+'"', "PYTHON_9.3")
-
-                # Get the acres
-                fc_acres = sum([row[0] for row in arcpy.da.SearchCursor("in_memory\\mem_agg_layer", acre_field)])
-                
-                # Add key=fc_id and value=acreage to sweet default dictionary
+            for fc_ID, fc_acres in tallies['criteria'].items():
                 acreage_counts[fc_ID] = round(fc_acres, 2)
 
-                # Switch the selection
-##                arcpy.SelectLayerByAttribute_management("in_memory\\mem_agg_layer", "CLEAR_SELECTION")                
-##                arcpy.SelectLayerByAttribute_management("in_memory\\mem_agg_layer", "NEW_SELECTION", '"'+fc_ID+'" IS NULL')
-                arcpy.SelectLayerByAttribute_management("in_memory\\mem_agg_layer", "SWITCH_SELECTION")
-                
-                # Clean the table for readability - replace "Null" with ""
-                arcpy.CalculateField_management("in_memory\\mem_agg_layer", fc_ID, '"'+""+'"', "PYTHON_9.3")
-                arcpy.SelectLayerByAttribute_management("in_memory\\mem_agg_layer", "CLEAR_SELECTION")
-                
             # Write the markup feature to disc
             auto_log('Creating markup output')   
             output_aggregate_feature_markup = output_path+"\\Aggregate_Results_Markup"
-            arcpy.CopyFeatures_management("in_memory\\mem_agg_layer", output_aggregate_feature_markup)
-
-            # Create a summary field and get list of other fields
-            auto_log('Calculating summary field') 
-            arcpy.AddField_management(output_aggregate_feature_markup, "Summary", "Text", field_length=255)
-            fc_field_list.append('Summary')
-            num_of_fields = len(fc_field_list)
-            with arcpy.da.UpdateCursor(output_aggregate_feature_markup, fc_field_list) as cur:
-                for row in cur:
-                    # There's gotta be a better way to do this... this sucks
-                    row[num_of_fields-1] = re.sub('\s+', ' ', (reduce(lambda x,y: x+" "+y, [row[i] for i in range(num_of_fields-1)]))).strip()
-                    cur.updateRow(row)
-
-            # Get the total analysis acreage
-            arcpy.MakeFeatureLayer_management(output_aggregate_feature_markup, "in_memory\\_markup")
-            total_analysis_acres = sum([row[0] for row in arcpy.da.SearchCursor("in_memory\\_markup", acre_field)])
+            arcpy.CopyFeatures_management(output_aggregate_feature, output_aggregate_feature_markup)
+
+            # Get the total analysis acreage - tallied with the matrix
+            total_analysis_acres = tallies['total']
             
-            # Get the total marked-up acreage
-            arcpy.SelectLayerByAttribute_management("in_memory\\_markup", "NEW_SELECTION", """ "Summary" <> '' """)
-            total_markup_acres = sum([row[0] for row in arcpy.da.SearchCursor("in_memory\\_markup", acre_field)])
+            # Get the total marked-up acreage - every polygon within at least one criterion
+            total_markup_acres = tallies['markup']
                 
             # Delete the lingering unmarked output - comment out if you want to keep original with original fields
             arcpy.Delete_management(output_aggregate_feature)
@@ -932,7 +1002,7 @@ class NSO_CSU_Analysis(object):
             auto_log("Time Elapsed: %s" %(str(end_time - start_time)))
             logging.debug('\n'*10)
             logging.shutdown()
-            deleteInMemory()
+            scratch.close()
 
 
 #######################################################################################################################
\ No newline at end of file
@@ -27,7 +27,6 @@ Something like that..
 Log everything...
 
 Comments:
-def deleteInMemory by Ben Zank
 
 
 To Do:
@@ -50,8 +49,21 @@ def write_location_matrix_to_target(target, location_fc):
 
 from __future__ import division # Integer division is lame - use // instead
 
-import copy, csv, datetime, getpass, os, re, sys, traceback
+import copy, csv, datetime, getpass, glob, os, re, shutil, sys, tempfile, traceback
 import arcpy
+import acreage
+import restriction_matrix
+import multiprocessing
+import use_restrictions_workers
+import restriction_tiles
+import restriction_raster
+import criteria_cache
+import pipeline_profile
+import stage_checkpoints
+import scratch_workspace
+import run_planner
+import criteria_generalize
+import duplicate_geometry
 #import math
 #import numpy as np
 #import pandas as pd
@@ -59,7 +71,7 @@ import arcpy
 #import matplotlib as mpl
 #import matplotlib.pyplot as plt
 #from collections import Counter
-#import threading, multiprocessing
+#import threading
 from collections import defaultdict
 
 #pylab
@@ -149,28 +161,6 @@ class pyt_log(object):
 
 ##---Functions-------------------------------------------------------------------------------------
 
-def deleteInMemory():
-    """Delete in memory tables and feature classes - reset to original worksapce when done"""
-
-    # get the original workspace location
-    orig_workspace = arcpy.env.workspace
-    
-    # Set the workspace to in_memory
-    arcpy.env.workspace = "in_memory"
-    # Delete all in memory feature classes
-    fcs = arcpy.ListFeatureClasses()
-    if len(fcs) > 0:
-        for fc in fcs:
-            arcpy.Delete_management(fc)
-    # Delete all in memory tables
-    tbls = arcpy.ListTables()
-    if len(tbls) > 0:
-        for tbl in tbls:
-            arcpy.Delete_management(tbl)
-
-    # Reset the workspace
-    arcpy.env.workspace = orig_workspace
-    
 def buildWhereClauseFromList(table, field, valueList):
     """Takes a list of values and constructs a SQL WHERE
     clause to select those values within a given field and table."""
@@ -193,17 +183,9 @@ def get_acres(fc):
     """Check for an acres field in fc - create if exists or flag for calculation.
        Recalculate acres and return name of acre field"""
 
-    # Add ACRES field to analysis area - check if exists
-    field_list = [field.name for field in arcpy.ListFields(fc) if field.name.upper() == "ACRES"]
-
-    # If ACRES/Acres/acres exists in table, flag for calculation instead
-    if field_list:
-        acre_field = field_list[0] # select the 'acres' variant
-    else:
-        arcpy.AddField_management(fc, "ACRES", "DOUBLE", 15, 2)
-        acre_field = "ACRES"
-
-    arcpy.CalculateField_management(fc, acre_field, "!shape.area@ACRES!", "PYTHON_9.3")
+    # Find or add the ACRES field and write every feature's planar acres
+    # from a single geometry read - see acreage.py
+    acre_field, acres = acreage.calculate_acres(fc)
     return acre_field
 
 ##---Variables-------------------------------------------------------------------------------------
@@ -218,6 +200,12 @@ arcpy.env.addOutputsToMap = False
 
 arcpy.env.overwriteOutput = True
 
+# Alternative D outputs are partitioned by these ecoregions
+ALT_D_ECOREGIONS = r"T:\CO\GIS\giswork\rgfo\projects\management_plans\ECRMP"\
+                   r"\Draft_RMP_EIS\1_Analysis\ECRMP_Outputs\boundaries"\
+                   r"\boundaries.gdb\ECRMP_HumanEcoregions_AltD_20160602"
+ALT_D_ECOREGION_FIELD = "Community_Landscape"
+
 
 ###################################################################################################
 ##
@@ -595,11 +583,100 @@ class Use_Restrictions_v2(object):
             parameterType="Optional",
             direction="Input")
 
+        # Criteria are dissolved on this many processes - 1 runs them one at a time
+        param36=arcpy.Parameter(
+            displayName="Parallel Criteria Workers",
+            name="Criteria_Workers",
+            datatype="Long",
+            parameterType="Optional",
+            direction="Input")
+
+        # Keep only the CRITERIA bitmask - no per-criterion text columns or Summary
+        param37=arcpy.Parameter(
+            displayName="Compact Output (criteria bitmask only)",
+            name="Compact_Output",
+            datatype="Boolean",
+            parameterType="Optional",
+            direction="Input")
+
+        # Dissolved criteria are reused from here when their inputs have not changed
+        param38=arcpy.Parameter(
+            displayName="Criteria Cache Folder",
+            name="Criteria_Cache_Folder",
+            datatype="Folder",
+            parameterType="Optional",
+            direction="Input")
+
+        # Overlay the criteria tile by tile, side by side - for areas too big for one union
+        param39=arcpy.Parameter(
+            displayName="Overlay Tiling",
+            name="Overlay_Tiling",
+            datatype="String",
+            parameterType="Optional",
+            direction="Input")
+
+        # Quick raster acreage estimate at this cell size instead of the vector overlay
+        param40=arcpy.Parameter(
+            displayName="Raster Estimate Cell Size",
+            name="Raster_Estimate_Cell_Size",
+            datatype="Double",
+            parameterType="Optional",
+            direction="Input")
+
+        # Time every stage and geoprocessing call - trace and summary go next to the report
+        param41=arcpy.Parameter(
+            displayName="Profile Run",
+            name="Profile_Run",
+            datatype="Boolean",
+            parameterType="Optional",
+            direction="Input")
+
+        # Pick up the latest run of this analysis at its first unfinished stage
+        param42=arcpy.Parameter(
+            displayName="Resume Previous Run",
+            name="Resume_Previous_Run",
+            datatype="Boolean",
+            parameterType="Optional",
+            direction="Input")
+
+        # Estimate the run up front - AUTO also picks workers, tiling or raster to suit it
+        param43=arcpy.Parameter(
+            displayName="Execution Strategy",
+            name="Execution_Strategy",
+            datatype="String",
+            parameterType="Optional",
+            direction="Input")
+
+        # Simplify the dissolved criteria under this tolerance (in data units) before the overlay
+        param44=arcpy.Parameter(
+            displayName="Generalization Tolerance",
+            name="Generalization_Tolerance",
+            datatype="Double",
+            parameterType="Optional",
+            direction="Input")
+
+        param45=arcpy.Parameter(
+            displayName="Generalization Method",
+            name="Generalization_Method",
+            datatype="String",
+            parameterType="Optional",
+            direction="Input")
+
+        # Alternative D - also write a feature class per ecoregion
+        param46=arcpy.Parameter(
+            displayName="Export Ecoregion Feature Classes",
+            name="Export_Ecoregion_Feature_Classes",
+            datatype="Boolean",
+            parameterType="Optional",
+            direction="Input")
+
         parameters = [param00, param01, param02, param03, param04, param05, param06, param07,
                       param08, param09, param10, param11, param12, param13, param14, param15,
                       param16, param17, param18, param19, param20, param21, param22, param23,
                       param24, param25, param26, param27, param28, param29, param30, param31,
-                      param32, param33, param34, param35]
+                      param32, param33, param34, param35, param36, param37,
+                      param38, param39, param40, param41, param42, param43,
+                      param44, param45, param46]
 
         return parameters
 
@@ -627,6 +704,27 @@ class Use_Restrictions_v2(object):
 
         if not parameters[35].altered:
             parameters[35].value = True
+
+        if not parameters[36].altered:
+            parameters[36].value = max(1, multiprocessing.cpu_count() - 1)
+
+        if not parameters[37].altered:
+            parameters[37].value = False
+
+        parameters[39].filter.type = "ValueList"
+        parameters[39].filter.list = restriction_tiles.TILING_OPTIONS
+        if not parameters[39].altered:
+            parameters[39].value = 'NONE'
+
+        parameters[43].filter.type = "ValueList"
+        parameters[43].filter.list = ['AS SET', 'AUTO']
+        if not parameters[43].altered:
+            parameters[43].value = 'AS SET'
+
+        parameters[45].filter.type = "ValueList"
+        parameters[45].filter.list = list(criteria_generalize.METHODS)
+        if not parameters[45].altered:
+            parameters[45].value = 'DOUGLAS_PEUCKER'
             
         return
 
@@ -646,10 +744,10 @@ class Use_Restrictions_v2(object):
     def execute(self, parameters, messages):
         """The source code of the tool."""
 
+        profiler = pipeline_profile.Profiler(enabled=False)
+        # Every intermediate gets a unique in_memory name, deleted when the run ends
+        scratch = scratch_workspace.ScratchWorkspace(log=arcpy.AddMessage)
         try:
-
-            # Clear memory JIC
-            deleteInMemory()
             
             # Get the analysis ID
             analysis_id = (parameters[34].valueAsText.split("[")[1][:5])+"_"+\
@@ -658,6 +756,16 @@ class Use_Restrictions_v2(object):
 
             # Get the alternative selection
             alternative = parameters[34].valueAsText.split("[")[1][:5]
+
+            # Bitmask only output schema
+            compact_output = bool(parameters[37].value)
+
+            # Overlay tiling - NONE runs one union over the whole analysis area
+            tiling = parameters[39].valueAsText
+
+            # Criteria generalization - no tolerance leaves them as dissolved
+            generalize_tolerance = parameters[44].value
+            generalize_method = parameters[45].valueAsText or 'DOUGLAS_PEUCKER'
             
             # Make a directory
             parent_folder_path = os.path.join(os.path.dirname(parameters[1].valueAsText),
@@ -675,6 +783,15 @@ class Use_Restrictions_v2(object):
             #filename = os.path.basename(__file__)
             analysis_id_time_stamp = analysis_id+"_"+date_time_stamp
 
+            # Resuming reuses the latest geodatabase (and logs) of this analysis that has stage markers
+            resume_gdbs = []
+            if parameters[42].value:
+                resume_gdbs = sorted((os.path.getmtime(gdb), gdb) for gdb in
+                                     glob.glob(child_folder_path+"\\"+analysis_id+"_*.gdb")
+                                     if arcpy.Exists(os.path.join(gdb, stage_checkpoints.CHECKPOINT_TABLE)))
+            if resume_gdbs:
+                analysis_id_time_stamp = os.path.splitext(os.path.basename(resume_gdbs[-1][1]))[0]
+
             # Create the logger
             report_path = child_folder_path+"\\"+analysis_id_time_stamp+"_Report.txt"
             logfile_path = child_folder_path+"\\"+analysis_id_time_stamp+"_Logfile.txt"
@@ -694,6 +811,12 @@ class Use_Restrictions_v2(object):
             logger.log_all("Output Location:\n")
             logger.log_all('\t'+parameters[1].valueAsText+'\n')
 
+            # Stage and geoprocessing call trace - see pipeline_profile.py
+            if parameters[41].value:
+                profile_path = child_folder_path+"\\"+analysis_id_time_stamp+"_Profile.jsonl"
+                profiler = pipeline_profile.Profiler(profile_path, vertices=True)
+                logger.logfile('Profile trace:', profile_path)
+
 
 ###################################################################################################
 ##
@@ -704,19 +827,35 @@ class Use_Restrictions_v2(object):
             # Make a geodatabase
             database_name = analysis_id_time_stamp+'.gdb'
             database_path = child_folder_path
-            arcpy.CreateFileGDB_management(database_path, database_name, "10.0")
             output_path = database_path+"\\"+database_name
-            logger.log_all('Created geodatabase at: \n')
+            if resume_gdbs:
+                logger.log_all('Resuming geodatabase at: \n')
+            else:
+                arcpy.CreateFileGDB_management(database_path, database_name, "10.0")
+                logger.log_all('Created geodatabase at: \n')
             logger.log_all('\t'+output_path+"\n")
 
-            # Secure a copy of the input analysis area
-            arcpy.MakeFeatureLayer_management(parameters[0].value, "in_memory\\_")
+            # Every stage below leaves a marker in the geodatabase when it finishes - a rerun
+            # with Resume Previous Run skips the stages whose inputs have not changed
+            checkpoints = stage_checkpoints.StageCheckpoints(output_path)
 
             # Dissolve everything to prevent overlapping input polygons
-            logger.console('1.) Dissolving input polygon')
-            arcpy.Dissolve_management("in_memory\\_", "in_memory\\__")
+            profiler.stage('1.) Dissolving input polygon')
             analysis_area = output_path+"\\"+analysis_id+"_Analysis_Area"
-            arcpy.CopyFeatures_management("in_memory\\__", analysis_area)
+            fingerprint = checkpoints.fingerprint('analysis_area', stage_checkpoints.source_state(
+                parameters[0].valueAsText))
+            if checkpoints.done('analysis_area', fingerprint):
+                logger.console('1.) Analysis area done on an earlier run')
+            else:
+                logger.console('1.) Dissolving input polygon')
+                # Secure a copy of the input analysis area
+                area_layer = scratch.layer('analysis_area')
+                arcpy.MakeFeatureLayer_management(parameters[0].value, area_layer)
+                area_dissolve = scratch.feature_class('analysis_dissolve')
+                arcpy.Dissolve_management(area_layer, area_dissolve)
+                arcpy.CopyFeatures_management(scratch.use(area_dissolve), analysis_area)
+                scratch.release(area_dissolve)
+                checkpoints.complete('analysis_area', fingerprint)
 
             # Set the workspace to the output database
             arcpy.env.workspace = output_path
@@ -809,40 +948,100 @@ class Use_Restrictions_v2(object):
             logger.logfile('Input categories:', input_categories)
 
             # Create feature datasets: 'Inputs' for copy of input data, 'Results' for outputs
-            arcpy.CreateFeatureDataset_management(output_path, "Inputs", spatial_ref)
-            arcpy.CreateFeatureDataset_management(output_path, "Results", spatial_ref)
-
-            logger.console('2.) Dissolving criteria unions')
-
-            # Function to unioned the layers and dissolve
-            # Deletes attribute data!
-            def union_inputs(input): #(name, fc_list)
-                name, fc_list = input[0], input[1]
-                union_output = output_path+"\\Inputs\\"+name
-                arcpy.Union_analysis(fc_list, "in_memory\\dissolve")
-                arcpy.Dissolve_management("in_memory\\dissolve", union_output)
-                arcpy.Delete_management("in_memory\\dissolve")
-                return
-                
+            for dataset in ("Inputs", "Results"):
+                if not arcpy.Exists(output_path+"\\"+dataset):
+                    arcpy.CreateFeatureDataset_management(output_path, dataset, spatial_ref)
+
             # Prep the tasks - makes it easier to read
             tasks = [(id[2:], data[0]) for id, data in sorted_inputs]
             logger.logfile('tasks', tasks)
 
-            # Union
-            for task in tasks:
-                union_inputs(task)
+            # Sample the inputs and estimate each way of running them - see run_planner.py
+            # A resumed run skips the estimate and keeps the strategy AUTO picked the
+            # first time - a different one would throw the finished stages away
+            workers = parameters[36].value or 1
+            raster_cell = parameters[40].value
+            strategy = parameters[43].valueAsText or 'AS SET'
+            settings = checkpoints.saved('strategy') if strategy == 'AUTO' else None
+            if resume_gdbs and (settings or strategy != 'AUTO'):
+                logger.console('Resuming - skipping the run estimate')
+            else:
+                plan = run_planner.plan_run(analysis_area, tasks,
+                                            multiprocessing.cpu_count() if strategy == 'AUTO' else workers,
+                                            raster_cell)
+                for line in run_planner.format_plan(plan):
+                    logger.console(line)
+                    logger.logfile(line)
+                if strategy == 'AUTO':
+                    settings = plan['strategies'][plan['recommended']]['settings']
+                    checkpoints.save('strategy', settings)
+                    logger.logfile('Execution strategy:', plan['recommended'], settings)
+            if settings:
+                workers, tiling, raster_cell = (settings['workers'], settings['tiling'],
+                                                settings['raster_cell'])
+
+            # Union and dissolve each criterion - deletes attribute data!
+            # Every criterion gets its own scratch gdb so they can run side by side
+            profiler.stage('2.) Dissolving criteria unions')
+            fingerprint = checkpoints.fingerprint('criteria', [(name, stage_checkpoints.source_state(fc_list))
+                                                               for name, fc_list in tasks],
+                                                  generalize_tolerance, generalize_method)
+            if checkpoints.done('criteria', fingerprint):
+                logger.console('2.) Criteria done on an earlier run')
+            else:
+                logger.console('2.) Dissolving criteria unions - {} worker(s)'.format(workers))
+                # Criteria left over from an earlier run with different inputs
+                for fc in arcpy.ListFeatureClasses(feature_dataset="Inputs"):
+                    arcpy.Delete_management(fc)
+                logger.logfile('Criteria workers:', workers)
+                scratch_folder = tempfile.mkdtemp(prefix='criteria_', dir=child_folder_path)
+                try:
+                    def dissolve(todo):
+                        return use_restrictions_workers.dissolve_criteria(todo, scratch_folder,
+                                                                          workers, logger.console,
+                                                                          scratch)
+                    cache_folder = parameters[38].valueAsText
+                    if cache_folder:
+                        # Only the criteria whose inputs changed are dissolved again
+                        logger.logfile('Criteria cache:', cache_folder)
+                        cache = criteria_cache.CriteriaCache(cache_folder, log=logger.console)
+                        dissolved, cache_keys = criteria_cache.cached_criteria(tasks, cache, dissolve,
+                                                                               logger.console)
+                        cache.evict(keep=cache_keys)
+                    else:
+                        dissolved = dissolve(tasks)
+                    # Merge the results into Inputs
+                    for name, fc_list in tasks:
+                        arcpy.CopyFeatures_management(dissolved[name],
+                                                      output_path+"\\Inputs\\"+name)
+                finally:
+                    shutil.rmtree(scratch_folder, ignore_errors=True)
+
+                # Fewer vertices for the union and matrix - see criteria_generalize.py
+                if generalize_tolerance:
+                    logger.console('Generalizing criteria - {} at {}'.format(generalize_method,
+                                                                            generalize_tolerance))
+                    generalized = criteria_generalize.generalize_criteria(
+                        [(name, output_path+"\\Inputs\\"+name) for name, fc_list in tasks],
+                        generalize_tolerance, generalize_method, logger.console)
+                    logger.report("\nGENERALIZATION - {} at {}:\n".format(generalize_method,
+                                                                          generalize_tolerance))
+                    for line in criteria_generalize.format_report(generalized):
+                        logger.logfile(line)
+                        logger.report("\t"+line+"\n")
                    
-            # Write inputs to report
-            for category in input_categories:
-                logger.report("\n"+category.upper()+":\n")
-                for ID, data_list in sorted_inputs:
-                    paths = data_list[0].split(";")
-                    if data_list[1] == category:
-                        logger.report("\t"+ID[2:].upper().replace("_", " ")+
-                                      ' - '+data_list[2]+'\n')
-                        for path_name in paths:
-                            logger.report("\t\t"+path_name)
-                        logger.report("\n")
+                # Write inputs to report
+                for category in input_categories:
+                    logger.report("\n"+category.upper()+":\n")
+                    for ID, data_list in sorted_inputs:
+                        paths = data_list[0].split(";")
+                        if data_list[1] == category:
+                            logger.report("\t"+ID[2:].upper().replace("_", " ")+
+                                          ' - '+data_list[2]+'\n')
+                            for path_name in paths:
+                                logger.report("\t\t"+path_name)
+                            logger.report("\n")
+                checkpoints.complete('criteria', fingerprint)
 
             # Create a master list of all category fcs that were created for later intersection
             all_fcs_list = []
@@ -850,199 +1049,216 @@ class Use_Restrictions_v2(object):
                 all_fcs_list.append(fc)  
             logger.logfile('all_fcs_list', all_fcs_list)
 
-            # For each fc in all_fcs_list,
-            # dissolve the fc and out put as analysis_id + feature name
-            for fc in all_fcs_list:
-                logger.logfile("FC", fc)
-                output_fc_name = "Restriction_"+os.path.basename(fc)
-                logger.logfile('output_fc_name', output_fc_name)
-                output_fc_path = output_path+"\\Results\\"+output_fc_name
-                #output_fc_path = output_path+"\\"+output_fc_name
-                logger.logfile('output_fc_path', output_fc_path)
-                arcpy.Clip_analysis(analysis_area, fc, "in_memory\\clip")
-                # Dissolve the clips
-                arcpy.Dissolve_management("in_memory\\clip", output_fc_path)
-                
             # map the criteria to their categories
             fc_id_map = defaultdict(str)
             for key, value in sorted_inputs:
                 fc_id_map[key[2:]] = value[2]
 
+            # Raster estimate - acreage figures in seconds, no union or matrix
+            if raster_cell:
+                profiler.stage('Raster estimate')
+                logger.console('Estimating acres on a {} cell raster'.format(raster_cell))
+                zones_fc, zone_field = None, None
+                if alternative == "ALT_D":
+                    zones_fc, zone_field = ALT_D_ECOREGIONS, ALT_D_ECOREGION_FIELD
+                estimate = restriction_raster.raster_estimate(
+                    analysis_area,
+                    [(fc_id_map[str(fc)], arcpy.Describe(fc).catalogPath) for fc in all_fcs_list],
+                    raster_cell, zones_fc, zone_field, logger.console)
+                outCSV = child_folder_path+"\\"+analysis_id_time_stamp+'_Raster_Estimate.csv'
+                restriction_raster.write_estimate_csv(outCSV, analysis_id, estimate)
+                logger.console('Estimated {:.2f} restricted acres +/- {:.2f}'.format(
+                    estimate['markup'], estimate['bounds']['markup']))
+                logger.log_all('\nSuccessful completion..\n')
+                return
+
+            # For each fc in all_fcs_list,
+            # dissolve the fc and out put as analysis_id + feature name
+            profiler.stage('Clipping criteria to the analysis area')
+            fingerprint = checkpoints.fingerprint('results')
+            if not checkpoints.done('results', fingerprint):
+                for fc in arcpy.ListFeatureClasses(feature_dataset="Results"):
+                    arcpy.Delete_management(fc)
+                for fc in all_fcs_list:
+                    logger.logfile("FC", fc)
+                    output_fc_name = "Restriction_"+os.path.basename(fc)
+                    logger.logfile('output_fc_name', output_fc_name)
+                    output_fc_path = output_path+"\\Results\\"+output_fc_name
+                    #output_fc_path = output_path+"\\"+output_fc_name
+                    logger.logfile('output_fc_path', output_fc_path)
+                    with profiler.section(output_fc_name):
+                        clip = scratch.feature_class('clip')
+                        arcpy.Clip_analysis(analysis_area, fc, clip)
+                        # Dissolve the clips
+                        arcpy.Dissolve_management(scratch.use(clip), output_fc_path)
+                        scratch.release(clip)
+                checkpoints.complete('results', fingerprint)
+                
             # Collapse geometry union [will be slow with full input]
-            logger.console('3.) Unioning all criteria inputs')
             output_aggregate_feature = output_path+"\\Aggregate_Results"
-
-            # Add input analysis area to list of union and union it all
-            all_fcs_list_copy = copy.deepcopy(all_fcs_list)
-            ### Try actual path to Analysis_Area
-            #all_fcs_list_copy.append(u'Analysis_Area')
-            all_fcs_list_copy.append(analysis_area)
-            logger.logfile("all_fcs_list_copy", all_fcs_list_copy)
-            arcpy.Union_analysis(all_fcs_list_copy, "in_memory\\agg_union")
-
-            # Clip the union and output it
-            arcpy.Clip_analysis("in_memory\\agg_union", analysis_area, "in_memory\\clip_")
-
-            # Make sure everything is in single-part format for later analysis - JIC
-            arcpy.MultipartToSinglepart_management("in_memory\\clip_", output_aggregate_feature)
-
-            # Create the matrix
-            logger.console('4.) Creating matrix')
-
-            # Erase all the other fields - ETFP
-            erase_fields_lst = [field.name for field in arcpy.ListFields(output_aggregate_feature)]
-            for field in erase_fields_lst:
+            output_aggregate_feature_markup = output_path+"\\"+analysis_id+"_Restrictions_Markup"
+            criteria_fcs = [(fc_id_map[str(fc)], arcpy.Describe(fc).catalogPath) for fc in all_fcs_list]
+            codes = [code for code, fc in criteria_fcs]
+            tallies = None
+            tiles, tile_extent = restriction_tiles.make_tiles(tiling, analysis_area, criteria_fcs)
+            fingerprint = checkpoints.fingerprint('overlay', tiling, compact_output)
+            if checkpoints.done('overlay', fingerprint):
+                logger.console('3.) Overlay done on an earlier run')
+            elif tiles:
+                # Clip, union and matrix per tile on a process pool, then stitch the tiles
+                profiler.stage('3.) Overlaying criteria by tile')
+                logger.console('3.) Overlaying criteria by tile')
+                tile_folder = tempfile.mkdtemp(prefix='tiles_', dir=child_folder_path)
                 try:
-                    arcpy.DeleteField_management(output_aggregate_feature, field)
-                except:
-                    # Should minimally fail on OID, Shape, Shape_area, and Shape_length
-                    logger.logfile("Delete field failed:", field) 
-
-            # Delete identical features within output_aggregate_feature to prevent double counting
-            try:
-                arcpy.DeleteIdentical_management(output_aggregate_feature, ["SHAPE"])
-                logger.logfile("Delete identical succeeded")
-            except:
-                logger.logfile("Delete identical failed") # This will usually fail - it's ok
-
-            # Calculate acres for output_aggregate_field and get acre field name
-            acre_field = get_acres(output_aggregate_feature)
+                    acre_field, tallies = restriction_tiles.tiled_overlay(analysis_area, criteria_fcs,
+                                                                          output_aggregate_feature,
+                                                                          tiles, tile_extent, tile_folder,
+                                                                          workers, compact_output, logger.console,
+                                                                          scratch=scratch)
+                finally:
+                    shutil.rmtree(tile_folder, ignore_errors=True)
+                checkpoints.complete('overlay', fingerprint)
+            else:
+                profiler.stage('3.) Unioning all criteria inputs')
+                logger.console('3.) Unioning all criteria inputs')
+
+                # Add input analysis area to list of union and union it all
+                all_fcs_list_copy = copy.deepcopy(all_fcs_list)
+                ### Try actual path to Analysis_Area
+                #all_fcs_list_copy.append(u'Analysis_Area')
+                all_fcs_list_copy.append(analysis_area)
+                logger.logfile("all_fcs_list_copy", all_fcs_list_copy)
+                # ONLY_FID keeps the lineage - one FID_ field per input, -1 where a piece is outside it
+                agg_union = scratch.feature_class('agg_union')
+                arcpy.Union_analysis(all_fcs_list_copy, agg_union, "ONLY_FID")
+
+                # Clip the union and output it
+                agg_clip = scratch.feature_class('agg_clip')
+                arcpy.Clip_analysis(scratch.use(agg_union), analysis_area, agg_clip)
+                scratch.release(agg_union)
+
+                # Make sure everything is in single-part format for later analysis - JIC
+                # The union is kept on disk until the matrix is built so a failed matrix can be rerun
+                arcpy.MultipartToSinglepart_management(scratch.use(agg_clip),
+                                                       output_path+"\\Aggregate_Union")
+                scratch.release(agg_clip)
+                checkpoints.complete('overlay', fingerprint)
+
+            # Tiled overlays build the matrix tile by tile
+            fingerprint = checkpoints.fingerprint('matrix')
+            if tiles or checkpoints.done('matrix', fingerprint):
+                pass
+            else:
+                # Create the matrix
+                profiler.stage('4.) Creating matrix')
+                logger.console('4.) Creating matrix')
+                all_fcs_list_copy = all_fcs_list + [analysis_area]
+                lineage = restriction_matrix.lineage_fields(output_path+"\\Aggregate_Union",
+                                                            all_fcs_list_copy)
+                arcpy.CopyFeatures_management(output_path+"\\Aggregate_Union", output_aggregate_feature)
+
+                # Erase all the other fields - ETFP
+                erase_fields_lst = [field.name for field in arcpy.ListFields(output_aggregate_feature)
+                                    if field.name not in lineage.values()]
+                for field in erase_fields_lst:
+                    try:
+                        arcpy.DeleteField_management(output_aggregate_feature, field)
+                    except:
+                        # Should minimally fail on OID, Shape, Shape_area, and Shape_length
+                        logger.logfile("Delete field failed:", field) 
+
+                # Delete identical features within output_aggregate_feature to prevent double counting
+                # - their lineage is kept on the surviving copy
+                duplicates = duplicate_geometry.delete_duplicates(output_aggregate_feature,
+                                                                  merge_fields=lineage.values())
+                for line in duplicate_geometry.format_report(duplicates):
+                    logger.logfile(line)
+
+                # Populate the matrix from the union lineage - every criterion column, the acres
+                # and the acreage tallies in one cursor sweep, no select by location per criterion
+                profiler.stage('5.) Populating matrix')
+                logger.console('5.) Populating matrix')
+                criteria = [(fc_id_map[str(fc)], lineage[fc]) for fc in all_fcs_list]
+                acre_field, tallies = restriction_matrix.populate_matrix(output_aggregate_feature,
+                                                                         criteria,
+                                                                         compact=compact_output)
+
+                # The lineage fields have done their job
+                arcpy.DeleteField_management(output_aggregate_feature, list(lineage.values()))
+                checkpoints.complete('matrix', fingerprint)
+                arcpy.Delete_management(output_path+"\\Aggregate_Union")
+
+            profiler.stage('6.) Creating markup output')
+            fingerprint = checkpoints.fingerprint('markup')
+            if checkpoints.done('markup', fingerprint):
+                # Everything upstream is on disk - tally the finished markup again
+                logger.console('6.) Markup done on an earlier run')
+                acre_field, tallies = restriction_matrix.tally_matrix(output_aggregate_feature_markup,
+                                                                      codes)
+                if arcpy.Exists(output_aggregate_feature):
+                    arcpy.Delete_management(output_aggregate_feature)
+            else:
+                logger.console('6.) Creating markup output')
+                if tallies is None:
+                    # The matrix came from an earlier run
+                    acre_field, tallies = restriction_matrix.tally_matrix(output_aggregate_feature,
+                                                                          codes)
+
+                # The key to the CRITERIA bitmask
+                restriction_matrix.write_code_table(output_path+"\\"+analysis_id+"_Criteria_Codes",
+                                                    codes, list(tallies['criteria'].values()))
+
+                # Write the markup feature to disc
+                arcpy.CopyFeatures_management(output_aggregate_feature,
+                                              output_aggregate_feature_markup)
+                # Before the delete - a resumed run tallies the markup from here on
+                checkpoints.complete('markup', fingerprint)
+
+                # Delete the lingering unmarked output 
+                # Comment out to keep original with original fields
+                arcpy.Delete_management(output_aggregate_feature)
 
             # Create a defaultdict to store acreages - default dictionaries are awesome!
             acreage_counts = defaultdict(int)
-
-            # Iterate across all_fcs_list and add field,
-            # select by location and calculate field with ID, remove null
-            arcpy.MakeFeatureLayer_management(output_aggregate_feature, "in_memory\\mem_agg_layer")
-
-            # Create a list to store all added field ids
-            fc_field_list = []
-
-            logger.console('5.) Populating matrix')
-            for fc in all_fcs_list:
-                fc_ID = fc_id_map[str(fc)]
-
-                # Copy the created fields for later use in fields summary
-                fc_field_list.append(fc_ID)
-
-                # Add field, select, and calculate
-                arcpy.AddField_management("in_memory\\mem_agg_layer", 
-                                          fc_ID, "Text", field_length=20)
-                arcpy.SelectLayerByLocation_management("in_memory\\mem_agg_layer", "WITHIN", 
-                                                       fc, selection_type="NEW_SELECTION")
-                
-                arcpy.CalculateField_management("in_memory\\mem_agg_layer",
-                                                fc_ID, '"'+fc_ID+'"', "PYTHON_9.3")
-
-                # Get the acres
-                fc_acres = sum([row[0] for row in 
-                                arcpy.da.SearchCursor("in_memory\\mem_agg_layer", acre_field)])
-
-                # Add key=fc_id and value=acreage to sweet default dictionary
+            for fc_ID, fc_acres in tallies['criteria'].items():
                 acreage_counts[fc_ID] = round(fc_acres, 2)
 
-                # Switch the selection
-                arcpy.SelectLayerByAttribute_management("in_memory\\mem_agg_layer",
-                                                        "SWITCH_SELECTION")
-
-                # Clean the table for readability - replace "Null" with ""
-                arcpy.CalculateField_management("in_memory\\mem_agg_layer",
-                                                fc_ID, '"'+""+'"', "PYTHON_9.3")
-                
-                arcpy.SelectLayerByAttribute_management("in_memory\\mem_agg_layer",
-                                                        "CLEAR_SELECTION")
-
-            # Write the markup feature to disc
-            output_aggregate_feature_markup = output_path+"\\"+analysis_id+"_Restrictions_Markup"
-            arcpy.CopyFeatures_management("in_memory\\mem_agg_layer",
-                                          output_aggregate_feature_markup)
-
-            # Create a summary field and get list of other fields
-            arcpy.AddField_management(output_aggregate_feature_markup,
-                                      "Summary", "Text", field_length=255)
-            
-            fc_field_list.append('Summary')
-            num_fields = len(fc_field_list)
-            with arcpy.da.UpdateCursor(output_aggregate_feature_markup, fc_field_list) as cur:
-                for row in cur:
-                    # There's gotta be a better way to do this...
-                    row[num_fields-1] = re.sub('\s+', ' ', (reduce(lambda x,y: x+" "+y,
-                                                 [row[i] for i in range(num_fields-1)]))).strip()
-                    
-                    cur.updateRow(row)
-
-            # Get the total analysis acreage
-            arcpy.MakeFeatureLayer_management(output_aggregate_feature_markup, 
-                                              "in_memory\\_markup")
-            
-            total_analysis_acres = sum([row[0] for row in 
-                                        arcpy.da.SearchCursor("in_memory\\_markup", acre_field)])
-            
+            # Get the total analysis acreage - tallied with the matrix
+            total_analysis_acres = tallies['total']
             logger.logfile("Total analysis acres", total_analysis_acres)
 
-            # Get the total marked-up acreage
-            logger.console('6.) Creating markup output')
-            arcpy.SelectLayerByAttribute_management("in_memory\\_markup",
-                                                    "NEW_SELECTION", """ "Summary" <> '' """)
-            
-            total_markup_acres = sum([row[0] for row in 
-                                      arcpy.da.SearchCursor("in_memory\\_markup", acre_field)])
+            # Get the total marked-up acreage - every polygon within at least one criterion
+            total_markup_acres = tallies['markup']
             
             logger.logfile("Total markup acres", total_markup_acres)
 
-            # Delete the lingering unmarked output 
-            # Comment out to keep original with original fields
-            arcpy.Delete_management(output_aggregate_feature)
-
             # Partition datasets - Alternative D
             logger.logfile("alternative", alternative)
             if alternative == "ALT_D":
                 
-                # Partition the data sets by ecoregion and write outputs to csv
+                # Tally the markup by ecoregion - one intersect and one cursor pass
                 logger.console('      Partitioning outputs by ecoregions')
-                ecoregions = r"T:\CO\GIS\giswork\rgfo\projects\management_plans\ECRMP"\
-                             r"\Draft_RMP_EIS\1_Analysis\ECRMP_Outputs\boundaries"\
-                             r"\boundaries.gdb\ECRMP_HumanEcoregions_AltD_20160602"
+                ecoregion_fc = output_path+"\\"+analysis_id+"_Markup_Ecoregions"
+                ecoregion_tallies = restriction_matrix.zone_matrix(output_aggregate_feature_markup,
+                                                                   ALT_D_ECOREGIONS, ALT_D_ECOREGION_FIELD,
+                                                                   codes, ecoregion_fc)
+                logger.logfile("Ecoregion_list", list(ecoregion_tallies))
+                restriction_matrix.write_zone_table(output_path+"\\"+analysis_id+"_Ecoregion_Acres",
+                                                    ecoregion_tallies, codes)
 
                 # Create a default dict to hold the values
                 ecoregion_markup_acres = defaultdict(int)
+                for ecoregion, tally in ecoregion_tallies.items():
+                    ecoregion_markup_acres[analysis_id+"__"+ecoregion] = round(tally['markup'], 2)
 
-                # Get a list of ecoregions
-                ecoregion_field = "Community_Landscape"
-                ecoregion_list = [str(row[0]) for row in 
-                                  arcpy.da.SearchCursor(ecoregions, ecoregion_field)]
-
-                logger.logfile("Ecoregion_list", ecoregion_list)
-                
-                # these will be created by split
-                ecoregion_out_names = [output_path+"\\"+er for er in ecoregion_list]
-                # Rename to these:
-                ecoregion_rename = [output_path+"\\"+analysis_id+"__"+er for er in ecoregion_list]
-                logger.logfile("Ecoregion_out_names", ecoregion_out_names)
-                
-                arcpy.Split_analysis(output_aggregate_feature_markup, ecoregions,
-                                     ecoregion_field, output_path)
-               
-                # Rename the ecoregion split outputs
-                for old_name, new_name in zip(ecoregion_out_names, ecoregion_rename):
-                    arcpy.Rename_management(old_name, new_name) 
-                
-                for ecoregion_fc in ecoregion_rename:
-                    # Get the acres
-                    acre_field = get_acres(ecoregion_fc)
-                    arcpy.MakeFeatureLayer_management(ecoregion_fc, "in_memory\\ecoregion")
-                    arcpy.SelectLayerByAttribute_management("in_memory\\ecoregion", 
-                                                            "NEW_SELECTION", 
-                                                            """ "Summary" <> '' """)
-                    
-                    ecoregion_acres = sum([row[0] for row in 
-                                           arcpy.da.SearchCursor("in_memory\\ecoregion",
-                                                                 acre_field)])
-
-                    # Add key=fc_id and value=acreage to sweet default dictionary
-                    ecoregion_markup_acres[ecoregion_fc] = round(ecoregion_acres, 2)
+                # A feature class per ecoregion only when asked for
+                if parameters[46].value:
+                    logger.logfile("Ecoregion exports", restriction_matrix.export_zones(
+                        ecoregion_fc, ALT_D_ECOREGION_FIELD, list(ecoregion_tallies),
+                        output_path, analysis_id+"__"))
 
             # Write outputs acreages to csv
+            profiler.stage('7.) Writing data')
             logger.console('7.) Writing data')
             outCSV = child_folder_path+"\\"+analysis_id_time_stamp+'_Acreage.csv'
             with open(outCSV, 'wb') as csvfile:
@@ -1108,7 +1324,13 @@ class Use_Restrictions_v2(object):
                 logger.log_all("Time Elapsed: %s" %(str(end_time - start_time)))
             except:
                 pass
-            deleteInMemory()
+            profiler.close()
+            for line in profiler.summary_table():
+                try:
+                    logger.logfile(line)
+                except:
+                    pass
+            scratch.close()
 
 
 ###################################################################################################
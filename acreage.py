@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Planar area, perimeter and acreage for whole feature classes in NumPy.
+
+Replaces the CalculateField "!shape.area@ACRES!" step and the SearchCursor
+pass that sums it afterwards.  Geometry is read once as WKB, every ring of
+every feature goes into one ragged coordinate array (see geometry_batch),
+and the shoelace area and perimeter of all the rings are computed at once.
+Holes and multipart features are handled by the ring orientation - outer
+rings and holes wind in opposite directions, so the signed ring areas of a
+feature sum to its net area.
+
+    measures = measure_features(fc, ['method'])
+    measures['area']                 # acres per feature
+    measures['area'].sum()           # total acres
+    grouped_totals(measures['area'], measures['method'])
+
+    acre_field, acres = calculate_acres(fc)    # drop-in for get_acres
+
+Areas are planar, in the units of a projected coordinate system - the same
+as shape.area@ACRES on projected data.
+"""
+
+from __future__ import division
+import collections
+import struct
+import numpy as np
+
+
+# Square meters per area unit
+AREA_UNITS = {'SQUARE_METERS': 1.0,
+              'SQUARE_KILOMETERS': 1.0e6,
+              'HECTARES': 1.0e4,
+              'ACRES': 4046.8564224,
+              'SQUARE_FEET': 0.09290304,
+              'SQUARE_MILES': 2589988.110336}
+
+# Meters per length unit
+LENGTH_UNITS = {'METERS': 1.0,
+                'KILOMETERS': 1000.0,
+                'FEET': 0.3048,
+                'MILES': 1609.344}
+
+# WKB geometry types
+_WKB_POLYGON = 3
+_WKB_MULTIPOLYGON = 6
+
+
+# Functions
+def ring_measures(xy, ring_offsets):
+    """
+    Returns (area, perimeter) arrays, one value per ring of the ragged
+    arrays xy (M, 2) and ring_offsets (R+1).  Areas are signed - positive
+    counter-clockwise.  Rings may be open or closed, the closing segment
+    is added either way (it is zero length for a closed ring).
+    """
+    xy = np.ascontiguousarray(xy, dtype=np.float64).reshape(-1, 2)
+    ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+    nring = len(ring_offsets) - 1
+    if len(xy) == 0:
+        return np.zeros(nring), np.zeros(nring)
+    counts = np.diff(ring_offsets)
+    rid = np.repeat(np.arange(nring), counts)
+
+    # Next vertex in the ring, wrapping the last back to the first
+    nxt = np.arange(1, len(xy) + 1)
+    full = counts > 0
+    nxt[ring_offsets[1:][full] - 1] = ring_offsets[:-1][full]
+
+    # Work relative to the first vertex of each ring - state plane and UTM
+    # coordinates are large enough to lose digits in the cross products
+    origin = xy[np.minimum(ring_offsets[:-1], len(xy) - 1)]
+    x = xy[:, 0] - origin[rid, 0]
+    y = xy[:, 1] - origin[rid, 1]
+    cross = x * y[nxt] - x[nxt] * y
+    seg = np.hypot(x[nxt] - x, y[nxt] - y)
+    area = np.bincount(rid, weights=cross, minlength=nring) / 2.0
+    perimeter = np.bincount(rid, weights=seg, minlength=nring)
+    return area, perimeter
+
+
+def feature_measures(xy, ring_offsets, ring_feature, nfeature=None):
+    """
+    Returns (area, perimeter) per feature from ring arrays, where
+    ring_feature gives the feature index of every ring.  The area is the
+    absolute value of the summed signed ring areas, so holes subtract;
+    the perimeter includes the holes, like shape.length.
+    """
+    ring_feature = np.asarray(ring_feature, dtype=np.int64)
+    if nfeature is None:
+        nfeature = int(ring_feature.max()) + 1 if len(ring_feature) else 0
+    ring_area, ring_perimeter = ring_measures(xy, ring_offsets)
+    area = np.bincount(ring_feature, weights=ring_area, minlength=nfeature)
+    perimeter = np.bincount(ring_feature, weights=ring_perimeter,
+                            minlength=nfeature)
+    return np.abs(area), perimeter
+
+
+def grouped_totals(values, groups):
+    """
+    Returns an OrderedDict of group: summed values, in sorted group
+    order - one bincount instead of a loop per group
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return collections.OrderedDict()
+    keys, inverse = np.unique(np.asarray(groups), return_inverse=True)
+    sums = np.bincount(inverse, weights=values, minlength=len(keys))
+    return collections.OrderedDict(zip(keys.tolist(), sums.tolist()))
+
+
+def wkb_polygons(wkb):
+    """
+    Returns a list of polygons, each a list of (N, 2) float64 ring arrays
+    (the outer ring first), from polygon or multipolygon WKB (2d, Z, M or
+    ZM, ISO or extended).  The coordinates are read straight out of the
+    buffer - only the ring headers are parsed in Python.
+    """
+    wkb = bytes(wkb)
+    polygons = []
+
+    def header(pos):
+        order = '<' if wkb[pos:pos + 1] == b'\x01' else '>'
+        geom_type, = struct.unpack_from(order + 'I', wkb, pos + 1)
+        base = geom_type & 0x0FFFFFFF
+        has_z = bool(geom_type & 0x80000000) or base // 1000 in (1, 3)
+        has_m = bool(geom_type & 0x40000000) or base // 1000 in (2, 3)
+        return order, base % 1000, 2 + has_z + has_m, pos + 5
+
+    def polygon(pos, order, dims):
+        nring, = struct.unpack_from(order + 'I', wkb, pos)
+        pos += 4
+        dtype = np.dtype(np.float64).newbyteorder(order)
+        rings = []
+        polygons.append(rings)
+        for i in range(nring):
+            npnt, = struct.unpack_from(order + 'I', wkb, pos)
+            pos += 4
+            coords = np.frombuffer(wkb, dtype, npnt * dims, pos)
+            rings.append(coords.reshape(-1, dims)[:, :2].astype(np.float64))
+            pos += 8 * npnt * dims
+        return pos
+
+    order, geom_type, dims, pos = header(0)
+    if geom_type == _WKB_POLYGON:
+        polygon(pos, order, dims)
+    elif geom_type == _WKB_MULTIPOLYGON:
+        npoly, = struct.unpack_from(order + 'I', wkb, pos)
+        pos += 4
+        for i in range(npoly):
+            order, geom_type, dims, pos = header(pos)
+            pos = polygon(pos, order, dims)
+    else:
+        raise ValueError("WKB geometry type {} is not a polygon".format(
+            geom_type))
+    return polygons
+
+
+def wkb_rings(wkb):
+    """Returns a list of (N, 2) float64 arrays, one per ring, from polygon
+       or multipolygon WKB - see wkb_polygons"""
+    return [ring for rings in wkb_polygons(wkb) for ring in rings]
+
+
+def polygons_wkb(polygons):
+    """Returns 2d little endian multipolygon WKB for a list of polygons,
+       each a list of (N, 2) ring arrays - the inverse of wkb_polygons"""
+    chunks = [struct.pack('<BII', 1, _WKB_MULTIPOLYGON, len(polygons))]
+    for rings in polygons:
+        chunks.append(struct.pack('<BII', 1, _WKB_POLYGON, len(rings)))
+        for ring in rings:
+            ring = np.ascontiguousarray(ring, dtype='<f8').reshape(-1, 2)
+            chunks.append(struct.pack('<I', len(ring)))
+            chunks.append(ring.tobytes())
+    return b''.join(chunks)
+
+
+def rings_from_wkb(wkbs):
+    """
+    Returns (xy, ring_offsets, ring_feature) for a sequence of polygon
+    WKB values - None (a null shape) gives a feature with no rings
+    """
+    rings = []
+    ring_feature = []
+    for i, wkb in enumerate(wkbs):
+        if wkb is None:
+            continue
+        feature_rings = wkb_rings(wkb)
+        rings.extend(feature_rings)
+        ring_feature.extend([i] * len(feature_rings))
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(ring) for ring in rings], out=ring_offsets[1:])
+    if rings:
+        xy = np.concatenate(rings)
+    else:
+        xy = np.zeros((0, 2), dtype=np.float64)
+    return xy, ring_offsets, np.array(ring_feature, dtype=np.int64)
+
+
+def measure_features(in_fc, fields=(), where_clause=None,
+                     spatial_reference=None, area_unit='ACRES',
+                     length_unit='METERS'):
+    """
+    Reads in_fc (a feature class or layer - selections are honored) in one
+    cursor pass and returns a dictionary of arrays, one value per feature:
+        oid, area (area_unit), perimeter (length_unit)
+    plus a list of values for each of the extra fields.  Raises
+    ValueError for geographic coordinates - pass a projected
+    spatial_reference to measure those.
+    """
+    import arcpy
+    if spatial_reference is None:
+        spatial_reference = arcpy.Describe(in_fc).spatialReference
+    if spatial_reference.type == 'Geographic':
+        raise ValueError("{} is in geographic coordinates - pass a projected "
+                         "spatial_reference for planar areas".format(in_fc))
+    fields = list(fields)
+    oids = []
+    wkbs = []
+    values = [[] for field in fields]
+    with arcpy.da.SearchCursor(in_fc, ['OID@', 'SHAPE@WKB'] + fields,
+                               where_clause, spatial_reference) as cur:
+        for row in cur:
+            oids.append(row[0])
+            wkbs.append(row[1])
+            for i in range(len(fields)):
+                values[i].append(row[i + 2])
+    xy, ring_offsets, ring_feature = rings_from_wkb(wkbs)
+    area, perimeter = feature_measures(xy, ring_offsets, ring_feature,
+                                       len(oids))
+    meters = spatial_reference.metersPerUnit
+    result = {'oid': np.array(oids, dtype=np.int64),
+              'area': area * meters**2 / AREA_UNITS[area_unit],
+              'perimeter': perimeter * meters / LENGTH_UNITS[length_unit]}
+    for field, field_values in zip(fields, values):
+        result[field] = field_values
+    return result
+
+
+def find_acre_field(in_fc):
+    """Returns the name of the ACRES field of in_fc (any case), adding
+       an ACRES double field if there is none"""
+    import arcpy
+    field_list = [field.name for field in arcpy.ListFields(in_fc)
+                  if field.name.upper() == "ACRES"]
+    if field_list:
+        return field_list[0]
+    arcpy.AddField_management(in_fc, "ACRES", "DOUBLE", 15, 2)
+    return "ACRES"
+
+
+def calculate_acres(in_fc, acre_field=None):
+    """
+    Writes the acres of every feature to acre_field and returns
+    (acre_field, total acres).  Without acre_field an existing ACRES field
+    (any case) is used, or an ACRES field is added - the same field the old
+    get_acres functions wrote with "!shape.area@ACRES!".
+    """
+    import arcpy
+    if acre_field is None:
+        acre_field = find_acre_field(in_fc)
+    measures = measure_features(in_fc)
+    acres = dict(zip(measures['oid'].tolist(), measures['area'].tolist()))
+    with arcpy.da.UpdateCursor(in_fc, ['OID@', acre_field]) as cur:
+        for oid, value in cur:
+            cur.updateRow([oid, acres.get(oid)])
+    return acre_field, float(measures['area'].sum())
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Bounding containers for every feature in a feature class, on a process pool.
+
+The extent and minimum bounding rectangle step of the Arch General Functions
+toolbox handles one project polygon.  This runs the same measurements over a
+whole statewide site or survey layer:
+
+    table = bounding_containers(r'C:\\data\\sites.gdb\\Sites',
+                                r'C:\\data\\sites.gdb\\Site_MBR',
+                                spatial_reference=arcpy.SpatialReference(26913))
+
+Vertices are read in chunks of whole features with FeatureClassToNumPyArray
+(explode_to_points) and copied into a fixed set of shared memory slots - a
+flat XY buffer and an offsets buffer each - that the workers received once,
+when the pool started.  A task only carries the slot number and the chunk
+size, so no coordinates are pickled, and a slot is reused as soon as its
+results come back.  Each worker runs the geometry_batch kernels over its
+chunk and returns one small column per measurement.  The columns are written
+out with NumPyArrayToTable, one row per feature keyed on SRC_OID.
+
+Child processes only import numpy and the geometry modules - arcpy is only
+imported by the parent for reading and writing.
+
+As with working_mp_GIS_example.py, call this from an importable module (or
+with "Run Python script in process" unchecked), never from inside a .pyt.
+"""
+
+from __future__ import division
+import collections
+import ctypes
+import multiprocessing
+import numpy as np
+
+import geometry_batch as gb
+import geometry_tools as gt
+import mp_setup
+
+
+# Output columns - name, dtype, and the key in the kernel results
+COLUMNS = [('SRC_OID', np.int32, 'oid'),
+           ('VERTICES', np.int32, 'vertices'),
+           ('XMIN', np.float64, 'xmin'),
+           ('YMIN', np.float64, 'ymin'),
+           ('XMAX', np.float64, 'xmax'),
+           ('YMAX', np.float64, 'ymax'),
+           ('XCENT', np.float64, 'xcent'),
+           ('YCENT', np.float64, 'ycent'),
+           ('MBR_ANGLE', np.float64, 'angle'),
+           ('MBR_LENGTH', np.float64, 'length'),
+           ('MBR_WIDTH', np.float64, 'width'),
+           ('MBR_AREA', np.float64, 'area'),
+           ('MIN_WIDTH', np.float64, 'min_width'),
+           ('HULL_AREA', np.float64, 'hull_area'),
+           ('HULL_PERIM', np.float64, 'hull_perimeter')]
+
+CHUNK_FEATURES = 20000
+SLOT_VERTICES = 2000000     # 32 MB of coordinates per slot
+
+
+# Set in each worker by _init_worker
+_slots = None
+
+
+def _slot_arrays(slot):
+    """Returns numpy views (xy, offsets) on a shared memory slot"""
+    xy_raw, offsets_raw = slot
+    return (np.ctypeslib.as_array(xy_raw).reshape(-1, 2),
+            np.ctypeslib.as_array(offsets_raw))
+
+
+def _init_worker(slots):
+    global _slots
+    _slots = slots
+
+
+def chunk_containers(xy, offsets, kernel='batch'):
+    """
+    Returns the measurement columns for one chunk of ragged polygons.
+    kernel='batch' runs geometry_batch across the chunk at once,
+    kernel='tools' loops geometry_tools.minRect - slower, kept to check
+    the batch results against
+    """
+    N = len(offsets) - 1
+    if kernel == 'batch':
+        result = gb.batch_bounding_containers(xy, offsets)
+        del result['mbr']
+        dx, dy = result['dx'], result['dy']
+    elif kernel == 'tools':
+        keys = ('xmin', 'ymin', 'xmax', 'ymax', 'xcent', 'ycent', 'angle',
+                'min_width', 'hull_area', 'hull_perimeter')
+        result = dict((key, np.zeros(N)) for key in keys)
+        dx = np.zeros(N); dy = np.zeros(N)
+        for i in range(N):
+            pnts = gt.CoordSeq(xy[offsets[i]:offsets[i+1]])
+            boxes = gt.boundingContainers(pnts)
+            LL, UL, UR, LR = boxes['extent']
+            result['xmin'][i], result['ymin'][i] = LL
+            result['xmax'][i], result['ymax'][i] = UR
+            result['angle'][i] = boxes['minRect'][1]
+            dx[i], dy[i] = boxes['minRect'][2:]
+            result['min_width'][i] = boxes['minWidthRect'][3]
+            result['hull_area'][i] = abs(boxes['hullArea'])
+            result['hull_perimeter'][i] = boxes['hullPerimeter']
+        result['xcent'] = (result['xmax'] - result['xmin'])/2.0 + result['xmin']
+        result['ycent'] = (result['ymax'] - result['ymin'])/2.0 + result['ymin']
+    else:
+        raise ValueError("kernel must be 'batch' or 'tools'")
+    result['length'] = np.maximum(dx, dy)
+    result['width'] = np.minimum(dx, dy)
+    result['area'] = dx*dy
+    result['vertices'] = np.diff(offsets)
+    return result
+
+
+def _slot_worker(slot, n_features, n_vertices, kernel):
+    """Pool task - measures the chunk sitting in a shared memory slot"""
+    xy, offsets = _slot_arrays(_slots[slot])
+    return chunk_containers(xy[:n_vertices], offsets[:n_features + 1],
+                            kernel)
+
+
+def _split_chunk(oids, xy, offsets, capacity):
+    """Splits a chunk at feature boundaries into pieces of at most
+       capacity vertices.  Yields (oids, xy, offsets, fits)"""
+    start = 0
+    N = len(oids)
+    while start < N:
+        base = offsets[start]
+        stop = int(np.searchsorted(offsets, base + capacity, 'right')) - 1
+        stop = min(max(stop, start), N)
+        if stop == start:
+            #a single feature larger than a slot
+            stop = start + 1
+            fits = False
+        else:
+            fits = True
+        yield (oids[start:stop], xy[base:offsets[stop]],
+               offsets[start:stop + 1] - base, fits)
+        start = stop
+
+
+def run_chunks(chunks, processes=None, kernel='batch', slots=None,
+               slot_vertices=SLOT_VERTICES, log=None):
+    """
+    Measures every chunk from an iterable of (oids, xy, offsets) and
+    returns a structured array of COLUMNS in chunk order.
+
+    processes  - worker count, default cpu_count() - 1; 1 runs in process
+    slots      - shared memory slots, default 2 per worker so the next
+                 chunk is loaded while the workers are busy
+    log        - a callable for progress and warning messages
+
+    A chunk whose worker fails is measured again in this process with the
+    tools kernel.  If that fails too, RuntimeError lists the OID ranges
+    once every other chunk is done, rather than leaving them out of the
+    table.
+    """
+    log = log or (lambda message: None)
+    if processes is None:
+        processes = max(1, multiprocessing.cpu_count() - 1)
+    parts = []
+
+    def collect(oids, result):
+        result['oid'] = oids
+        parts.append(result)
+
+    if processes == 1:
+        for oids, xy, offsets in chunks:
+            collect(oids, chunk_containers(xy, offsets, kernel))
+        return _to_table(parts)
+
+    slots = slots or 2*processes
+    shared = [(multiprocessing.RawArray(ctypes.c_double, 2*slot_vertices),
+               multiprocessing.RawArray(ctypes.c_int64, slot_vertices + 1))
+              for i in range(slots)]
+    views = [_slot_arrays(slot) for slot in shared]
+
+    mp_setup.set_executable()
+    pool = multiprocessing.Pool(processes, _init_worker, (shared,))
+    free = collections.deque(range(slots))
+    pending = collections.deque()
+    failures = []
+
+    def finish_oldest():
+        slot, oids, n_vertices, job = pending.popleft()
+        try:
+            collect(oids, job.get())
+        except Exception as e:
+            #the chunk is still in its slot - measure it again here
+            log('Warning: OIDs {} to {} failed, retrying with the tools '
+                'kernel\n{}'.format(oids[0], oids[-1], repr(e)))
+            slot_xy, slot_offsets = views[slot]
+            try:
+                collect(oids, chunk_containers(slot_xy[:n_vertices],
+                                               slot_offsets[:len(oids) + 1],
+                                               'tools'))
+            except Exception as e:
+                log('Warning: OIDs {} to {} failed again\n{}'.format(
+                    oids[0], oids[-1], repr(e)))
+                failures.append('{} to {}'.format(oids[0], oids[-1]))
+        free.append(slot)
+
+    try:
+        done = 0
+        for chunk_oids, chunk_xy, chunk_offsets in chunks:
+            for oids, xy, offsets, fits in _split_chunk(
+                    chunk_oids, chunk_xy, chunk_offsets, slot_vertices):
+                if not fits:
+                    #too big for a slot - measure it here, in order
+                    while pending:
+                        finish_oldest()
+                    collect(oids, chunk_containers(xy, offsets, kernel))
+                    continue
+                if not free:
+                    finish_oldest()
+                slot = free.popleft()
+                slot_xy, slot_offsets = views[slot]
+                slot_xy[:len(xy)] = xy
+                slot_offsets[:len(offsets)] = offsets
+                job = pool.apply_async(_slot_worker, [slot, len(oids),
+                                                      len(xy), kernel])
+                pending.append((slot, oids, len(xy), job))
+            done += len(chunk_oids)
+            log('Read {} features'.format(done))
+        while pending:
+            finish_oldest()
+    finally:
+        pool.close()
+        pool.join()
+    if failures:
+        raise RuntimeError('Chunks failed to measure - OIDs {}'.format(
+            ', '.join(failures)))
+    return _to_table(parts)
+
+
+def _to_table(parts):
+    """Concatenates the chunk results into one structured array"""
+    table = np.zeros(sum(len(part['oid']) for part in parts),
+                     dtype=[(name, dtype) for name, dtype, key in COLUMNS])
+    row = 0
+    for part in parts:
+        n = len(part['oid'])
+        for name, dtype, key in COLUMNS:
+            table[name][row:row + n] = part[key]
+        row += n
+    return table
+
+
+def read_chunks(in_fc, chunk_features=CHUNK_FEATURES, where_clause=None,
+                spatial_reference=None):
+    """
+    Yields (oids, xy, offsets) for consecutive blocks of chunk_features
+    features, read by OID range so each block is one array read.
+    Multipart features are measured on all of their vertices, features
+    with no geometry are skipped.
+    """
+    import arcpy
+    oid_field = arcpy.Describe(in_fc).OIDFieldName
+    oid_name = arcpy.AddFieldDelimiters(in_fc, oid_field)
+    with arcpy.da.SearchCursor(in_fc, ['OID@'], where_clause) as cur:
+        all_oids = sorted(row[0] for row in cur)
+    for i in range(0, len(all_oids), chunk_features):
+        block = all_oids[i:i + chunk_features]
+        where = '{0} >= {1} AND {0} <= {2}'.format(oid_name, block[0],
+                                                    block[-1])
+        if where_clause:
+            where = '({}) AND ({})'.format(where_clause, where)
+        vertices = arcpy.da.FeatureClassToNumPyArray(
+            in_fc, ['OID@', 'SHAPE@X', 'SHAPE@Y'], where,
+            spatial_reference, explode_to_points=True,
+            skip_nulls=True)
+        if len(vertices) == 0:
+            continue
+        oids, offsets = gb.offsets_from_ids(vertices['OID@'])
+        xy = np.column_stack([vertices['SHAPE@X'], vertices['SHAPE@Y']])
+        yield oids, xy, offsets
+
+
+def bounding_containers(in_fc, out_table, where_clause=None,
+                        spatial_reference=None, processes=None,
+                        chunk_features=CHUNK_FEATURES, kernel='batch',
+                        log=None):
+    """
+    Measures every feature in in_fc on a process pool and writes the
+    COLUMNS to out_table.  Use a projected spatial_reference - the
+    lengths and areas are in its linear unit.  Returns the structured
+    array that was written.
+    """
+    import arcpy
+    if log is None:
+        log = arcpy.AddMessage
+    chunks = read_chunks(in_fc, chunk_features, where_clause,
+                         spatial_reference)
+    table = run_chunks(chunks, processes, kernel, log=log)
+    if arcpy.Exists(out_table):
+        arcpy.Delete_management(out_table)
+    arcpy.da.NumPyArrayToTable(table, out_table)
+    log('Wrote {} rows to {}'.format(len(table), out_table))
+    return table
+
+
+if __name__ == '__main__':
+    import arcpy
+    import bounding_containers_mp
+    bounding_containers_mp.bounding_containers(
+        arcpy.GetParameterAsText(0), arcpy.GetParameterAsText(1),
+        arcpy.GetParameterAsText(2) or None)
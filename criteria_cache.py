@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of dissolved Use Restrictions criteria.
+
+Most criteria layers change a few times a year, but every run re-unions and
+re-dissolves all of them.  The cache keeps each dissolved criterion in a
+file geodatabase under cache_folder, keyed on the content of its inputs -
+the path, row count and a SHA-1 of the geometry (OID and WKB) of every
+input feature class - so a criterion is only recomputed when one of its
+inputs has actually changed:
+
+    cache = CriteriaCache(r'T:\\CO\\GIS\\cache\\use_restrictions')
+    dissolved, keys = cached_criteria(tasks, cache, dissolve, log)
+    cache.evict(keep=keys)
+
+Checksumming reads every geometry, which is much cheaper than a union and
+dissolve but not free, so each input's checksum is remembered with its
+modification time and row count and only recomputed when either changes.
+Modification times come from the files on disk - a shapefile's files, or
+every file of the geodatabase holding a feature class; inputs with no
+files to look at (SDE) are checksummed every run.
+
+The index is a JSON file next to the cache geodatabase.  Queued jobs run
+in parallel against one cache and a file geodatabase takes one writer, so
+every copy into or delete from the cache geodatabase and every change to
+the index is made holding a lock file (criteria_cache.lock), starting from
+the index as it is on disk.  Entries used within IN_USE_HOURS are never
+evicted - another run may still be copying them out.  Within a run only the
+parent process touches the cache - the dissolve workers never see it.
+"""
+
+from __future__ import division
+import contextlib
+import errno
+import glob
+import hashlib
+import json
+import os
+import socket
+import time
+
+
+CACHE_GDB = 'criteria_cache.gdb'
+INDEX_FILE = 'criteria_cache.json'
+LOCK_FILE = 'criteria_cache.lock'
+
+# Bump to invalidate every entry when the dissolve itself changes
+CACHE_VERSION = 1
+
+MAX_AGE_DAYS = 90
+MAX_BYTES = 20 * 1024**3
+
+# Never evict an entry used this recently - another run may be reading it
+IN_USE_HOURS = 24
+
+# Wait this long for the lock, polling every LOCK_POLL_SECONDS.  A lock
+# file older than LOCK_STALE_SECONDS was left behind by a run that died
+LOCK_TIMEOUT_SECONDS = 2 * 3600
+LOCK_POLL_SECONDS = 2
+LOCK_STALE_SECONDS = 6 * 3600
+
+
+# Functions
+def split_inputs(fc_list):
+    """Returns the paths of a ';' delimited (and possibly quoted) multivalue
+       parameter string, or of a list"""
+    if isinstance(fc_list, (list, tuple)):
+        return list(fc_list)
+    return [path.strip().strip("'\"") for path in fc_list.split(';')
+            if path.strip()]
+
+
+def _folder_size(folder):
+    """Total size of the files in folder, in bytes"""
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def modified_time(path):
+    """
+    Returns the latest modification time of the files behind a feature
+    class path, or None when there are none to look at
+    """
+    files = []
+    if os.path.isfile(path):
+        # A shapefile and its sidecar files
+        files = glob.glob(os.path.splitext(path)[0] + '.*')
+    else:
+        folder = path
+        while folder and not folder.lower().endswith('.gdb'):
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                folder = None
+                break
+            folder = parent
+        if folder and os.path.isdir(folder):
+            files = [os.path.join(folder, name) for name in os.listdir(folder)]
+    times = []
+    for name in files:
+        try:
+            times.append(os.path.getmtime(name))
+        except OSError:
+            pass
+    return max(times) if times else None
+
+
+def geometry_checksum(in_fc):
+    """Returns (row count, SHA-1 hex digest of every OID and WKB geometry)"""
+    import arcpy
+    digest = hashlib.sha1()
+    count = 0
+    with arcpy.da.SearchCursor(in_fc, ['OID@', 'SHAPE@WKB']) as cur:
+        for oid, wkb in cur:
+            digest.update(str(oid).encode('ascii'))
+            if wkb is not None:
+                digest.update(bytes(wkb))
+            count += 1
+    return count, digest.hexdigest()
+
+
+class CriteriaCache(object):
+    """
+    A cache geodatabase of dissolved criteria and its JSON index.
+
+    cache_folder  - created if it does not exist
+    max_age_days  - evict entries not used for this long
+    max_bytes     - then evict the least recently used entries until the
+                    cache geodatabase is no larger than this
+    """
+
+    def __init__(self, cache_folder, max_age_days=MAX_AGE_DAYS,
+                 max_bytes=MAX_BYTES, log=None):
+        import arcpy
+        self.folder = cache_folder
+        self.gdb = os.path.join(cache_folder, CACHE_GDB)
+        self.index_path = os.path.join(cache_folder, INDEX_FILE)
+        self.lock_path = os.path.join(cache_folder, LOCK_FILE)
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.log = log or (lambda message: None)
+        # Checksums worked out by this run, merged into every index write
+        self.sources = {}
+        self._lock_depth = 0
+        if not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+        with self.locked():
+            if not arcpy.Exists(self.gdb):
+                arcpy.CreateFileGDB_management(cache_folder, CACHE_GDB)
+
+    def _load(self):
+        self.index = {'version': CACHE_VERSION, 'entries': {}, 'sources': {}}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+                if index.get('version') == CACHE_VERSION:
+                    self.index = index
+            except ValueError:
+                self.log('Criteria cache index is unreadable - starting over')
+        self.index['sources'].update(self.sources)
+
+    def _write(self):
+        """Writes the index - to a temporary file first so a failed run
+           cannot leave half an index behind"""
+        temp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.rename(temp_path, self.index_path)
+
+    def _acquire(self):
+        waited = 0
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.EACCES):
+                    raise
+            else:
+                os.write(fd, '{} {} {}'.format(socket.gethostname(), os.getpid(),
+                                               time.ctime()).encode('utf-8'))
+                os.close(fd)
+                return
+            try:
+                stale = time.time() - os.path.getmtime(self.lock_path) > LOCK_STALE_SECONDS
+            except OSError:
+                # Released in between
+                stale = False
+            if stale:
+                self.log('Removing a stale criteria cache lock')
+                try:
+                    os.remove(self.lock_path)
+                except OSError:
+                    pass
+                continue
+            if waited >= LOCK_TIMEOUT_SECONDS:
+                raise RuntimeError('Criteria cache is locked by another run - '
+                                   'remove {} if that run is dead'.format(self.lock_path))
+            time.sleep(LOCK_POLL_SECONDS)
+            waited += LOCK_POLL_SECONDS
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds the cache lock for a block that changes the cache - the index
+        is reloaded from disk on the way in and written on the way out.
+        Blocks nest within one process.
+        """
+        if self._lock_depth:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+        self._acquire()
+        self._lock_depth = 1
+        try:
+            self._load()
+            yield
+            self._write()
+        finally:
+            self._lock_depth = 0
+            os.remove(self.lock_path)
+
+    def save(self):
+        """Writes this run's source checksums to the index"""
+        with self.locked():
+            pass
+
+    def source_checksum(self, path):
+        """
+        Returns (row count, checksum) of one input, reusing the remembered
+        checksum when the modification time and row count are unchanged
+        """
+        import arcpy
+        key = os.path.normcase(os.path.abspath(path))
+        mtime = modified_time(path)
+        count = int(arcpy.GetCount_management(path).getOutput(0))
+        known = self.sources.get(key) or self.index['sources'].get(key)
+        if (known and mtime is not None and known['mtime'] == mtime
+                and known['count'] == count):
+            return count, known['checksum']
+        count, checksum = geometry_checksum(path)
+        self.sources[key] = {'mtime': mtime, 'count': count,
+                             'checksum': checksum}
+        self.index['sources'][key] = self.sources[key]
+        return count, checksum
+
+    def key(self, fc_list):
+        """
+        Returns the cache key of a criterion - a SHA-1 of the path, row
+        count and checksum of every input, plus the output coordinate
+        system the dissolve would run in
+        """
+        import arcpy
+        digest = hashlib.sha1()
+        digest.update('version {}\n'.format(CACHE_VERSION).encode('utf-8'))
+        sr = arcpy.env.outputCoordinateSystem
+        digest.update('sr {}\n'.format(sr.exportToString() if sr else '')
+                      .encode('utf-8'))
+        for path in sorted(split_inputs(fc_list)):
+            count, checksum = self.source_checksum(path)
+            digest.update(u'{}|{}|{}\n'.format(
+                os.path.normcase(os.path.abspath(path)), count,
+                checksum).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entry_fc(self, key):
+        return os.path.join(self.gdb, 'c_' + key[:24])
+
+    def get(self, key):
+        """Returns the cached feature class for key, or None"""
+        import arcpy
+        with self.locked():
+            entry = self.index['entries'].get(key)
+            if entry is None:
+                return None
+            if not arcpy.Exists(entry['fc']):
+                del self.index['entries'][key]
+                return None
+            entry['last_used'] = time.time()
+            return entry['fc']
+
+    def put(self, key, name, dissolved_fc):
+        """Copies a freshly dissolved criterion into the cache - unless
+           another run cached the same key in the meantime"""
+        import arcpy
+        with self.locked():
+            entry = self.index['entries'].get(key)
+            if entry is not None and arcpy.Exists(entry['fc']):
+                entry['last_used'] = time.time()
+                return entry['fc']
+            cache_fc = self._entry_fc(key)
+            before = _folder_size(self.gdb)
+            if arcpy.Exists(cache_fc):
+                arcpy.Delete_management(cache_fc)
+            arcpy.CopyFeatures_management(dissolved_fc, cache_fc)
+            now = time.time()
+            self.index['entries'][key] = {
+                'name': name, 'fc': cache_fc, 'created': now, 'last_used': now,
+                'bytes': max(0, _folder_size(self.gdb) - before)}
+            return cache_fc
+
+    def evict(self, keep=()):
+        """
+        Drops entries not used within max_age_days, then the least recently
+        used until the entries total no more than max_bytes.  Keys in keep
+        (this run's criteria) and entries used within IN_USE_HOURS (by any
+        run) are never dropped.  Returns the evicted keys.
+        """
+        import arcpy
+        with self.locked():
+            entries = self.index['entries']
+            in_use = time.time() - IN_USE_HOURS * 3600
+            keep = set(keep) | set(key for key, entry in entries.items()
+                                   if entry['last_used'] >= in_use)
+            evicted = []
+            if self.max_age_days is not None:
+                oldest = time.time() - self.max_age_days * 86400
+                evicted += [key for key, entry in entries.items()
+                            if entry['last_used'] < oldest and key not in keep]
+            if self.max_bytes is not None:
+                live = sorted((entry['last_used'], key)
+                              for key, entry in entries.items()
+                              if key not in evicted)
+                size = sum(entries[key]['bytes'] for last_used, key in live)
+                for last_used, key in live:
+                    if size <= self.max_bytes:
+                        break
+                    if key in keep:
+                        continue
+                    evicted.append(key)
+                    size -= entries[key]['bytes']
+            for key in evicted:
+                entry = entries.pop(key)
+                if arcpy.Exists(entry['fc']):
+                    arcpy.Delete_management(entry['fc'])
+                self.log('      Evicted cached {}'.format(entry['name']))
+        return evicted
+
+
+def cached_criteria(tasks, cache, dissolve, log=None):
+    """
+    Returns (outputs, keys) - a dictionary of name: dissolved feature class
+    for every (name, fc_list) task and the cache keys of this run, for
+    evict(keep=keys).  Unchanged criteria come from the cache, the rest go
+    to dissolve(tasks) - which returns name: feature class, like
+    use_restrictions_workers.dissolve_criteria - and are cached.
+    """
+    log = log or (lambda message: None)
+    outputs = {}
+    keys = {}
+    misses = []
+    for name, fc_list in tasks:
+        keys[name] = cache.key(fc_list)
+        cached = cache.get(keys[name])
+        if cached:
+            log('      {} unchanged - using the cached dissolve'.format(name))
+            outputs[name] = cached
+        else:
+            misses.append((name, fc_list))
+    if misses:
+        for name, dissolved_fc in dissolve(misses).items():
+            outputs[name] = cache.put(keys[name], name, dissolved_fc)
+    cache.save()
+    return outputs, list(keys.values())
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Topology aware generalization of dissolved criteria before the overlay.
+
+Criteria like wetlands, travel buffers and visual resources carry far more
+vertex detail than acre level reporting needs, and the union and matrix
+slow down with every vertex.  generalize_criteria simplifies the dissolved
+criteria in place under a tolerance (in the units of their spatial
+reference) and reports, per criterion, the vertices removed and the
+acreage it moved:
+
+    report = generalize_criteria([(name, path), ...], 5.0)
+    for line in format_report(report):
+        log(line)
+
+Boundaries shared between criteria - or between rings of one criterion -
+stay shared.  Every vertex is snapped to a fine grid (tolerance / 1000) and
+tagged with the set of criteria that use it.  Rings are cut into chains
+wherever that set changes, each chain is simplified with its end points
+fixed, and a chain that appears in more than one place is simplified once
+and reused, so both sides of a shared edge move together and no slivers
+open between them.  Rings that would collapse are kept as they were, and
+RepairGeometry cleans up any self intersection left behind.
+
+    DOUGLAS_PEUCKER  drops vertices closer than tolerance to the line
+                     through their neighbours
+    VISVALINGAM      drops vertices whose triangle with their neighbours
+                     (effective area) is under tolerance squared
+
+Every criterion is read into memory at once to find the shared vertices -
+run it on the dissolved criteria, not the raw inputs.
+"""
+
+from __future__ import division
+import collections
+import heapq
+import numpy as np
+
+import acreage
+
+
+METHODS = ('DOUGLAS_PEUCKER', 'VISVALINGAM')
+
+# Vertices closer than tolerance / SNAP_DIVISOR are the same vertex
+SNAP_DIVISOR = 1000.0
+
+
+# Functions
+def douglas_peucker(points, tolerance):
+    """Returns the keep mask of an open chain of (N, 2) points - the end
+       points are always kept"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a = points[first]
+        dx, dy = points[last] - a
+        between = points[first + 1:last]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distance = np.hypot(between[:, 0] - a[0], between[:, 1] - a[1])
+        else:
+            distance = np.abs(dx * (between[:, 1] - a[1])
+                              - dy * (between[:, 0] - a[0])) / length
+        i = int(np.argmax(distance))
+        if distance[i] > tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def _triangle(points, i, j, k):
+    (ax, ay), (bx, by), (cx, cy) = points[i], points[j], points[k]
+    return abs((bx - ax) * (cy - ay) - (cx - ax) * (by - ay)) / 2.0
+
+
+def visvalingam(points, tolerance):
+    """Returns the keep mask of an open chain of (N, 2) points, dropping
+       vertices by effective area under tolerance squared"""
+    n = len(points)
+    keep = np.ones(n, dtype=bool)
+    if n < 3:
+        return keep
+    threshold = tolerance ** 2
+    previous = list(range(-1, n - 1))
+    following = list(range(1, n + 1))
+    areas = [None] + [_triangle(points, i - 1, i, i + 1) for i in range(1, n - 1)] + [None]
+    heap = [(areas[i], i) for i in range(1, n - 1)]
+    heapq.heapify(heap)
+    while heap:
+        area, i = heapq.heappop(heap)
+        if not keep[i] or area != areas[i]:
+            continue
+        if area >= threshold:
+            break
+        keep[i] = False
+        before, after = previous[i], following[i]
+        following[before] = after
+        previous[after] = before
+        # Neighbours never drop below the area just removed
+        for j in (before, after):
+            if 0 < j < n - 1:
+                areas[j] = max(area, _triangle(points, previous[j], j, following[j]))
+                heapq.heappush(heap, (areas[j], j))
+    return keep
+
+
+def _popcount(value):
+    return bin(int(value)).count('1')
+
+
+class _SharedVertices(object):
+    """
+    Vertex ids, criteria masks and node flags for every ring of every
+    criterion - rings are closed (N, 2) arrays, indexed in read order
+    """
+
+    def __init__(self, rings, ring_criterion, snap):
+        self.starts = np.zeros(len(rings) + 1, dtype=np.int64)
+        np.cumsum([len(ring) - 1 for ring in rings], out=self.starts[1:])
+        if self.starts[-1] == 0:
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.shared = self.node = np.zeros(0, dtype=bool)
+            return
+        xy = np.concatenate([ring[:-1] for ring in rings])
+        snapped = np.ascontiguousarray(np.round(xy / snap).astype(np.int64))
+        keys = snapped.view(np.dtype((np.void, 16))).ravel()
+        unique, self.ids = np.unique(keys, return_inverse=True)
+        criterion = np.repeat(np.asarray(ring_criterion, dtype=np.int64),
+                              np.diff(self.starts))
+        bits = np.left_shift(np.int64(1), criterion)
+        order = np.argsort(self.ids, kind='mergesort')
+        first = np.flatnonzero(np.concatenate(([True], np.diff(self.ids[order]) != 0)))
+        masks = np.bitwise_or.reduceat(bits[order], first)
+        counts = np.bincount(self.ids)
+        popcounts = dict((mask, _popcount(mask)) for mask in np.unique(masks).tolist())
+        members = np.array([popcounts[mask] for mask in masks.tolist()])
+        self.mask = masks[self.ids]
+        self.shared = members[self.ids] > 1
+        # A vertex used more often than by its criteria touches another ring
+        # of the same criterion
+        self.node = counts[self.ids] > members[self.ids]
+        for r in range(len(rings)):
+            start, end = self.starts[r], self.starts[r + 1]
+            mask = self.mask[start:end]
+            changed = (mask != np.roll(mask, 1)) | (mask != np.roll(mask, -1))
+            self.node[start:end] |= changed
+
+
+class _Simplifier(object):
+    """Simplifies rings chain by chain, reusing the result of shared chains"""
+
+    def __init__(self, method, tolerance):
+        self.simplify = douglas_peucker if method == 'DOUGLAS_PEUCKER' else visvalingam
+        self.tolerance = tolerance
+        self.chains = {}
+
+    def chain(self, points, ids, shared):
+        if len(points) < 3:
+            return np.ones(len(points), dtype=bool)
+        if not shared:
+            return self.simplify(points, self.tolerance)
+        forward = ids.tobytes()
+        backward = ids[::-1].tobytes()
+        if forward <= backward:
+            if forward not in self.chains:
+                self.chains[forward] = self.simplify(points, self.tolerance)
+            return self.chains[forward]
+        if backward not in self.chains:
+            self.chains[backward] = self.simplify(points[::-1], self.tolerance)
+        return self.chains[backward][::-1]
+
+    def ring(self, ring, ids, node, shared):
+        """Returns the simplified closed ring, or the ring itself if it
+           would collapse"""
+        points = ring[:-1]
+        n = len(points)
+        if n < 4:
+            return ring
+        nodes = np.flatnonzero(node)
+        if len(nodes) == 0:
+            # Split a ring with no nodes at its lowest vertex id - the same
+            # vertex whichever criterion the ring belongs to - and the vertex
+            # farthest from it
+            start = int(np.argmin(ids))
+            order = (np.arange(n + 1) + start) % n
+            rotated = points[order[:-1]]
+            far = int(np.argmax(np.hypot(rotated[:, 0] - rotated[0, 0],
+                                         rotated[:, 1] - rotated[0, 1])))
+            cuts = [0, far, n] if 0 < far else [0, n]
+        else:
+            order = (np.arange(n + 1) + nodes[0]) % n
+            cuts = list(nodes - nodes[0]) + [n]
+        keep = np.zeros(n + 1, dtype=bool)
+        for first, last in zip(cuts[:-1], cuts[1:]):
+            span = order[first:last + 1]
+            keep[first:last + 1] |= self.chain(points[span], ids[span],
+                                               bool(shared[span[1:-1]].any())
+                                               if last - first > 1 else False)
+        simplified = points[order[keep]]
+        if len(simplified) < 4:
+            return ring
+        return simplified
+
+
+def _acres(polygons, meters):
+    """Net acres of a list of polygons (lists of rings)"""
+    rings = [ring for rings in polygons for ring in rings]
+    if not rings:
+        return 0.0
+    offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(ring) for ring in rings], out=offsets[1:])
+    area, perimeter = acreage.ring_measures(np.concatenate(rings), offsets)
+    return abs(float(area.sum())) * meters**2 / acreage.AREA_UNITS['ACRES']
+
+
+def generalize_criteria(criteria, tolerance, method='DOUGLAS_PEUCKER', log=None):
+    """
+    Simplifies every (name, feature class) criterion in place under
+    tolerance and returns an OrderedDict of name: {'vertices_before',
+    'vertices_after', 'acres_before', 'acres_after'}
+    """
+    import arcpy
+    log = log or (lambda message: None)
+    if method not in METHODS:
+        raise ValueError("method must be one of {}".format(', '.join(METHODS)))
+    criteria = list(criteria)
+    if len(criteria) > 62:
+        raise ValueError("at most 62 criteria can be generalized together")
+
+    # Read every criterion - the shared vertices need all of them
+    features = []   # (criterion index, oid, polygons)
+    for c, (name, fc) in enumerate(criteria):
+        with arcpy.da.SearchCursor(fc, ['OID@', 'SHAPE@WKB']) as cur:
+            for oid, wkb in cur:
+                if wkb is not None:
+                    features.append((c, oid, acreage.wkb_polygons(wkb)))
+    rings = []
+    ring_criterion = []
+    for c, oid, polygons in features:
+        for ring in (ring for ring_list in polygons for ring in ring_list):
+            rings.append(ring)
+            ring_criterion.append(c)
+    vertices = _SharedVertices(rings, ring_criterion, tolerance / SNAP_DIVISOR)
+    simplifier = _Simplifier(method, tolerance)
+
+    report = collections.OrderedDict(
+        (name, {'vertices_before': 0, 'vertices_after': 0,
+                'acres_before': 0.0, 'acres_after': 0.0}) for name, fc in criteria)
+    results = collections.defaultdict(dict)
+    meters = {}
+    r = 0
+    for c, oid, polygons in features:
+        name, fc = criteria[c]
+        if fc not in meters:
+            meters[fc] = arcpy.Describe(fc).spatialReference.metersPerUnit
+        simplified = []
+        for ring_list in polygons:
+            simplified.append([])
+            for ring in ring_list:
+                start, end = vertices.starts[r], vertices.starts[r + 1]
+                new_ring = simplifier.ring(ring, vertices.ids[start:end],
+                                           vertices.node[start:end],
+                                           vertices.shared[start:end])
+                simplified[-1].append(new_ring)
+                report[name]['vertices_before'] += len(ring)
+                report[name]['vertices_after'] += len(new_ring)
+                r += 1
+        report[name]['acres_before'] += _acres(polygons, meters[fc])
+        report[name]['acres_after'] += _acres(simplified, meters[fc])
+        results[c][oid] = simplified
+
+    # Write back and clean up any self intersections
+    for c, (name, fc) in enumerate(criteria):
+        spatial_reference = arcpy.Describe(fc).spatialReference
+        with arcpy.da.UpdateCursor(fc, ['OID@', 'SHAPE@']) as cur:
+            for oid, shape in cur:
+                if oid in results[c]:
+                    cur.updateRow([oid, arcpy.FromWKB(
+                        bytearray(acreage.polygons_wkb(results[c][oid])), spatial_reference)])
+        arcpy.RepairGeometry_management(fc)
+        log('      Generalized {} - {} of {} vertices removed'.format(
+            name, report[name]['vertices_before'] - report[name]['vertices_after'],
+            report[name]['vertices_before']))
+    return report
+
+
+def format_report(report):
+    """Returns the vertices removed and acreage moved per criterion as
+       printable lines"""
+    lines = ['{:<28} {:>12} {:>12} {:>8} {:>14}'.format(
+        'Criterion', 'Vertices', 'Removed', 'Percent', 'Acre delta')]
+    for name, row in report.items():
+        removed = row['vertices_before'] - row['vertices_after']
+        lines.append('{:<28} {:>12} {:>12} {:>7.1f}% {:>14.2f}'.format(
+            name[:28], row['vertices_before'], removed,
+            100 * removed / row['vertices_before'] if row['vertices_before'] else 0.0,
+            row['acres_after'] - row['acres_before']))
+    return lines
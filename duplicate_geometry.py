@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Duplicate polygon removal by geometry hash - replaces DeleteIdentical.
+
+DeleteIdentical_management on SHAPE sorts the whole feature class and
+routinely fails on the multi-million part aggregate unions (the tools used
+to shrug - "This will usually fail - it's ok"), letting identical slivers
+through to double count acres.  delete_duplicates makes one streaming
+cursor pass instead, keeping a 20 byte digest per distinct geometry and
+deleting every later feature whose digest has been seen:
+
+    report = delete_duplicates(fc, merge_fields=lineage.values())
+    for line in format_report(report):
+        log(line)
+
+The digest is a SHA-1 of the geometry's rings in a canonical form -
+coordinates snapped to a tolerance grid (the XY tolerance of the spatial
+reference by default), repeated vertices dropped, every ring started at its
+lowest vertex and walked in one direction, and the rings sorted - so the
+same polygon digitized from a different start vertex, wound the other way
+or with its rings in another order, or off by less than the tolerance, is
+still a duplicate.  Near duplicates that straddle a grid line are missed,
+never merged wrongly.
+
+The first feature of each geometry is kept.  merge_fields (union lineage
+FID_ fields) of the deleted duplicates are carried over to it wherever its
+own value is null or -1, so no criterion membership is lost with the row.
+"""
+
+from __future__ import division
+import hashlib
+import numpy as np
+
+import acreage
+
+
+# Snap grid when the spatial reference has no XY tolerance
+DEFAULT_TOLERANCE = 0.001
+
+
+# Functions
+def ring_key(ring, snap):
+    """Returns the canonical bytes of one ring - snapped, without repeated
+       vertices, from its lowest vertex, in its lower direction"""
+    points = np.round(np.asarray(ring, dtype=np.float64) / snap).astype(np.int64)
+    changed = np.any(points != np.roll(points, 1, axis=0), axis=1)
+    if not changed.any():
+        return points[:1].tobytes()
+    points = points[changed]
+    start = int(np.lexsort((points[:, 1], points[:, 0]))[0])
+    points = np.roll(points, -start, axis=0)
+    if len(points) > 2 and tuple(points[-1]) < tuple(points[1]):
+        points = np.concatenate([points[:1], points[:0:-1]])
+    return np.ascontiguousarray(points).tobytes()
+
+
+def geometry_key(wkb, snap):
+    """Returns the digest of a polygon WKB, or None for a null shape"""
+    if wkb is None:
+        return None
+    rings = sorted(ring_key(ring, snap) for ring in acreage.wkb_rings(wkb))
+    digest = hashlib.sha1()
+    for ring in rings:
+        digest.update(str(len(ring)).encode('ascii') + b':')
+        digest.update(ring)
+    return digest.digest()
+
+
+def _missing(value):
+    return value is None or value == -1
+
+
+def delete_duplicates(in_fc, tolerance=None, merge_fields=(), log=None):
+    """
+    Deletes every feature of in_fc (a feature class or layer) whose
+    geometry matches an earlier one and returns {'features', 'removed'
+    [(deleted oid, kept oid), ...], 'acres'} - acres removed, None for
+    geographic coordinates
+    """
+    import arcpy
+    log = log or (lambda message: None)
+    spatial_reference = arcpy.Describe(in_fc).spatialReference
+    if not tolerance:
+        tolerance = getattr(spatial_reference, 'XYTolerance', None) or DEFAULT_TOLERANCE
+    merge_fields = list(merge_fields)
+    projected = spatial_reference.type != 'Geographic'
+
+    seen = {}
+    merges = {}
+    removed = []
+    removed_area = 0.0
+    features = 0
+    with arcpy.da.UpdateCursor(in_fc, ['OID@', 'SHAPE@WKB'] + merge_fields) as cur:
+        for row in cur:
+            features += 1
+            key = geometry_key(row[1], tolerance)
+            if key is None:
+                continue
+            kept = seen.get(key)
+            if kept is None:
+                seen[key] = row[0]
+                continue
+            if merge_fields:
+                values = merges.setdefault(kept, [None] * len(merge_fields))
+                for i, value in enumerate(row[2:]):
+                    if _missing(values[i]) and not _missing(value):
+                        values[i] = value
+            if projected:
+                rings = acreage.wkb_rings(row[1])
+                offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+                np.cumsum([len(ring) for ring in rings], out=offsets[1:])
+                area, perimeter = acreage.ring_measures(np.concatenate(rings), offsets)
+                removed_area += abs(float(area.sum()))
+            removed.append((row[0], kept))
+            cur.deleteRow()
+
+    # Carry the lineage of the deleted duplicates over to the kept features
+    if merges:
+        with arcpy.da.UpdateCursor(in_fc, ['OID@'] + merge_fields) as cur:
+            for row in cur:
+                values = merges.get(row[0])
+                if values is None:
+                    continue
+                cur.updateRow([row[0]] + [merged if _missing(value) else value
+                                          for value, merged in zip(row[1:], values)])
+
+    acres = None
+    if projected:
+        acres = removed_area * spatial_reference.metersPerUnit**2 / acreage.AREA_UNITS['ACRES']
+    log('      Removed {} duplicate geometries of {}'.format(len(removed), features))
+    return {'features': features, 'removed': removed, 'acres': acres}
+
+
+def format_report(report, limit=20):
+    """Returns the removal count, acres and the first limit deleted/kept
+       OID pairs as printable lines"""
+    lines = ['Duplicate geometries removed: {} of {} features{}'.format(
+        len(report['removed']), report['features'],
+        '' if report['acres'] is None else ' ({:.4f} acres)'.format(report['acres']))]
+    for deleted, kept in report['removed'][:limit]:
+        lines.append('    OID {} duplicated OID {}'.format(deleted, kept))
+    if len(report['removed']) > limit:
+        lines.append('    ... and {} more'.format(len(report['removed']) - limit))
+    return lines
@@ -18,6 +18,8 @@ from matplotlib.path import Path
 import pandas as pd
 import math
 
+from geometry_tools import CoordSeq, minRect
+
 
 # Constants
 degToRad = math.pi/180.0
@@ -82,17 +84,15 @@ def polyAngles(pnts):
     Requires:  a list of points forming a polygon
     Returns:   a list containing from pnt, to pnt, anAngle, aDistance
     """
-    pnts2 = pnts[:]
-    if pnts2[0] != pnts2[-1]:
-        N = len(pnts2)
-        # Add the first point to the list
-        pnts2.append(pnts2[0])
+    if tuple(pnts[0]) != tuple(pnts[-1]):
+        # Wrap back to the first point
+        N = len(pnts)
     else:
-        N = len(pnts2) - 1
+        N = len(pnts) - 1
     angleList = []  
-    for i in range(1, len(pnts2)):
-        pnt1 = pnts2[i-1];  pnt2 = pnts2[i]
-        if pnt1 != pnt2:
+    for i in range(1, N + 1):
+        pnt1 = pnts[i-1];  pnt2 = pnts[i % len(pnts)]
+        if tuple(pnt1) != tuple(pnt2):
             theAngle = p1p2Angle(pnt1, pnt2)
             theDist = p1p2Dist(pnt1, pnt2)
         if i < N:
@@ -111,7 +111,7 @@ def transRotatePnts(pnts, pntCent, angle):
    
     X0 = pntCent[0]; Y0 = pntCent[1]
     # Check for a duplicate closure point
-    if pnts[0] != pnts[-1]:
+    if tuple(pnts[0]) != tuple(pnts[-1]):
         N = len(pnts)
     else:
         N = len(pnts)-1
@@ -119,6 +119,17 @@ def transRotatePnts(pnts, pntCent, angle):
     angle = angle*(-1.0) #reverse the rotation
     cosXY = math.cos(degToRad * angle) 
     sinXY = math.sin(degToRad * angle)
+    if isinstance(pnts, CoordSeq):
+        # Fill one new buffer - no per point lists
+        rotPnts = CoordSeq.empty(N)
+        src = pnts.buf; dst = rotPnts.buf
+        k = 2*pnts.start
+        for j in range(0, 2*N, 2):
+            X1 = src[k] - X0; Y1 = src[k+1] - Y0
+            dst[j] = (X1 * cosXY) - (Y1 *sinXY)
+            dst[j+1] = (X1 * sinXY) + (Y1 *cosXY)
+            k += 2
+        return rotPnts
     rotPnts = []
     for j in range(0, N):
         X1 = pnts[j][0] - X0; Y1 = pnts[j][1] - Y0
@@ -130,46 +141,6 @@ def transRotatePnts(pnts, pntCent, angle):
     return rotPnts
   
   
-def minRect(pnts):
-    """
-    Determines the minimum area rectangle for a shape represented
-    by a list of points
-    """
-    areaDict = {}
-    angleList = polyAngles(pnts)  #determine the angles
-    pntCent = extentCenter(pnts)  #determine center of the extent
-    xCent = pntCent[0]; yCent = pntCent[1]
-    for angle in angleList:
-        rotPnts = transRotatePnts(pnts, pntCent, angle[2])  #slice the angle
-        Xs = []; Ys = []
-        for pnt in rotPnts:
-            Xs.append(pnt[0]); Ys.append(pnt[1])
-        #Determine the area of the rotated hull
-        Xmin = min(Xs); Xmax = max(Xs); Ymin = min(Ys); Ymax = max(Ys)
-        area = (max(Xs) - min(Xs))*(max(Ys) - min(Ys))
-        areaDict.update({area:[pntCent, Xmin, Xmax, Ymin, Ymax,angle[2]]})
-    #Get the minimum rectangle centred about the origin
-    #Rotate the rectangle back
-    minArea = min(areaDict.keys())
-    a = areaDict.get(minArea)
-    Xmin = a[1];  Xmax = a[2]
-    Ymin = a[3];  Ymax = a[4]
-    angle = a[5] * (-1.0)
-    rectPnts = [[Xmin,Ymin], [Xmin,Ymax], [Xmax,Ymax], [Xmax,Ymin]]
-    originPnt = [0.0,0.0]
-    rotPnts = transRotatePnts(rectPnts, originPnt, angle)
-    outList = []
-    xyPnts = []
-    for pnt in rotPnts:
-        XY = [pnt[0] + xCent, pnt[1] + yCent]
-        xyPnts.append(XY)
-    dx = Xmax - Xmin       
-    dy = Ymax - Ymin
-    outList = [xyPnts, angle, dx, dy]
-    #return the points
-    return outList
-
-  
 ###---------------------------------------------------------------------------
 
         
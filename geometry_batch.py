@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+Batched NumPy versions of the geometry_tools bounding containers.
+
+Polygons are passed as ragged coordinate arrays - a flat float64 XY buffer
+of shape (M, 2) holding every vertex of every polygon back to back, and an
+offsets array of length N+1 so that polygon i is xy[offsets[i]:offsets[i+1]].
+Every result is a column (one value per polygon) and is computed across all
+the polygons at once - there are no per-vertex or per-polygon Python loops.
+
+    extentPnts    -> xmin, ymin, xmax, ymax
+    extentCenter  -> xcent, ycent
+    pntAvgXY      -> xavg, yavg
+    minRect       -> mbr (N, 4, 2), angle, dx, dy
+    circleMake    -> batch_ngons
+"""
+
+from __future__ import division
+import collections
+import numpy as np
+
+import geometry_tools as gt
+
+
+# Unit circle vertex tables by vertex count, least recently used first
+_ngon_cache = collections.OrderedDict()
+NGON_CACHE_SIZE = gt.ngonCacheSize
+
+
+# Functions
+def ragged_from_lists(polys):
+    """Returns (xy, offsets) for a list of polygons, each a list of [x, y]"""
+    counts = np.array([len(poly) for poly in polys], dtype=np.int64)
+    offsets = np.zeros(len(polys) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.zeros((0, 2), dtype=np.float64), offsets
+    xy = np.concatenate([np.asarray(poly, dtype=np.float64).reshape(-1, 2)
+                         for poly in polys if len(poly)])
+    return xy, offsets
+
+
+def offsets_from_ids(ids):
+    """
+    Returns (unique ids, offsets) for a vertex id column where the vertices
+    of each feature are contiguous, e.g. the OID@ column from
+    arcpy.da.FeatureClassToNumPyArray(..., explode_to_points=True)
+    """
+    ids = np.asarray(ids)
+    if len(ids) == 0:
+        return ids, np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    offsets = np.append(starts, len(ids)).astype(np.int64)
+    return ids[starts], offsets
+
+
+def _check_ragged(xy, offsets):
+    """Validates and normalizes the ragged arrays"""
+    xy = np.ascontiguousarray(xy, dtype=np.float64).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if offsets.ndim != 1 or len(offsets) < 1:
+        raise ValueError("offsets must be a 1-d array of length N+1")
+    if offsets[0] != 0 or offsets[-1] != len(xy):
+        raise ValueError("offsets must start at 0 and end at len(xy)")
+    if np.any(np.diff(offsets) < 1):
+        raise ValueError("every polygon needs at least one vertex")
+    return xy, offsets
+
+
+def batch_extents(xy, offsets):
+    """
+    Returns a dict of columns xmin, ymin, xmax, ymax, xcent, ycent (the
+    extent center) and xavg, yavg (the vertex average) for N polygons
+    """
+    xy, offsets = _check_ragged(xy, offsets)
+    if len(offsets) == 1:
+        return dict((key, np.zeros(0)) for key in
+                    ('xmin', 'ymin', 'xmax', 'ymax', 'xcent', 'ycent',
+                     'xavg', 'yavg'))
+    starts = offsets[:-1]
+    counts = np.diff(offsets)
+    xmin = np.minimum.reduceat(xy[:, 0], starts)
+    xmax = np.maximum.reduceat(xy[:, 0], starts)
+    ymin = np.minimum.reduceat(xy[:, 1], starts)
+    ymax = np.maximum.reduceat(xy[:, 1], starts)
+    # Sum relative to the first vertex to limit round off on big coordinates
+    first = xy[starts]
+    local = xy - np.repeat(first, counts, axis=0)
+    xavg = first[:, 0] + np.add.reduceat(local[:, 0], starts) / counts
+    yavg = first[:, 1] + np.add.reduceat(local[:, 1], starts) / counts
+    return {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax,
+            'xcent': (xmax - xmin) / 2.0 + xmin,
+            'ycent': (ymax - ymin) / 2.0 + ymin,
+            'xavg': xavg, 'yavg': yavg}
+
+
+def _cross(ax, ay, bx, by, px, py):
+    """Cross product of (b - a) and (p - a) - negative when p is right of a->b"""
+    return (bx - ax) * (py - ay) - (by - ay) * (px - ax)
+
+
+def _group_argmin(values, starts, group):
+    """
+    Returns the index of the first smallest value in each contiguous group,
+    where starts holds the first index of every (non-empty) group and group
+    the group number of every value
+    """
+    low = np.minimum.reduceat(values, starts)
+    hits = np.flatnonzero(values == low[group])
+    first = np.concatenate(([True], group[hits][1:] != group[hits][:-1]))
+    return hits[first]
+
+
+def batch_convex_hulls(xy, offsets):
+    """
+    Returns (hull_xy, hull_offsets) - the convex hull of each polygon as
+    ragged arrays in counter-clockwise order, starting at the lowest-left
+    vertex, without a closing point. Duplicate and collinear points are
+    dropped so degenerate polygons return 1 (a point) or 2 (a line) vertices.
+
+    Quickhull, run on every polygon at once: each pass finds the farthest
+    outside point of every open chord and splits it in two, so the Python
+    loop runs once per level of the hull recursion, not once per vertex.
+    """
+    xy, offsets = _check_ragged(xy, offsets)
+    npoly = len(offsets) - 1
+    if npoly == 0:
+        return xy, offsets
+    starts = offsets[:-1]
+    counts = np.diff(offsets)
+    pid = np.repeat(np.arange(npoly), counts)
+
+    # Work relative to the first vertex of each polygon
+    origin = xy[starts]
+    px = xy[:, 0] - origin[pid, 0]
+    py = xy[:, 1] - origin[pid, 1]
+
+    # Lowest-left and highest-right points - the first and last in x, y order
+    left = px == np.minimum.reduceat(px, starts)[pid]
+    a_idx = _group_argmin(np.where(left, py, np.inf), starts, pid)
+    right = px == np.maximum.reduceat(px, starts)[pid]
+    b_idx = _group_argmin(np.where(right, -py, np.inf), starts, pid)
+    single = (px[a_idx] == px[b_idx]) & (py[a_idx] == py[b_idx])
+
+    # Directed chords of the ccw hull - the outside points are on the right.
+    # Chord 2i runs a->b under polygon i, chord 2i+1 runs b->a over it
+    seg_a = np.column_stack((a_idx, b_idx)).ravel()
+    seg_b = np.column_stack((b_idx, a_idx)).ravel()
+    seg_poly = np.repeat(np.arange(npoly), 2)
+
+    # Assign every point to the chord it is outside of (if any)
+    lower = 2 * pid
+    c1 = _cross(px[a_idx][pid], py[a_idx][pid],
+                px[b_idx][pid], py[b_idx][pid], px, py)
+    pnt_seg = np.where(c1 < 0, lower, lower + 1)
+    dist = np.where(c1 < 0, c1, -c1)
+    pts = np.flatnonzero((dist < 0) & ~single[pid])
+    pnt_seg, dist = pnt_seg[pts], dist[pts]
+
+    closed = np.ones(len(seg_a), dtype=bool)
+    closed[pnt_seg] = False
+    closed[np.repeat(single, 2) & (np.arange(len(seg_a)) % 2 == 1)] = False
+    done_a = [seg_a[closed]]
+    done_poly = [seg_poly[closed]]
+    while len(pts):
+        # Keep the points grouped by chord - the ids are nearly sorted
+        order = np.argsort(pnt_seg, kind='mergesort')
+        pts, pnt_seg, dist = pts[order], pnt_seg[order], dist[order]
+        first = np.flatnonzero(np.concatenate(([True],
+                                               pnt_seg[1:] != pnt_seg[:-1])))
+        rank = np.cumsum(np.concatenate(([False],
+                                         pnt_seg[1:] != pnt_seg[:-1])))
+        # Farthest outside point of every open chord
+        open_seg = pnt_seg[first]
+        far = pts[_group_argmin(dist, first, rank)]
+
+        # Split each open chord a->b into a->far (2r) and far->b (2r+1)
+        nopen = len(open_seg)
+        new_a = np.column_stack((seg_a[open_seg], far)).ravel()
+        new_b = np.column_stack((far, seg_b[open_seg])).ravel()
+        new_poly = np.repeat(seg_poly[open_seg], 2)
+
+        s1 = 2 * rank
+        s2 = s1 + 1
+        c1 = _cross(px[new_a[s1]], py[new_a[s1]],
+                    px[new_b[s1]], py[new_b[s1]], px[pts], py[pts])
+        c2 = _cross(px[new_a[s2]], py[new_a[s2]],
+                    px[new_b[s2]], py[new_b[s2]], px[pts], py[pts])
+        pnt_seg = np.where(c1 < 0, s1, s2)
+        dist = np.where(c1 < 0, c1, c2)
+        outside = dist < 0
+        pts, pnt_seg, dist = pts[outside], pnt_seg[outside], dist[outside]
+
+        closed = np.ones(2 * nopen, dtype=bool)
+        closed[pnt_seg] = False
+        done_a.append(new_a[closed])
+        done_poly.append(new_poly[closed])
+        seg_a, seg_b, seg_poly = new_a, new_b, new_poly
+
+    # The hull vertices are the chord starts
+    hull_pts = np.concatenate(done_a)
+    hull_poly = np.concatenate(done_poly)
+
+    # Order each hull ccw around its vertex average, starting at a_idx
+    hcounts = np.bincount(hull_poly, minlength=npoly)
+    hx = px[hull_pts]
+    hy = py[hull_pts]
+    mx = np.bincount(hull_poly, weights=hx, minlength=npoly) / hcounts
+    my = np.bincount(hull_poly, weights=hy, minlength=npoly) / hcounts
+    theta = np.arctan2(hy - my[hull_poly], hx - mx[hull_poly])
+    start = np.arctan2(py[a_idx] - my, px[a_idx] - mx)
+    theta = np.mod(theta - start[hull_poly], 2 * np.pi)
+    theta[hull_pts == a_idx[hull_poly]] = -1.0
+    order = np.argsort(theta)
+    order = order[np.argsort(hull_poly[order], kind='mergesort')]
+    hull_pts = hull_pts[order]
+    hull_offsets = np.zeros(npoly + 1, dtype=np.int64)
+    np.cumsum(hcounts, out=hull_offsets[1:])
+    return xy[hull_pts], hull_offsets
+
+
+def batch_min_rect(xy, offsets, hulls=None, measure='area'):
+    """
+    Returns a dict of columns mbr (N, 4, 2 corners), angle, dx, dy - the
+    minimum area rectangle of every polygon, matching geometry_tools.minRect.
+    measure='width' or 'perimeter' picks the rectangles of geometry_tools
+    minWidthRect and minPerimRect instead (dy is the width).
+    Pass hulls=(hull_xy, hull_offsets) to reuse batch_convex_hulls output.
+
+    The caliper support points for every hull edge are found with one
+    searchsorted over the edge angles rather than by walking the hull.
+    Clockwise polygons are measured along their hull edges run clockwise
+    and ties are settled as geometry_tools.pickRect does, so both give
+    the same angle, dx and dy.
+    """
+    xy, offsets = _check_ragged(xy, offsets)
+    if hulls is None:
+        hulls = batch_convex_hulls(xy, offsets)
+    hxy, hoff = hulls
+    npoly = len(hoff) - 1
+    if npoly == 0:
+        return {'mbr': np.zeros((0, 4, 2)), 'angle': np.zeros(0),
+                'dx': np.zeros(0), 'dy': np.zeros(0)}
+    hcounts = np.diff(hoff)
+    hpoly = np.repeat(np.arange(npoly), hcounts)
+    nedge = len(hxy)
+
+    # Edges k -> k+1 wrapping within each hull
+    pos = np.arange(nedge) - hoff[hpoly]
+    nxt = hoff[hpoly] + (pos + 1) % hcounts[hpoly]
+    origin = hxy[hoff[:-1]]
+    hx = hxy[:, 0] - origin[hpoly, 0]
+    hy = hxy[:, 1] - origin[hpoly, 1]
+    ex = hx[nxt] - hx
+    ey = hy[nxt] - hy
+    elen = np.hypot(ex, ey)
+    elen[elen == 0] = 1.0
+    ux = ex / elen
+    uy = ey / elen
+    phi = np.arctan2(ey, ex)
+
+    # Ccw edge angles increase around a hull - make them 0 <= psi < 2pi
+    psi = np.mod(phi - phi[hoff[:-1]][hpoly], 2 * np.pi)
+    psi[hoff[:-1][hcounts > 0]] = 0.0
+    span = 8.0
+    key = hpoly * span + psi
+
+    def support(turn):
+        """The hull vertex farthest in the direction psi + turn - 90"""
+        target = hpoly * span + np.mod(psi + turn, 2 * np.pi)
+        k = np.searchsorted(key, target, side='left')
+        return np.where(k >= hoff[hpoly + 1], hoff[hpoly], k)
+
+    quarter = np.pi / 2.0
+    right = support(quarter)
+    top = support(2 * quarter)
+    left = support(3 * quarter)
+
+    xmin = (hx[left] - hx) * ux + (hy[left] - hy) * uy
+    xmax = (hx[right] - hx) * ux + (hy[right] - hy) * uy
+    ymin = np.zeros(nedge)
+    ymax = (hy[top] - hy) * ux - (hx[top] - hx) * uy
+    if measure == 'area':
+        value = (xmax - xmin) * ymax
+    elif measure == 'width':
+        value = ymax
+    elif measure == 'perimeter':
+        value = (xmax - xmin) + ymax
+    else:
+        raise ValueError("measure must be 'area', 'width' or 'perimeter'")
+
+    # Clockwise polygons (ArcGIS outer rings) - measure along the hull
+    # edges run the other way, as geometry_tools.reverseRect
+    edge_angle = np.degrees(phi)
+    cw = (batch_hull_area((xy, offsets))[0] < 0)[hpoly]
+    edge_angle[cw] += 180.0
+    edge_angle[cw & (edge_angle > 180.0)] -= 360.0
+    xmin, xmax = np.where(cw, -xmax, xmin), np.where(cw, -xmin, xmax)
+    ymin, ymax = np.where(cw, -ymax, ymin), np.where(cw, -ymin, ymax)
+    ux = np.where(cw, -ux, ux)
+    uy = np.where(cw, -uy, uy)
+    angle = -edge_angle
+
+    # Smallest rectangle of each hull and, within the gt.rectTolerance of
+    # the hull size, the smallest absolute angle, positive first - as
+    # gt.pickRect
+    starts = hoff[:-1]
+    size = np.hypot(
+        np.maximum.reduceat(hx, starts) - np.minimum.reduceat(hx, starts),
+        np.maximum.reduceat(hy, starts) - np.minimum.reduceat(hy, starts))
+    tol = gt.rectTieTol * size**(2 if measure == 'area' else 1)
+    low = np.minimum.reduceat(value, starts)[hpoly]
+    tie = value <= low + tol[hpoly]
+    least = np.minimum.reduceat(np.where(tie, np.abs(angle), np.inf),
+                                starts)[hpoly]
+    tie &= np.abs(angle) <= least + gt.angleTieTol
+    best = _group_argmin(np.where(tie, -angle, np.inf), starts, hpoly)
+
+    dx = xmax[best] - xmin[best]
+    dy = ymax[best] - ymin[best]
+    bx, by = ux[best], uy[best]
+    X = np.column_stack((xmin[best], xmin[best], xmax[best], xmax[best]))
+    Y = np.column_stack((ymin[best], ymax[best], ymax[best], ymin[best]))
+    cx = (hx[best] + origin[:, 0])[:, None]
+    cy = (hy[best] + origin[:, 1])[:, None]
+    mbr = np.empty((npoly, 4, 2), dtype=np.float64)
+    mbr[:, :, 0] = cx + X * bx[:, None] - Y * by[:, None]
+    mbr[:, :, 1] = cy + X * by[:, None] + Y * bx[:, None]
+    angle = angle[best]
+
+    # Points and lines - the rectangle collapses onto the hull
+    flat = hcounts < 3
+    if np.any(flat):
+        a = hoff[:-1][flat]
+        b = np.where(hcounts[flat] == 2, a + 1, a)
+        fdx = hxy[b, 0] - hxy[a, 0]
+        fdy = hxy[b, 1] - hxy[a, 1]
+        angle[flat] = -np.degrees(np.arctan2(fdy, fdx))
+        dx[flat] = np.hypot(fdx, fdy)
+        dy[flat] = 0.0
+        mbr[flat, 0] = hxy[a]
+        mbr[flat, 1] = hxy[a]
+        mbr[flat, 2] = hxy[b]
+        mbr[flat, 3] = hxy[b]
+    return {'mbr': mbr, 'angle': angle, 'dx': dx, 'dy': dy}
+
+
+def batch_hull_area(hulls):
+    """
+    Returns the signed (shoelace) area and perimeter columns of ragged
+    rings - batch_convex_hulls output, or the polygons themselves
+    """
+    hxy, hoff = hulls
+    npoly = len(hoff) - 1
+    hcounts = np.diff(hoff)
+    hpoly = np.repeat(np.arange(npoly), hcounts)
+    nxt = hoff[hpoly] + (np.arange(len(hxy)) - hoff[hpoly] + 1) % hcounts[hpoly]
+    origin = hxy[hoff[:-1]][hpoly]
+    x1 = hxy[:, 0] - origin[:, 0]
+    y1 = hxy[:, 1] - origin[:, 1]
+    x2 = x1[nxt]
+    y2 = y1[nxt]
+    area = np.bincount(hpoly, weights=x1 * y2 - x2 * y1, minlength=npoly) / 2.0
+    perimeter = np.bincount(hpoly, weights=np.hypot(x2 - x1, y2 - y1),
+                            minlength=npoly)
+    return area, perimeter
+
+
+def batch_bounding_containers(xy, offsets):
+    """
+    Returns every column of batch_extents and batch_min_rect for N
+    polygons plus min_width and the hull_area and hull_perimeter - the
+    long-axis metrics of a whole layer in one call, from one set of hulls
+    """
+    xy, offsets = _check_ragged(xy, offsets)
+    result = batch_extents(xy, offsets)
+    hulls = batch_convex_hulls(xy, offsets)
+    result.update(batch_min_rect(xy, offsets, hulls))
+    result['min_width'] = batch_min_rect(xy, offsets, hulls, 'width')['dy']
+    result['hull_area'], result['hull_perimeter'] = batch_hull_area(hulls)
+    return result
+
+
+def unit_ngon(n):
+    """
+    Returns the (n, 2) read-only vertices of a unit N-gon starting at
+    (1, 0) and running counter-clockwise. The trig tables are cached per
+    vertex count (least recently used tables are dropped first)
+    """
+    n = int(n)
+    if n < 3:
+        raise ValueError("an N-gon needs at least 3 vertices")
+    try:
+        table = _ngon_cache.pop(n)
+    except KeyError:
+        theta = np.arange(n) * (2.0 * np.pi / n)
+        table = np.column_stack((np.cos(theta), np.sin(theta)))
+        table.flags.writeable = False
+        while len(_ngon_cache) >= NGON_CACHE_SIZE:
+            _ngon_cache.popitem(last=False)
+    _ngon_cache[n] = table
+    return table
+
+
+def ngon_counts(radii, tolerance, min_vertices=8, max_vertices=4096):
+    """
+    Returns the vertex count for each radius so that no chord strays more
+    than tolerance (map units) from the true circle, r * (1 - cos(pi / n))
+    """
+    radii = np.atleast_1d(np.asarray(radii, dtype=np.float64))
+    if tolerance <= 0:
+        raise ValueError("tolerance must be positive")
+    ratio = np.clip(1.0 - tolerance / np.maximum(radii, tolerance), -1.0, 1.0)
+    with np.errstate(divide='ignore'):
+        counts = np.ceil(np.pi / np.arccos(ratio))
+    counts[~np.isfinite(counts)] = max_vertices
+    return np.clip(counts, min_vertices, max_vertices).astype(np.int64)
+
+
+def batch_ngons(centers, radii, n=360, tolerance=None, closed=False,
+                min_vertices=8, max_vertices=4096):
+    """
+    Returns (xy, offsets) - ragged arrays of N-gons, one per center, ready
+    for the batch functions above. n fixes the vertex count (360 matches
+    circleMake - reshape xy to (N, n, 2) for a dense block); a tolerance
+    in map units picks each count from ngon_counts instead. closed=True
+    repeats the first vertex at the end of each ring.
+
+    The work is grouped by vertex count, so it loops over the distinct
+    counts, never over the centers.
+    """
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    radii = np.asarray(radii, dtype=np.float64) * np.ones(len(centers))
+    if tolerance is None:
+        counts = np.full(len(centers), int(n), dtype=np.int64)
+    else:
+        counts = ngon_counts(radii, tolerance, min_vertices, max_vertices)
+    sizes = counts + (1 if closed else 0)
+    offsets = np.zeros(len(centers) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    xy = np.empty((offsets[-1], 2), dtype=np.float64)
+    for count in np.unique(counts):
+        idx = np.flatnonzero(counts == count)
+        table = unit_ngon(count)
+        if closed:
+            table = np.vstack((table, table[:1]))
+        block = (centers[idx, None, :] +
+                 radii[idx, None, None] * table[None, :, :])
+        rows = offsets[idx][:, None] + np.arange(len(table))[None, :]
+        xy[rows.ravel()] = block.reshape(-1, 2)
+    return xy, offsets
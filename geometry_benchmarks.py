@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the geometry_tools kernels used by the site record tools.
+
+Seeded generators build convex, concave, densified and degenerate polygons
+from 10 to 1,000,000 vertices, each kernel is timed across those sizes and
+the results are written as a JSON baseline that later runs compare against.
+
+    python geometry_benchmarks.py --save baseline.json
+    python geometry_benchmarks.py --compare baseline.json
+
+Every timing is the best of several repeats (seconds per call).  Peak memory
+is the tracemalloc peak of one call where tracemalloc exists (Python 3).
+On Python 2.7, where the tools run, it is how far one call in a child
+process raises the peak resident memory above where it started - it
+counts what the interpreter keeps as well as what the kernel allocates.
+The scaling exponent is the least squares slope of log(time) against
+log(vertices) - about 1.0 is linear, 2.0 quadratic.
+A comparison exits with status 1 when any kernel is slower than the
+baseline by more than the threshold ratio.
+"""
+
+from __future__ import division, print_function
+import argparse
+import json
+import math
+import multiprocessing
+import platform
+import random
+import sys
+import timeit
+
+import geometry_tools as gt
+import mp_setup
+import pipeline_profile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+SIZES = (10, 100, 1000, 10000, 100000, 1000000)
+SHAPES = ('convex', 'concave', 'densified', 'degenerate')
+KERNELS = ('minRect', 'polyAngles', 'transRotatePnts', 'extentPnts',
+           'p1p2Azimuth')
+
+# Polygons sit in UTM-sized coordinates like the site records
+X0, Y0 = 500000.0, 4400000.0
+RADIUS = 250.0
+
+# Minimum wall time per repeat, calls are batched until it is reached
+MIN_TIME = 0.05
+
+
+# Generators
+def convex_polygon(n, seed=0):
+    """Returns n points on an ellipse at random angles - every point is
+       a hull vertex"""
+    rnd = random.Random(seed)
+    angles = sorted(rnd.uniform(0.0, 2.0*math.pi) for i in range(n))
+    a, b = RADIUS, RADIUS*rnd.uniform(0.3, 1.0)
+    rot = rnd.uniform(0.0, math.pi)
+    cos_r, sin_r = math.cos(rot), math.sin(rot)
+    pnts = []
+    for t in angles:
+        x, y = a*math.cos(t), b*math.sin(t)
+        pnts.append([X0 + x*cos_r - y*sin_r, Y0 + x*sin_r + y*cos_r])
+    return pnts
+
+
+def concave_polygon(n, seed=0):
+    """Returns a simple star shaped polygon of n points - evenly spaced
+       angles with random radii, so most points are inside the hull"""
+    rnd = random.Random(seed)
+    step = 2.0*math.pi/n
+    pnts = []
+    for i in range(n):
+        r = RADIUS*rnd.uniform(0.2, 1.0)
+        pnts.append([X0 + r*math.cos(i*step), Y0 + r*math.sin(i*step)])
+    return pnts
+
+
+def densified_polygon(n, seed=0):
+    """Returns a rotated rectangle densified to n points along its edges,
+       the way a digitized or buffered outline carries many collinear
+       vertices"""
+    rnd = random.Random(seed)
+    w, h = RADIUS, RADIUS*rnd.uniform(0.2, 1.0)
+    rot = rnd.uniform(0.0, math.pi)
+    cos_r, sin_r = math.cos(rot), math.sin(rot)
+    corners = [(-w, -h), (w, -h), (w, h), (-w, h)]
+    per_edge = max(1, n // 4)
+    pnts = []
+    for i in range(4):
+        (x1, y1), (x2, y2) = corners[i], corners[(i + 1) % 4]
+        count = per_edge if i < 3 else max(1, n - 3*per_edge)
+        for j in range(count):
+            f = j/count
+            x, y = x1 + (x2 - x1)*f, y1 + (y2 - y1)*f
+            pnts.append([X0 + x*cos_r - y*sin_r, Y0 + x*sin_r + y*cos_r])
+    return pnts[:n]
+
+
+def degenerate_polygon(n, seed=0):
+    """Returns n points that collapse - repeated vertices along a single
+       line with a closing point, the slivers and zero area parts that
+       turn up in real data"""
+    rnd = random.Random(seed)
+    azimuth = rnd.uniform(0.0, math.pi)
+    dx, dy = math.cos(azimuth), math.sin(azimuth)
+    pnts = []
+    for i in range(max(1, n - 1)):
+        d = RADIUS*round(rnd.uniform(-1.0, 1.0), 1)
+        pnts.append([X0 + d*dx, Y0 + d*dy])
+    pnts.append(pnts[0][:])
+    return pnts[:n]
+
+
+GENERATORS = {'convex': convex_polygon,
+              'concave': concave_polygon,
+              'densified': densified_polygon,
+              'degenerate': degenerate_polygon}
+
+
+# Kernels
+def _azimuths(pnts):
+    return [gt.p1p2Azimuth(pnts[i-1], pnts[i]) for i in range(1, len(pnts))]
+
+
+def _rotate(pnts):
+    return gt.transRotatePnts(pnts, gt.extentCenter(pnts), 30.0)
+
+
+KERNEL_CALLS = {'minRect': gt.minRect,
+                'polyAngles': gt.polyAngles,
+                'transRotatePnts': _rotate,
+                'extentPnts': gt.extentPnts,
+                'p1p2Azimuth': _azimuths}
+
+
+def time_call(func, arg, repeat=3):
+    """Returns the best seconds per call of func(arg) over repeat runs"""
+    number = 1
+    while True:
+        start = timeit.default_timer()
+        for i in range(number):
+            func(arg)
+        elapsed = timeit.default_timer() - start
+        if elapsed >= MIN_TIME or number >= 1000000:
+            break
+        number *= 10
+    best = elapsed/number
+    for i in range(repeat - 1):
+        start = timeit.default_timer()
+        for j in range(number):
+            func(arg)
+        best = min(best, (timeit.default_timer() - start)/number)
+    return best
+
+
+def _child_peak(func, arg, sender):
+    """Runs func(arg) in a child process and sends back its peak resident
+       memory growth"""
+    before = pipeline_profile.current_rss()
+    func(arg)
+    after = pipeline_profile.peak_rss()
+    sender.send(None if None in (before, after) else max(0, after - before))
+    sender.close()
+
+
+def peak_memory(func, arg):
+    """Returns the peak bytes allocated during func(arg), or None when
+       neither tracemalloc nor the resident memory can be read"""
+    if tracemalloc is None:
+        mp_setup.set_executable()
+        receiver, sender = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target=_child_peak,
+                                          args=(func, arg, sender))
+        process.start()
+        sender.close()
+        try:
+            return receiver.recv()
+        except EOFError:
+            return None
+        finally:
+            process.join()
+            receiver.close()
+    tracemalloc.start()
+    try:
+        func(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def scaling_exponent(sizes, times):
+    """Returns the log-log least squares slope of time against size"""
+    pairs = [(math.log(n), math.log(t)) for n, t in zip(sizes, times)
+             if n > 0 and t > 0]
+    if len(pairs) < 2:
+        return None
+    mx = sum(p[0] for p in pairs)/len(pairs)
+    my = sum(p[1] for p in pairs)/len(pairs)
+    sxx = sum((p[0] - mx)**2 for p in pairs)
+    if sxx == 0:
+        return None
+    return sum((p[0] - mx)*(p[1] - my) for p in pairs)/sxx
+
+
+def result_key(kernel, shape, n):
+    return '%s|%s|%d' % (kernel, shape, n)
+
+
+def run(sizes=SIZES, shapes=SHAPES, kernels=KERNELS, repeat=3, seed=0,
+        coordseq=False, memory=True, log=None):
+    """
+    Times every kernel on every shape and size.  Returns a dictionary
+    ready for json - machine, settings, results keyed kernel|shape|n
+    ({'seconds', 'peak_bytes'}) and scaling exponents keyed kernel|shape
+    """
+    results = {}
+    for shape in shapes:
+        for n in sizes:
+            pnts = GENERATORS[shape](n, seed)
+            if coordseq:
+                pnts = gt.CoordSeq(pnts)
+            for kernel in kernels:
+                func = KERNEL_CALLS[kernel]
+                seconds = time_call(func, pnts, repeat)
+                peak = peak_memory(func, pnts) if memory else None
+                results[result_key(kernel, shape, n)] = {
+                    'seconds': seconds, 'peak_bytes': peak}
+                if log:
+                    log('%-16s %-11s %8d  %.6g s' % (kernel, shape, n,
+                                                     seconds))
+    scaling = {}
+    for kernel in kernels:
+        for shape in shapes:
+            times = [results[result_key(kernel, shape, n)]['seconds']
+                     for n in sizes]
+            scaling['%s|%s' % (kernel, shape)] = scaling_exponent(sizes,
+                                                                  times)
+    return {'machine': {'python': platform.python_version(),
+                        'implementation': platform.python_implementation(),
+                        'platform': platform.platform(),
+                        'processor': platform.processor()},
+            'settings': {'sizes': list(sizes), 'shapes': list(shapes),
+                         'kernels': list(kernels), 'repeat': repeat,
+                         'seed': seed, 'coordseq': coordseq},
+            'results': results,
+            'scaling': scaling}
+
+
+def compare(current, baseline, threshold=1.25):
+    """
+    Returns a list of [key, baseline seconds, current seconds, ratio] for
+    every result in both runs, and a list of the keys whose ratio is over
+    the threshold
+    """
+    rows = []; regressions = []
+    for key in sorted(current['results']):
+        if key not in baseline['results']:
+            continue
+        old = baseline['results'][key]['seconds']
+        new = current['results'][key]['seconds']
+        ratio = new/old if old else float('inf')
+        rows.append([key, old, new, ratio])
+        if ratio > threshold:
+            regressions.append(key)
+    return rows, regressions
+
+
+def scaling_table(report):
+    """Returns the scaling exponents as printable lines"""
+    lines = ['%-16s %-11s %s' % ('kernel', 'shape', 'exponent')]
+    for key in sorted(report['scaling']):
+        kernel, shape = key.split('|')
+        value = report['scaling'][key]
+        lines.append('%-16s %-11s %s' % (
+            kernel, shape, 'n/a' if value is None else '%.2f' % value))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--max-size', type=int, default=None,
+                        help='drop sizes above this vertex count')
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES,
+                        default=SHAPES)
+    parser.add_argument('--kernels', nargs='+', choices=KERNELS,
+                        default=KERNELS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--coordseq', action='store_true',
+                        help='pass the points as a geometry_tools.CoordSeq')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the peak memory pass')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare to')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio counted as a regression')
+    args = parser.parse_args(argv)
+
+    sizes = [n for n in args.sizes
+             if args.max_size is None or n <= args.max_size]
+    report = run(sizes, args.shapes, args.kernels, args.repeat, args.seed,
+                 args.coordseq, not args.no_memory, log=print)
+    print('')
+    for line in scaling_table(report):
+        print(line)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('\nSaved baseline to %s' % args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(report, baseline, args.threshold)
+        print('\n%-42s %12s %12s %7s' % ('kernel|shape|n', 'baseline',
+                                          'current', 'ratio'))
+        for key, old, new, ratio in rows:
+            flag = '  <-- slower' if key in regressions else ''
+            print('%-42s %12.6g %12.6g %7.2f%s' % (key, old, new, ratio,
+                                                   flag))
+        if regressions:
+            print('\n%d of %d results slower than %.2fx the baseline'
+                  % (len(regressions), len(rows), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
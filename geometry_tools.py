@@ -5,35 +5,167 @@ Created on Fri Apr 28 09:40:16 2017
 @author: mtroyer
 """
 
-'''
-Sourced from Bounding Containers by Dan Patterson
-http://www.arcgis.com/home/
-item.html?id=564e2949763943e3b9fb4240bab0ca2f
-'''
+#
+#Sourced from Bounding Containers by Dan Patterson
+#http://www.arcgis.com/home/
+#item.html?id=564e2949763943e3b9fb4240bab0ca2f
+#
 #---------------------------------------------------------------------
 #required modules
 from __future__ import division
+import collections
+import itertools
 import math
+import random
+import sys
+from array import array
 #
 #constants
 degToRad = math.pi/180.0
 radToDeg = 180.0/math.pi
+rectTieTol = 1.0e-9     #of the hull size - rectangle measures this close tie
+angleTieTol = 1.0e-7    #degrees - angles this close are ties
+ngonCacheSize = 64      #unit circle tables kept, least recently used go first
 #
 #---------------------------------------------------------------
-def circleMake(aPnt,aRadius):
+class CoordSeq(object):
+  '''
+  A compact sequence of [X,Y] points stored as interleaved doubles
+  in one array('d') - X0, Y0, X1, Y1, ...  Points come back as
+  (X, Y) tuples and slices are views on the same buffer, so
+  trimming a closing point or walking a part copies nothing.
+  NumPy wraps it without a copy, np.asarray(seq) is (N, 2) float64,
+  and the helpers in this module return a CoordSeq when given one
+    seq = CoordSeq((pnt.X, pnt.Y) for pnt in part if pnt)
+    rotPnts = transRotatePnts(seq, extentCenter(seq), 30.0)
+  Do not grow .buf while a view or NumPy array is looking at it
+  '''
+  __slots__ = ('buf', 'start', 'stop')
+
+  def __init__(self, pnts=(), buf=None, start=0, stop=None):
+    if buf is None:
+      buf = array('d')
+      if hasattr(pnts, 'shape'):
+        data = pnts.astype('d').reshape(-1, 2)
+        data = data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+        if hasattr(buf, 'frombytes'):
+          buf.frombytes(data)
+        else:
+          buf.fromstring(data)
+      elif isinstance(pnts, CoordSeq):
+        buf.extend(pnts.buf[2*pnts.start:2*pnts.stop])
+      else:
+        for pnt in pnts:
+          buf.append(pnt[0]); buf.append(pnt[1])
+    self.buf = buf
+    self.start = start
+    self.stop = len(buf)//2 if stop is None else stop
+
+  @classmethod
+  def empty(cls, N):
+    '''Returns a zero filled CoordSeq of N points'''
+    return cls(buf=array('d', [0.0])*(2*N))
+
+  def __len__(self):
+    return self.stop - self.start
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      start, stop, step = i.indices(len(self))
+      if step != 1:
+        raise ValueError("CoordSeq views do not support a step")
+      stop = max(start, stop)
+      return CoordSeq(buf=self.buf, start=self.start + start,
+                      stop=self.start + stop)
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("CoordSeq index out of range")
+    k = 2*(self.start + i)
+    return (self.buf[k], self.buf[k+1])
+
+  def __setitem__(self, i, pnt):
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("CoordSeq index out of range")
+    k = 2*(self.start + i)
+    self.buf[k] = pnt[0]; self.buf[k+1] = pnt[1]
+
+  def __iter__(self):
+    buf = self.buf
+    for k in range(2*self.start, 2*self.stop, 2):
+      yield (buf[k], buf[k+1])
+
+  def __eq__(self, other):
+    if not isinstance(other, CoordSeq):
+      return NotImplemented
+    return (self.buf[2*self.start:2*self.stop] ==
+            other.buf[2*other.start:2*other.stop])
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return 'CoordSeq(%r)' % [list(pnt) for pnt in self]
+
+  def xs(self):
+    '''Returns the X values as an array('d')'''
+    return self.buf[2*self.start:2*self.stop:2]
+
+  def ys(self):
+    '''Returns the Y values as an array('d')'''
+    return self.buf[2*self.start+1:2*self.stop:2]
+
+  def buffer(self):
+    '''Returns a zero-copy buffer over the view's doubles'''
+    if sys.version_info[0] < 3:
+      return buffer(self.buf, 16*self.start, 16*len(self))
+    return memoryview(self.buf)[2*self.start:2*self.stop]
+
+  def __buffer__(self, flags):
+    return memoryview(self.buf)[2*self.start:2*self.stop]
+
+  @property
+  def __array_interface__(self):
+    address = self.buf.buffer_info()[0] + 16*self.start
+    return {'shape': (len(self), 2), 'typestr': '<f8',
+            'data': (address, False), 'version': 3}
+#---------------------------------------------------------------
+_unitCircles = collections.OrderedDict()
+def unitCircle(numVertices=360):
+  '''
+  returns the cached unit Ngon [(cos, sin), ...] for a vertex count,
+  starting at [1, 0] and running counter-clockwise - the least recently
+  used tables are dropped first, as geometry_batch.unit_ngon does
+  '''
+  try:
+    table = _unitCircles.pop(numVertices)
+  except KeyError:
+    step = 2.0*math.pi/numVertices
+    table = [(math.cos(step*i), math.sin(step*i)) for i in range(numVertices)]
+    while len(_unitCircles) >= ngonCacheSize:
+      _unitCircles.popitem(last=False)
+  _unitCircles[numVertices] = table
+  return table
+#---------------------------------------------------------------
+def circleMake(aPnt,aRadius,numVertices=360,asCoordSeq=False):
   '''create a circle from a point [X,Y] and radius
      returns a list of points representing the circle as an Ngon
+     (or a CoordSeq; geometry_batch.batch_ngons builds many at once)
   '''
   X0, Y0 = aPnt[0], aPnt[1]
-  X1, Y1 = X0 + aRadius, Y0
-  circPnts = [[X1, Y1]]
-  for i in range(1,360):
-    X = X0 + math.cos(degToRad * i) * aRadius
-    Y = Y1 + math.sin(degToRad * i) * aRadius
-    circPnt = [X,Y]
-    circPnts.append(circPnt)
-  del circPnt
-  return circPnts
+  if asCoordSeq:
+    circPnts = CoordSeq.empty(numVertices)
+    buf = circPnts.buf
+    for i, (cosA, sinA) in enumerate(unitCircle(numVertices)):
+      buf[2*i] = X0 + cosA*aRadius; buf[2*i+1] = Y0 + sinA*aRadius
+    return circPnts
+  return [[X0 + cosA*aRadius, Y0 + sinA*aRadius]
+          for cosA, sinA in unitCircle(numVertices)]
 #-------------------------------------------------------------
 def dxdyHypot (p1,p2):
   import math
@@ -46,35 +178,334 @@ def dXdY (p1,p2):
   xyDiff = [p1[0] - p2[0], p1[1] - p2[1]]
   return xyDiff
 #-------------------------------------------------------------
+def _extent(pnts):
+  '''Returns L, R, B, T of input points'''
+  if isinstance(pnts, CoordSeq):
+    xList = pnts.xs(); yList = pnts.ys()
+  else:
+    xList = []; yList = []
+    for pnt in pnts:
+      xList.append(pnt[0]); yList.append(pnt[1])
+  return min(xList), max(xList), min(yList), max(yList)
+#-------------------------------------------------------------
 def extentPnts(pnts):
   '''Returns the min, max X, Y of input points'''
-  xList = []; yList = []
-  for pnt in pnts:
-    xList.append(pnt[0]); yList.append(pnt[1])
-  L = min(xList); R = max(xList); B = min(yList); T = max(yList)
+  L, R, B, T = _extent(pnts)
   LL = [L,B]; UL = [L,T]; UR = [R,T]; LR = [R,B]
+  if isinstance(pnts, CoordSeq):
+    return CoordSeq([LL, UL, UR, LR])
   return [LL, UL, UR, LR]
 #-------------------------------------------------------------
 def extentCenter(pnts):
-  '''Returns the average and median X, Y coordinates of a series
-     of input points'''
-  xList = []; yList = []
-  for pnt in pnts:
-    xList.append(pnt[0]); yList.append(pnt[1])
-  L = min(xList); R = max(xList); B = min(yList); T = max(yList)
-  Xcent = (R - L)/2.0; Ycent = (T - B)/2.0
+  '''Returns the center of the extent [X, Y] of a series of input
+     points'''
+  L, R, B, T = _extent(pnts)
+  Xcent = (R - L)/2.0 + L; Ycent = (T - B)/2.0 + B
   return [Xcent, Ycent]
 #-------------------------------------------------------------
+def convexHull(pnts):
+  '''
+  Requires:  a list of points [[X,Y], ...] (closed or not)
+  Returns:   the convex hull as a list of [X,Y] points in counter-
+             clockwise order without a closing point.  Duplicate and
+             collinear points are dropped, so fewer than 3 points are
+             returned for degenerate input (a point or a line)
+  Andrew's monotone chain - O(n log n)
+  '''
+  source = pnts
+  pnts = sorted(set([(float(pnt[0]), float(pnt[1])) for pnt in pnts]))
+  if len(pnts) < 3:
+    if isinstance(source, CoordSeq):
+      return CoordSeq(pnts)
+    return [list(pnt) for pnt in pnts]
+  def cross(o, a, b):
+    return (a[0] - o[0])*(b[1] - o[1]) - (a[1] - o[1])*(b[0] - o[0])
+  lower = []
+  for pnt in pnts:
+    while len(lower) >= 2 and cross(lower[-2], lower[-1], pnt) <= 0:
+      lower.pop()
+    lower.append(pnt)
+  upper = []
+  for pnt in reversed(pnts):
+    while len(upper) >= 2 and cross(upper[-2], upper[-1], pnt) <= 0:
+      upper.pop()
+    upper.append(pnt)
+  hull = lower[:-1] + upper[:-1]
+  if isinstance(source, CoordSeq):
+    return CoordSeq(hull)
+  return [list(pnt) for pnt in hull]
+#-------------------------------------------------------------
+def caliperRects(hull):
+  '''
+  Requires:  a convex hull from convexHull (3 or more points)
+  Returns:   a generator of [anAngle, Xmin, Xmax, Ymin, Ymax], one per
+             hull edge, where anAngle is the edge angle relative to the
+             x axis and the extents are measured along and across the
+             edge, relative to the first hull point
+  Rotating calipers - the three support points only ever move forward
+  around the hull so all the rectangles cost O(h) together
+  '''
+  N = len(hull)
+  X0 = hull[0][0]; Y0 = hull[0][1]
+  Xs = [pnt[0] - X0 for pnt in hull]   #shift to limit round off
+  Ys = [pnt[1] - Y0 for pnt in hull]
+  right = top = left = 1
+  for i in range(N):
+    j = (i + 1) % N
+    dX = Xs[j] - Xs[i]; dY = Ys[j] - Ys[i]
+    edgeLen = math.hypot(dX, dY)
+    cosA = dX/edgeLen; sinA = dY/edgeLen
+    along = lambda k: Xs[k % N]*cosA + Ys[k % N]*sinA
+    across = lambda k: Ys[k % N]*cosA - Xs[k % N]*sinA
+    if right < i + 1:
+      right = i + 1
+    while along(right + 1) > along(right):
+      right += 1
+    if i == 0:
+      top = right
+    while across(top + 1) > across(top):
+      top += 1
+    if i == 0:
+      left = top
+    while along(left + 1) < along(left):
+      left += 1
+    #the edge itself is the bottom of the rectangle
+    yield [math.atan2(dY, dX)*radToDeg, along(left), along(right),
+           across(i), across(top)]
+#-------------------------------------------------------------
+#rectangle measures for caliperRects rows [anAngle, Xmin, Xmax, Ymin, Ymax]
+rectMeasures = {
+  'area': lambda rect: (rect[2] - rect[1])*(rect[4] - rect[3]),
+  'width': lambda rect: rect[4] - rect[3],
+  'perimeter': lambda rect: (rect[2] - rect[1]) + (rect[4] - rect[3])}
+#-------------------------------------------------------------
+def reverseRect(rect):
+  '''
+  Returns the caliperRects row [anAngle, Xmin, Xmax, Ymin, Ymax] of
+  the same rectangle measured along its hull edge run the other way
+  '''
+  anAngle, Xmin, Xmax, Ymin, Ymax = rect
+  anAngle += 180.0
+  if anAngle > 180.0:
+    anAngle -= 360.0
+  return [anAngle, -Xmax, -Xmin, -Ymax, -Ymin]
+#-------------------------------------------------------------
+def rectTolerance(pnts, measure='area'):
+  '''
+  Returns the tie tolerance of a rectangle measure over the points -
+  rectTieTol of their extent diagonal, squared for 'area'.  Round off
+  scales with the size of the shape, not with the measure, which can
+  be next to nothing for a sliver
+  '''
+  L, R, B, T = _extent(pnts)
+  size = math.hypot(R - L, T - B)
+  return rectTieTol*size**(2 if measure == 'area' else 1)
+#-------------------------------------------------------------
+def pickRect(rects, tol=0.0):
+  '''
+  Requires:  a list of candidate rectangles [value, angle, ...] and the
+             tie tolerance of the value (rectTolerance)
+  Returns:   the one to keep - the smallest value and, among the values
+             within tol of it, the smallest absolute angle (the
+             positive one of +/-), so ties never depend on round off
+             or on the order the edges are visited
+  '''
+  low = min([rect[0] for rect in rects])
+  ties = [rect for rect in rects if rect[0] <= low + tol]
+  least = min([abs(rect[1]) for rect in ties])
+  return max([rect for rect in ties if abs(rect[1]) <= least + angleTieTol],
+             key=lambda rect: rect[1])
+#-------------------------------------------------------------
+def hullRects(hull, measures=('area',), clockwise=False):
+  '''
+  Requires:  a convex hull from convexHull and a list of rectMeasures
+  Returns:   a dictionary of measure: [xyPnts, angle, dx, dy], the
+             bounding rectangle minimizing each measure, all from one
+             rotating calipers pass over the hull.  dx runs along the
+             hull edge, dy across it (dy is the width for 'width')
+  clockwise=True measures along the hull edges run clockwise - the
+  direction of the input ring's own edges when it is clockwise, as
+  ArcGIS stores outer rings - so angle is the one minRectByEdges
+  reports.  Ties are settled by pickRect
+  '''
+  asSeq = isinstance(hull, CoordSeq)
+  if len(hull) < 3:
+    #a point or a line - the rectangle collapses onto the hull
+    hull = [list(pnt) for pnt in hull]
+    if len(hull) == 1:
+      hull = hull*2
+    angle = p1p2Angle(hull[0], hull[1])
+    if angle == -9999.99:
+      angle = 0.0
+    dx = p1p2Dist(hull[0], hull[1])
+    xyPnts = [hull[0][:], hull[0][:], hull[1][:], hull[1][:]]
+    return dict([(measure, [CoordSeq(xyPnts) if asSeq else
+                            [pnt[:] for pnt in xyPnts], angle*(-1.0), dx, 0.0])
+                 for measure in measures])
+  candidates = dict([(measure, []) for measure in measures])
+  for rect in caliperRects(hull):
+    if clockwise:
+      rect = reverseRect(rect)
+    for measure in measures:
+      candidates[measure].append([rectMeasures[measure](rect),
+                                  rect[0]*(-1.0)] + rect[1:])
+  rects = {}
+  for measure in measures:
+    angle, Xmin, Xmax, Ymin, Ymax = pickRect(candidates[measure],
+                                             rectTolerance(hull, measure))[1:]
+    #Rotate the rectangle back and shift it to the first hull point
+    cosA = math.cos(degToRad * angle*(-1.0))
+    sinA = math.sin(degToRad * angle*(-1.0))
+    rectPnts = [[Xmin,Ymin], [Xmin,Ymax], [Xmax,Ymax], [Xmax,Ymin]]
+    xyPnts = []
+    for X, Y in rectPnts:
+      xyPnts.append([hull[0][0] + X*cosA - Y*sinA,
+                     hull[0][1] + X*sinA + Y*cosA])
+    if asSeq:
+      xyPnts = CoordSeq(xyPnts)
+    rects[measure] = [xyPnts, angle, Xmax - Xmin, Ymax - Ymin]
+  return rects
+#-------------------------------------------------------------
+def _hullRects(pnts, measures):
+  '''hullRects of the points, measured in the direction they run'''
+  if not isinstance(pnts, CoordSeq):
+    pnts = list(pnts)
+  return hullRects(convexHull(pnts), measures, polyArea(pnts) < 0)
+#-------------------------------------------------------------
 def minRect(pnts):
   '''
   Determines the minimum area rectangle for a shape represented
   by a list of points
-  
-  calls:  polyAngles, transRotatePnts
+
+  calls:  convexHull, hullRects
+  Note:  the minimum rectangle has a side collinear with a hull edge
+         so only the hull edges are tested.  Returns the same
+         [xyPnts, angle, dx, dy] as minRectByEdges in O(n log n) -
+         the angle of a clockwise ring is measured along its edges
+         run clockwise, exactly as minRectByEdges does
+  '''
+  return _hullRects(pnts, ['area'])['area']
+#-------------------------------------------------------------
+def minWidthRect(pnts):
+  '''
+  Returns [xyPnts, angle, dx, dy] for the bounding rectangle across
+  the narrowest width of the points - dy is the minimum width
+  '''
+  return _hullRects(pnts, ['width'])['width']
+#-------------------------------------------------------------
+def minPerimRect(pnts):
+  '''
+  Returns [xyPnts, angle, dx, dy] for the minimum perimeter
+  bounding rectangle of the points
+  '''
+  return _hullRects(pnts, ['perimeter'])['perimeter']
+#-------------------------------------------------------------
+def minCircle(pnts, seed=None):
+  '''
+  Returns [[X, Y], radius], the minimum enclosing circle of a list
+  of points.  Welzl's algorithm in its iterative (move-to-front free)
+  form - expected linear time on shuffled points.  Pass a convex
+  hull to cut the work down, the circle only ever touches the hull
+  '''
+  pnts = [[float(pnt[0]), float(pnt[1])] for pnt in pnts]
+  if not pnts:
+    raise ValueError("minCircle requires at least one point")
+  X0 = pnts[0][0]; Y0 = pnts[0][1]
+  local = [[pnt[0] - X0, pnt[1] - Y0] for pnt in pnts]
+  random.Random(seed).shuffle(local)
+  scale = max([abs(c) for pnt in local for c in pnt] + [1.0])
+  eps = 1.0e-12*scale
+  def inside(circ, pnt):
+    return math.hypot(pnt[0] - circ[0], pnt[1] - circ[1]) <= circ[2] + eps
+  def circle2(a, b):
+    return [(a[0] + b[0])/2.0, (a[1] + b[1])/2.0,
+            math.hypot(a[0] - b[0], a[1] - b[1])/2.0]
+  def circle3(a, b, c):
+    d = 2.0*(a[0]*(b[1] - c[1]) + b[0]*(c[1] - a[1]) + c[0]*(a[1] - b[1]))
+    if abs(d) <= eps*eps:
+      #collinear - the circle spans the farthest pair
+      return max([circle2(a, b), circle2(a, c), circle2(b, c)],
+                 key=lambda circ: circ[2])
+    a2 = a[0]**2 + a[1]**2; b2 = b[0]**2 + b[1]**2; c2 = c[0]**2 + c[1]**2
+    X = (a2*(b[1] - c[1]) + b2*(c[1] - a[1]) + c2*(a[1] - b[1]))/d
+    Y = (a2*(c[0] - b[0]) + b2*(a[0] - c[0]) + c2*(b[0] - a[0]))/d
+    return [X, Y, math.hypot(a[0] - X, a[1] - Y)]
+  circ = [local[0][0], local[0][1], 0.0]
+  for i in range(1, len(local)):
+    p = local[i]
+    if inside(circ, p):
+      continue
+    circ = [p[0], p[1], 0.0]
+    for j in range(i):
+      q = local[j]
+      if inside(circ, q):
+        continue
+      circ = circle2(p, q)
+      for k in range(j):
+        r = local[k]
+        if not inside(circ, r):
+          circ = circle3(p, q, r)
+  return [[circ[0] + X0, circ[1] + Y0], circ[2]]
+#-------------------------------------------------------------
+def polyArea(pnts):
+  '''
+  Returns the planar (shoelace) area of a ring, positive when the
+  points run counter-clockwise
+  '''
+  X0 = pnts[0][0]; Y0 = pnts[0][1]
+  area = 0.0
+  for i in range(len(pnts)):
+    X1 = pnts[i-1][0] - X0; Y1 = pnts[i-1][1] - Y0
+    X2 = pnts[i][0] - X0; Y2 = pnts[i][1] - Y0
+    area += X1*Y2 - X2*Y1
+  return area/2.0
+#-------------------------------------------------------------
+def polyPerimeter(pnts):
+  '''Returns the perimeter of a ring, closed or not'''
+  return sum([p1p2Dist(pnts[i-1], pnts[i]) for i in range(len(pnts))])
+#-------------------------------------------------------------
+def boundingContainers(pnts):
+  '''
+  Requires:  a list of points (a site or survey outline)
+  Returns:   a dictionary of every container from one hull:
+               extent        [LL, UL, UR, LR] as extentPnts
+               hull          convex hull points (ccw, not closed)
+               hullArea, hullPerimeter
+               minRect       [xyPnts, angle, dx, dy], minimum area
+               minWidthRect  [xyPnts, angle, dx, dy], dy is the width
+               minPerimRect  [xyPnts, angle, dx, dy], minimum perimeter
+               circle        [[X, Y], radius], minimum enclosing circle
+  The hull is built once and the rectangles share one calipers pass
+  '''
+  if not isinstance(pnts, CoordSeq):
+    pnts = list(pnts)
+  hull = convexHull(pnts)
+  rects = hullRects(hull, ['area', 'width', 'perimeter'], polyArea(pnts) < 0)
+  if len(hull) > 2:
+    hullArea = polyArea(hull); hullPerimeter = polyPerimeter(hull)
+  else:
+    hullArea = 0.0
+    hullPerimeter = 2.0*p1p2Dist(hull[0], hull[-1])
+  return {'extent': extentPnts(hull),
+          'hull': hull,
+          'hullArea': hullArea,
+          'hullPerimeter': hullPerimeter,
+          'minRect': rects['area'],
+          'minWidthRect': rects['width'],
+          'minPerimRect': rects['perimeter'],
+          'circle': minCircle(hull, seed=0)}
+#-------------------------------------------------------------
+def minRectByEdges(pnts):
+  '''
+  Determines the minimum area rectangle for a shape represented
+  by a list of points by rotating every point to every edge angle.
+  O(n^2) - kept as the reference for minRect, use minRect instead
+
+  calls:  polyAngles, transRotatePnts, pickRect
   Note:  polyAngles returns a list in the form
          [pnt, to pnt, anAngle, aDistance]
   '''
-  areaDict = {}
+  rects = []
   pnts = list(pnts)             #ensure that you have a list of points
   angleList = polyAngles(pnts)  #determine the angles
   pntCent = extentCenter(pnts)  #determine centre of the extent
@@ -87,14 +518,13 @@ def minRect(pnts):
     #Determine the area of the rotated hull
     Xmin = min(Xs); Xmax = max(Xs); Ymin = min(Ys); Ymax = max(Ys)
     area = (max(Xs) - min(Xs))*(max(Ys) - min(Ys))
-    areaDict.update({area:[pntCent, Xmin, Xmax, Ymin, Ymax,angle[2]]})
+    rects.append([area, angle[2]*(-1.0), Xmin, Xmax, Ymin, Ymax])
   #Get the minimum rectangle centred about the origin
   #Rotate the rectangle back
-  minArea = min(areaDict.keys())
-  a = areaDict.get(minArea)
-  Xmin = a[1];  Xmax = a[2]
-  Ymin = a[3];  Ymax = a[4]
-  angle = a[5] * (-1.0)
+  a = pickRect(rects, rectTolerance(pnts))
+  Xmin = a[2];  Xmax = a[3]
+  Ymin = a[4];  Ymax = a[5]
+  angle = a[1]
   #print "xmin,xmax, ymin, ymax, angle",Xmin,Xmax,Ymin,Ymax,a[5], angle
   rectPnts = [[Xmin,Ymin], [Xmin,Ymax], [Xmax,Ymax], [Xmax,Ymin]]
   originPnt = [0.0,0.0]
@@ -169,6 +599,8 @@ def pntAvgXY(pnts):
   of input points
   '''
   N = float(len(pnts))  #ensure floating point division later on
+  if isinstance(pnts, CoordSeq):
+    return [sum(pnts.xs())/N, sum(pnts.ys())/N]
   Xsum = 0.0; Ysum = 0.0
   for pnt in pnts:
     X = pnt[0]; Y = pnt[1]
@@ -178,6 +610,128 @@ def pntAvgXY(pnts):
   Ycent = (Ysum/N)
   return [Xcent, Ycent]
 #-------------------------------------------------------------
+class ExtentAccumulator(object):
+  '''
+  Running extent, average and (optionally) variance of a stream of
+  points in constant memory - extentPnts, extentCenter and pntAvgXY
+  without holding the points.  Feed it chunks with update(): lists,
+  generators (e.g. (pnt.X, pnt.Y) over a SHAPE@ cursor) or NumPy
+  arrays of shape (N, 2).  Accumulators built by separate workers
+  combine with merge()
+    acc = ExtentAccumulator()
+    acc.update((pnt.X, pnt.Y) for row in cursor
+               for part in row[0] for pnt in part if pnt)
+    acc.extentPnts(), acc.extentCenter(), acc.pntAvgXY()
+  '''
+  __slots__ = ('count', 'xMin', 'xMax', 'yMin', 'yMax',
+               'xMean', 'yMean', 'xM2', 'yM2', 'variance', 'blockSize')
+
+  def __init__(self, variance=False, blockSize=4096):
+    self.count = 0
+    self.xMin = self.yMin = float('inf')
+    self.xMax = self.yMax = float('-inf')
+    self.xMean = self.yMean = 0.0
+    self.xM2 = self.yM2 = 0.0    #sums of squared deviations (Welford)
+    self.variance = variance
+    self.blockSize = blockSize
+
+  def __getstate__(self):
+    return [getattr(self, name) for name in self.__slots__]
+
+  def __setstate__(self, state):
+    for name, value in zip(self.__slots__, state):
+      setattr(self, name, value)
+
+  def _combine(self, n, xMin, xMax, yMin, yMax, xMean, yMean, xM2, yM2):
+    '''Chan et al. pairwise update with the summary of a block'''
+    if n == 0:
+      return
+    N = self.count + n
+    dX = xMean - self.xMean; dY = yMean - self.yMean
+    if self.variance:
+      self.xM2 += xM2 + dX*dX*self.count*n/N
+      self.yM2 += yM2 + dY*dY*self.count*n/N
+    self.xMean += dX*n/N; self.yMean += dY*n/N
+    self.xMin = min(self.xMin, xMin); self.xMax = max(self.xMax, xMax)
+    self.yMin = min(self.yMin, yMin); self.yMax = max(self.yMax, yMax)
+    self.count = N
+
+  def add(self, pnt):
+    '''Adds a single point [X,Y]'''
+    X = float(pnt[0]); Y = float(pnt[1])
+    self._combine(1, X, X, Y, Y, X, Y, 0.0, 0.0)
+    return self
+
+  def update(self, pnts):
+    '''Adds a chunk of points - a NumPy array or any iterable'''
+    if hasattr(pnts, 'shape'):
+      arr = pnts.reshape(-1, 2)
+      if len(arr) == 0:
+        return self
+      arr = arr.astype(float)
+      lo = arr.min(axis=0); hi = arr.max(axis=0); mean = arr.mean(axis=0)
+      M2 = [0.0, 0.0]
+      if self.variance:
+        M2 = ((arr - mean)**2).sum(axis=0)
+      self._combine(len(arr), lo[0], hi[0], lo[1], hi[1],
+                    mean[0], mean[1], M2[0], M2[1])
+      return self
+    pnts = iter(pnts)
+    while True:
+      xList = []; yList = []
+      for pnt in itertools.islice(pnts, self.blockSize):
+        xList.append(pnt[0]); yList.append(pnt[1])
+      n = len(xList)
+      if n == 0:
+        return self
+      xMean = math.fsum(xList)/n; yMean = math.fsum(yList)/n
+      xM2 = yM2 = 0.0
+      if self.variance:
+        xM2 = math.fsum([(X - xMean)**2 for X in xList])
+        yM2 = math.fsum([(Y - yMean)**2 for Y in yList])
+      self._combine(n, float(min(xList)), float(max(xList)),
+                    float(min(yList)), float(max(yList)),
+                    xMean, yMean, xM2, yM2)
+
+  def merge(self, other):
+    '''Folds another accumulator (e.g. from a worker) into this one'''
+    if other.variance != self.variance:
+      raise ValueError("Cannot merge accumulators with and without variance")
+    self._combine(other.count, other.xMin, other.xMax, other.yMin,
+                  other.yMax, other.xMean, other.yMean, other.xM2, other.yM2)
+    return self
+
+  def _checkEmpty(self):
+    if self.count == 0:
+      raise ValueError("No points have been accumulated")
+
+  def extentPnts(self):
+    '''Returns [LL, UL, UR, LR] as extentPnts'''
+    self._checkEmpty()
+    L = self.xMin; R = self.xMax; B = self.yMin; T = self.yMax
+    return [[L,B], [L,T], [R,T], [R,B]]
+
+  def extentCenter(self):
+    '''Returns the center of the extent [X, Y]'''
+    self._checkEmpty()
+    return [(self.xMax - self.xMin)/2.0 + self.xMin,
+            (self.yMax - self.yMin)/2.0 + self.yMin]
+
+  def pntAvgXY(self):
+    '''Returns the average X, Y as pntAvgXY'''
+    self._checkEmpty()
+    return [self.xMean, self.yMean]
+
+  def varXY(self, sample=False):
+    '''Returns the population (or sample) variance of X and Y'''
+    self._checkEmpty()
+    if not self.variance:
+      raise ValueError("Variance was not tracked - use variance=True")
+    d = self.count - 1 if sample else self.count
+    if d <= 0:
+      return [0.0, 0.0]
+    return [self.xM2/d, self.yM2/d]
+#-------------------------------------------------------------
 def pntCenter (p1,p2):
   '''
   requires 2 points [10,10],[20,20]
@@ -191,16 +745,14 @@ def polyAngles(pnts):
   Requires:  a list of points forming a polygon
   Returns:   a list containing from pnt, to pnt, anAngle, aDistance
   '''
-  pnts2 = pnts[:]
-  if pnts2[0] != pnts2[-1]:
-    N = len(pnts2)
-    pnts2.append(pnts2[0])        #add the first point to the list
+  if tuple(pnts[0]) != tuple(pnts[-1]):
+    N = len(pnts)                 #wrap back to the first point
   else:
-    N = len(pnts2) - 1
+    N = len(pnts) - 1
   angleList = []  
-  for i in range(1, len(pnts2)):
-    pnt1 = pnts2[i-1];  pnt2 = pnts2[i]
-    if pnt1 != pnt2:
+  for i in range(1, N + 1):
+    pnt1 = pnts[i-1];  pnt2 = pnts[i % len(pnts)]
+    if tuple(pnt1) != tuple(pnt2):
       theAngle = p1p2Angle(pnt1, pnt2)
       theDist = p1p2Dist(pnt1, pnt2)
       if i < N:
@@ -223,7 +775,7 @@ def transRotatePnts(pnts,pntCent,angle):
   #
   X0 = pntCent[0]; Y0 = pntCent[1]
   #print "transform2D center ", str(X0), str(Y0)
-  if pnts[0] != pnts[-1]:
+  if tuple(pnts[0]) != tuple(pnts[-1]):
     N = len(pnts)
   else:
     N = len(pnts)-1
@@ -231,6 +783,17 @@ def transRotatePnts(pnts,pntCent,angle):
   angle = angle*(-1.0) #reverse the rotation
   cosXY = math.cos(degToRad * angle) 
   sinXY = math.sin(degToRad * angle)
+  if isinstance(pnts, CoordSeq):
+    #fill one new buffer - no per point lists
+    rotPnts = CoordSeq.empty(N)
+    src = pnts.buf; dst = rotPnts.buf
+    k = 2*pnts.start
+    for j in range(0, 2*N, 2):
+      X1 = src[k] - X0; Y1 = src[k+1] - Y0
+      dst[j] = (X1 * cosXY) - (Y1 *sinXY)
+      dst[j+1] = (X1 * sinXY) + (Y1 *cosXY)
+      k += 2
+    return rotPnts
   rotPnts = []
   for j in range(0, N):
     X1 = pnts[j][0] - X0; Y1 = pnts[j][1] - Y0
@@ -242,5 +805,9 @@ def transRotatePnts(pnts,pntCent,angle):
   return rotPnts
   
 
+#-------------------------------------------------------------
 def main():
-    pass
\ No newline at end of file
+  pass
+
+if __name__ == '__main__':
+  main()
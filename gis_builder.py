@@ -28,6 +28,7 @@ Comments:
 ###############################################################################
 
 from __future__ import division  # Integer division is lame - use // instead
+import acreage
 import arcpy
 import collections
 import csv
@@ -243,23 +244,9 @@ def get_acres(fc):
     """Check for an acres field in fc - create if doesn't exist and calculate.
        Recalculate acres and return name of acre field"""
 
-    # Add ACRES field to analysis area - check if exists
-    field_list = [field.name for field in arcpy.ListFields(fc)
-                  if field.name.upper() == "ACRES"]
-
-    # If ACRES/Acres/acres exists in table, flag for calculation instead
-    if field_list:
-        acre_field = field_list[0] # select the 'acres' variant
-    else:
-        arcpy.AddField_management(fc, "ACRES", "DOUBLE", 15, 2)
-        acre_field = "ACRES"
-
-    arcpy.CalculateField_management(fc,
-                                    acre_field,
-                                    "!shape.area@ACRES!",
-                                    "PYTHON_9.3")
-    acres = sum(row[0] for row in arcpy.da.SearchCursor(fc, acre_field))
-    return acre_field, acres
+    # Find or add the ACRES field, write every feature's planar acres and
+    # total them from a single geometry read - see acreage.py
+    return acreage.calculate_acres(fc)
 
 def selectRelatedRecords(sourceLayer, pk, targetLayer, fk):
     """A python implementation of the 'related tables' button in table view"""
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite ledger of queued tool runs for use_restrictions_job_queue.
+
+Every job (a row of the parameter csv) gets one ledger row holding its
+status, attempt count, start and end times, outputs and the traceback of
+its last failure, so a queue that dies at row 40 of 60 can be rerun with
+resume=True and only the unfinished rows run again:
+
+    ledger = JobLedger(r'T:\\...\\Use_Restrictions_Params.sqlite')
+    keys = ledger.register(params, labels)
+    for key in ledger.pending(keys, resume=True):
+        ...
+
+Jobs are keyed on a SHA-1 of their parameters, not their row number, so
+editing or reordering the csv between runs does not mark the wrong rows
+done.  Only the parent process writes the ledger - the workers just run
+jobs and return their outputs.
+"""
+
+from __future__ import division
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+RETRY = 'RETRY'
+DONE = 'DONE'
+FAILED = 'FAILED'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_key TEXT PRIMARY KEY,
+    label TEXT,
+    params TEXT,
+    status TEXT,
+    attempts INTEGER DEFAULT 0,
+    started REAL,
+    finished REAL,
+    outputs TEXT,
+    traceback TEXT
+)
+"""
+
+
+# Functions
+def job_key(param):
+    """Returns the ledger key of a job - a SHA-1 of its sorted parameters"""
+    text = json.dumps(sorted(param.items()), sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class JobLedger(object):
+    """
+    The jobs table of a SQLite database at ledger_path (created if it does
+    not exist).  Every update is committed straight away, so the ledger is
+    current whenever the queue stops.
+    """
+
+    def __init__(self, ledger_path):
+        self.path = ledger_path
+        folder = os.path.dirname(os.path.abspath(ledger_path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.connection = sqlite3.connect(ledger_path)
+        self.connection.execute(_SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def _update(self, key, **values):
+        columns = sorted(values)
+        self.connection.execute(
+            'UPDATE jobs SET {} WHERE job_key = ?'.format(
+                ', '.join('{} = ?'.format(column) for column in columns)),
+            [values[column] for column in columns] + [key])
+        self.connection.commit()
+
+    def register(self, params, labels=None):
+        """
+        Adds every job in params that is not in the ledger yet and returns
+        their keys, in order
+        """
+        keys = []
+        for i, param in enumerate(params):
+            key = job_key(param)
+            label = labels[i] if labels else key[:12]
+            self.connection.execute(
+                'INSERT OR IGNORE INTO jobs (job_key, label, params, status) '
+                'VALUES (?, ?, ?, ?)',
+                [key, label, json.dumps(param, sort_keys=True), PENDING])
+            keys.append(key)
+        self.connection.commit()
+        return keys
+
+    def status(self, key):
+        row = self.connection.execute(
+            'SELECT status FROM jobs WHERE job_key = ?', [key]).fetchone()
+        return row[0] if row else None
+
+    def pending(self, keys, resume=False):
+        """
+        Returns the keys to run - all of them, or with resume only those
+        not already DONE (failed and interrupted jobs run again)
+        """
+        if not resume:
+            return list(keys)
+        return [key for key in keys if self.status(key) != DONE]
+
+    def start(self, key):
+        """Marks a job running and returns its attempt number"""
+        attempts = self.connection.execute(
+            'SELECT attempts FROM jobs WHERE job_key = ?',
+            [key]).fetchone()[0] + 1
+        self._update(key, status=RUNNING, attempts=attempts,
+                     started=time.time(), finished=None)
+        return attempts
+
+    def finish(self, key, outputs):
+        self._update(key, status=DONE, finished=time.time(),
+                     outputs=json.dumps(list(outputs)), traceback=None)
+
+    def fail(self, key, traceback, retry=False):
+        self._update(key, status=RETRY if retry else FAILED,
+                     finished=time.time(), traceback=traceback)
+
+    def reset(self, keys):
+        """Returns jobs to PENDING and zeroes their attempts - a fresh run"""
+        for key in keys:
+            self._update(key, status=PENDING, attempts=0, started=None,
+                         finished=None, traceback=None)
+
+    def summary(self, keys):
+        """Returns a dict of status: job count for keys"""
+        counts = {}
+        for key in keys:
+            status = self.status(key)
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def failures(self, keys):
+        """Returns (label, traceback) of every FAILED job in keys"""
+        rows = []
+        for key in keys:
+            row = self.connection.execute(
+                'SELECT label, traceback FROM jobs WHERE job_key = ? AND '
+                'status = ?', [key, FAILED]).fetchone()
+            if row:
+                rows.append(row)
+        return rows
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Process setup shared by the multiprocessing modules.
+
+ArcMap runs python embedded, so sys.executable is the host application and
+multiprocessing has to be pointed at the python install before it starts a
+child.  Call set_executable() before creating a Pool or Process:
+
+    mp_setup.set_executable()
+    pool = multiprocessing.Pool(processes=workers, maxtasksperchild=1)
+
+get_install_path() prefers a registered 64 bit python - background
+geoprocessing - over the 32 bit one ArcMap ships with.
+"""
+
+import multiprocessing
+import os
+import sys
+
+
+# Functions
+def get_install_path():
+    """
+    Return 64bit python install path from registry (if installed and
+    registered), otherwise fall back to current 32bit process install path
+    """
+    if sys.maxsize > 2**32:
+        return sys.exec_prefix
+    path = r'SOFTWARE\Python\PythonCore\2.7'
+    try:
+        from _winreg import OpenKey, QueryValue
+        from _winreg import HKEY_LOCAL_MACHINE, KEY_READ, KEY_WOW64_64KEY
+        with OpenKey(HKEY_LOCAL_MACHINE, path, 0,
+                     KEY_READ | KEY_WOW64_64KEY) as key:
+            return QueryValue(key, "InstallPath").strip(os.sep)
+    except:
+        return sys.exec_prefix
+
+
+def set_executable():
+    """Set multiprocessing exe in case we're running as an embedded process -
+       windows only, elsewhere the children fork"""
+    if sys.platform == 'win32':
+        multiprocessing.set_executable(os.path.join(get_install_path(),
+                                                    'pythonw.exe'))
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Stage and geoprocessing call profiling for the Use Restrictions tools.
+
+A Profiler splits a run into the stages the tools already announce and,
+while it is open, wraps the overlay tools on the arcpy module (GP_TOOLS) so
+every union, dissolve, clip, select and calc - including the ones made by
+helper modules like restriction_matrix - is timed without touching the call
+sites:
+
+    profiler = Profiler(trace_path, vertices=True)
+    profiler.stage('1.) Dissolving input polygon')
+    ...
+    with profiler.section('Restriction_' + fc):
+        arcpy.Clip_analysis(...)
+    ...
+    profiler.close()
+    for line in profiler.summary_table():
+        logger.logfile(line)
+
+Every stage, section and call is one JSON line in the trace, with wall and
+CPU seconds, the peak resident memory of the process so far and, for calls,
+the feature count (and optionally vertex count) of each input and output
+dataset.  The process peak never goes down, so a call that raises it also
+records rss_before, the resident memory when it started, and rss_growth,
+how far above that it peaked - what the call itself needed.  Calls made in worker processes are not seen - only the time of the
+stage that waits for them.
+"""
+
+from __future__ import division
+import collections
+import contextlib
+import json
+import os
+import sys
+import time
+
+
+# arcpy tools wrapped while a Profiler is open
+GP_TOOLS = ('Union_analysis', 'Intersect_analysis', 'Erase_analysis',
+            'Clip_analysis', 'Split_analysis', 'Select_analysis',
+            'Dissolve_management', 'Merge_management',
+            'MultipartToSinglepart_management', 'CopyFeatures_management',
+            'DeleteIdentical_management', 'SelectLayerByAttribute_management',
+            'SelectLayerByLocation_management', 'CalculateField_management',
+            'PolygonToRaster_conversion')
+
+
+# Functions
+def cpu_seconds():
+    """User plus system CPU seconds of this process"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes, or None"""
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters), counters.cb):
+            return int(counters.PeakWorkingSetSize)
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss():
+    """Resident memory of this process in bytes right now, or None"""
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters), counters.cb):
+            return int(counters.WorkingSetSize)
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def dataset_args(args):
+    """The string arguments of a call that could be datasets - lists and ';'
+       delimited multivalues are split"""
+    paths = []
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            paths.extend(dataset_args(arg))
+        elif isinstance(arg, basestring if sys.version_info[0] == 2 else str):
+            paths.extend(path.strip().strip("'\"") for path in arg.split(';')
+                         if path.strip())
+    return paths
+
+
+def dataset_measures(path, vertices=False):
+    """Returns {'path', 'features'[, 'vertices']} for a dataset, or None
+       when path is not a feature class, layer or table"""
+    import arcpy
+    try:
+        if not arcpy.Exists(path):
+            return None
+        measures = {'path': path,
+                    'features': int(arcpy.GetCount_management(path).getOutput(0))}
+        if vertices and hasattr(arcpy.Describe(path), 'shapeType'):
+            total = 0
+            with arcpy.da.SearchCursor(path, ['SHAPE@']) as cur:
+                for shape, in cur:
+                    if shape is not None:
+                        total += shape.pointCount
+            measures['vertices'] = total
+        return measures
+    except Exception:
+        return None
+
+
+def summarize(events):
+    """
+    Returns (stages, tools) - OrderedDicts of stage name and of tool name:
+    {'calls', 'wall', 'cpu', 'peak_rss'} from a list of trace events.  Call
+    time is credited to the stage the call ran in.
+    """
+    stages = collections.OrderedDict()
+    tools = collections.OrderedDict()
+    for event in events:
+        if event['kind'] == 'stage':
+            row = stages.setdefault(event['name'], {'calls': 0})
+            row.update(wall=event['wall'], cpu=event['cpu'],
+                       peak_rss=event['peak_rss'])
+    for event in events:
+        if event['kind'] != 'call':
+            continue
+        if event['stage'] in stages:
+            stages[event['stage']]['calls'] += 1
+        row = tools.setdefault(event['name'], {'calls': 0, 'wall': 0.0,
+                                               'cpu': 0.0, 'peak_rss': None})
+        row['calls'] += 1
+        row['wall'] += event['wall']
+        row['cpu'] += event['cpu']
+        if event['peak_rss'] is not None:
+            row['peak_rss'] = max(row['peak_rss'] or 0, event['peak_rss'])
+    return stages, tools
+
+
+def _megabytes(value):
+    return '' if value is None else '{:.0f}'.format(value / 1024**2)
+
+
+class Profiler(object):
+    """
+    Times the stages, sections and geoprocessing calls of one run and
+    writes them to trace_path as JSON lines (kept in memory only when
+    trace_path is None), and the summary table to <trace>_Summary.txt when
+    it is closed.  vertices=True counts the vertices of every call's
+    datasets - a full read of each, so only for diagnosing a run.  A
+    Profiler with enabled=False does nothing.
+    """
+
+    def __init__(self, trace_path=None, vertices=False, tools=GP_TOOLS,
+                 enabled=True):
+        self.enabled = enabled
+        self.events = []
+        self.vertices = vertices
+        self.trace = None
+        self.summary_path = None
+        self.current = None
+        self.sections = []
+        self.originals = {}
+        if not enabled:
+            return
+        if trace_path:
+            self.trace = open(trace_path, 'w')
+            self.summary_path = os.path.splitext(trace_path)[0] + '_Summary.txt'
+        import arcpy
+        for name in tools:
+            function = getattr(arcpy, name, None)
+            if function is not None:
+                self.originals[name] = function
+                setattr(arcpy, name, self._wrap(name, function))
+
+    def _record(self, event):
+        self.events.append(event)
+        if self.trace:
+            self.trace.write(json.dumps(event, sort_keys=True) + '\n')
+            self.trace.flush()
+
+    def _open(self, kind, name):
+        return {'kind': kind, 'name': name,
+                'stage': self.current['name'] if self.current else None,
+                'section': self.sections[-1]['name'] if self.sections else None,
+                'start': time.time(), '_cpu': cpu_seconds()}
+
+    def _close(self, event, wall=None, cpu=None, **extra):
+        started = event.pop('_cpu')
+        event['wall'] = time.time() - event['start'] if wall is None else wall
+        event['cpu'] = cpu_seconds() - started if cpu is None else cpu
+        event['peak_rss'] = peak_rss()
+        event.update(extra)
+        self._record(event)
+
+    def _wrap(self, name, function):
+        def profiled(*args, **kwargs):
+            event = self._open('call', name)
+            inputs = [measures for measures in
+                      (dataset_measures(path, self.vertices) for path in
+                       dataset_args(list(args) + list(kwargs.values())))
+                      if measures]
+            rss_before = current_rss()
+            peak_before = peak_rss()
+            event['_cpu'] = cpu_seconds()
+            event['start'] = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                self._close(event, inputs=inputs, outputs=[], error=repr(e))
+                raise
+            wall = time.time() - event['start']
+            cpu = cpu_seconds() - event['_cpu']
+            # Only a call that raised the peak says how much it needed
+            memory = {}
+            peak_after = peak_rss()
+            if None not in (rss_before, peak_before, peak_after) and peak_after > peak_before:
+                memory = {'rss_before': rss_before,
+                          'rss_growth': peak_after - rss_before}
+            outputs = []
+            try:
+                outputs = [result.getOutput(i) for i in range(result.outputCount)]
+            except Exception:
+                pass
+            outputs = [measures for measures in
+                       (dataset_measures(path, self.vertices)
+                        for path in dataset_args(outputs)) if measures]
+            # Inputs overwritten by the call are outputs
+            output_paths = set(measures['path'] for measures in outputs)
+            inputs = [measures for measures in inputs
+                      if measures['path'] not in output_paths]
+            self._close(event, wall, cpu, inputs=inputs, outputs=outputs, **memory)
+            return result
+        profiled.__name__ = name
+        return profiled
+
+    def stage(self, name):
+        """Ends the current stage, if any, and starts the next"""
+        if not self.enabled:
+            return
+        if self.current:
+            self._close(self.current)
+            self.current = None
+        self.current = self._open('stage', name)
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """Times the enclosed block - a criterion, a tile - within the stage"""
+        if not self.enabled:
+            yield
+            return
+        event = self._open('section', name)
+        self.sections.append(event)
+        try:
+            yield
+        finally:
+            self.sections.pop()
+            self._close(event)
+
+    def close(self):
+        """Ends the last stage, unwraps arcpy, closes the trace and writes
+           the summary table"""
+        if not self.enabled:
+            return
+        if self.current:
+            self._close(self.current)
+            self.current = None
+        import arcpy
+        for name, function in self.originals.items():
+            setattr(arcpy, name, function)
+        self.originals = {}
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+            with open(self.summary_path, 'w') as f:
+                f.write('\n'.join(self.summary_table()) + '\n')
+
+    def summary_table(self, top=10):
+        """
+        Returns printable lines: wall, CPU, peak memory and call count by
+        stage and by tool, then the slowest sections and calls
+        """
+        if not self.enabled:
+            return []
+        stages, tools = summarize(self.events)
+        lines = ['{:<48} {:>10} {:>10} {:>9} {:>6}'.format(
+            'Stage', 'Wall (s)', 'CPU (s)', 'Peak MB', 'Calls')]
+        for name, row in stages.items():
+            lines.append('{:<48} {:>10.1f} {:>10.1f} {:>9} {:>6}'.format(
+                name[:48], row['wall'], row['cpu'], _megabytes(row['peak_rss']),
+                row['calls']))
+        lines.append('')
+        lines.append('{:<48} {:>10} {:>10} {:>9} {:>6}'.format(
+            'Tool', 'Wall (s)', 'CPU (s)', 'Peak MB', 'Calls'))
+        for name, row in sorted(tools.items(), key=lambda item: -item[1]['wall']):
+            lines.append('{:<48} {:>10.1f} {:>10.1f} {:>9} {:>6}'.format(
+                name, row['wall'], row['cpu'], _megabytes(row['peak_rss']),
+                row['calls']))
+        slowest = sorted((event for event in self.events
+                          if event['kind'] in ('section', 'call')),
+                         key=lambda event: -event['wall'])[:top]
+        if slowest:
+            lines.append('')
+            lines.append('Slowest sections and calls:')
+        for event in slowest:
+            inputs = ', '.join('{} ({} features{})'.format(
+                os.path.basename(measures['path']), measures['features'],
+                ', {} vertices'.format(measures['vertices'])
+                if 'vertices' in measures else '')
+                for measures in event.get('inputs', []))
+            lines.append('  {:>10.1f}s  {}  [{}]{}'.format(
+                event['wall'], event['name'], event['section'] or event['stage'],
+                '  ' + inputs if inputs else ''))
+        return lines
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+KD-tree point index for bulk nearest neighbour and distance queries.
+
+Builds a KD-tree over site or survey centroids (or any [X, Y] points) and
+answers whole arrays of queries at once - which sites are nearest each of
+these surveys, what is within a mile of each site, every pair of sites
+closer than 100 m - without the O(n**2) p1p2Dist loops or a
+SelectLayerByLocation per feature:
+
+    sites = PointIndex.from_features(r'C:\\data\\sites.gdb\\Sites')
+    dist, idx = sites.nearest(survey_xy, k=5)
+    site_oids = sites.ids[idx]       # idx is -1 past the last point if k > N
+    offsets, idx, dist = sites.within(survey_xy, 1609.344)
+    i, j, dist = sites.pairs(100.0)
+
+The tree is stored as flat arrays and queries walk it with the whole set
+of query points at each node, so the Python loop runs once per tree node
+visited, not once per query.  Distances are planar, in the units of the
+coordinates.  distance_matrix and azimuth_matrix are the vectorized
+p1p2Dist and p1p2Azimuth.
+"""
+
+from __future__ import division
+import numpy as np
+
+
+LEAF_SIZE = 32
+
+# p1p2Azimuth returns this for coincident points
+NO_AZIMUTH = -9999.99
+
+
+# Functions
+def distance_matrix(a, b):
+    """Returns the (len(a), len(b)) planar distances between two sets of
+       [X, Y] points - p1p2Dist for every pair"""
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+    return np.hypot(b[None, :, 0] - a[:, None, 0],
+                    b[None, :, 1] - a[:, None, 1])
+
+
+def azimuth_matrix(a, b):
+    """
+    Returns the (len(a), len(b)) azimuths from each point of a to each
+    point of b, 0 to 360 clockwise from north - p1p2Azimuth for every pair,
+    with NO_AZIMUTH (-9999.99) where the points coincide
+    """
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+    dx = b[None, :, 0] - a[:, None, 0]
+    dy = b[None, :, 1] - a[:, None, 1]
+    azimuth = np.mod(90.0 - np.degrees(np.arctan2(dy, dx)) + 360.0, 360.0)
+    azimuth[(dx == 0) & (dy == 0)] = NO_AZIMUTH
+    return azimuth
+
+
+def _sq_dist(queries, pnts):
+    """Squared distances, (len(queries), len(pnts))"""
+    dx = pnts[None, :, 0] - queries[:, None, 0]
+    dy = pnts[None, :, 1] - queries[:, None, 1]
+    return dx * dx + dy * dy
+
+
+class PointIndex(object):
+    """
+    A static KD-tree over N points.  Nodes split the wider side of their
+    bounding box at the median, so every subtree holds a contiguous run
+    of self.perm and leaves hold at most leaf_size points.
+
+    xy        - (N, 2) coordinates
+    ids       - optional id per point (OIDs), kept as self.ids
+    """
+
+    def __init__(self, xy, ids=None, leaf_size=LEAF_SIZE):
+        self.xy = np.ascontiguousarray(xy, dtype=np.float64).reshape(-1, 2)
+        n = len(self.xy)
+        if ids is None:
+            ids = np.arange(n)
+        self.ids = np.asarray(ids)
+        if len(self.ids) != n:
+            raise ValueError("ids must have one value per point")
+        self.leaf_size = max(1, int(leaf_size))
+        self._build()
+
+    @classmethod
+    def from_features(cls, in_fc, where_clause=None, spatial_reference=None,
+                      leaf_size=LEAF_SIZE):
+        """Indexes the centroids (SHAPE@XY) of a feature class or layer,
+           with the OIDs as ids"""
+        import arcpy
+        pnts = arcpy.da.FeatureClassToNumPyArray(
+            in_fc, ['OID@', 'SHAPE@XY'], where_clause, spatial_reference,
+            skip_nulls=True)
+        return cls(pnts['SHAPE@XY'], pnts['OID@'], leaf_size)
+
+    def __len__(self):
+        return len(self.xy)
+
+    def _build(self):
+        """Splits nodes until every leaf holds at most leaf_size points"""
+        n = len(self.xy)
+        perm = np.arange(n)
+        start = []; stop = []; bbox = []
+        left = []; right = []; axis = []; split = []
+        # (start, stop, parent, side) - side 0 is the left child
+        todo = [(0, n, -1, 0)] if n else []
+        while todo:
+            s, e, parent, side = todo.pop()
+            node = len(start)
+            if parent >= 0:
+                (right if side else left)[parent] = node
+            pnts = self.xy[perm[s:e]]
+            lo = pnts.min(axis=0); hi = pnts.max(axis=0)
+            start.append(s); stop.append(e)
+            bbox.append((lo[0], lo[1], hi[0], hi[1]))
+            left.append(-1); right.append(-1); axis.append(0); split.append(0.0)
+            if e - s <= self.leaf_size or (lo == hi).all():
+                continue
+            ax = 0 if hi[0] - lo[0] >= hi[1] - lo[1] else 1
+            m = (s + e) // 2
+            order = np.argpartition(pnts[:, ax], m - s)
+            perm[s:e] = perm[s:e][order]
+            axis[node] = ax
+            split[node] = self.xy[perm[m], ax]
+            todo.append((m, e, node, 1))
+            todo.append((s, m, node, 0))
+        self.perm = perm
+        self._start = np.array(start, dtype=np.int64)
+        self._stop = np.array(stop, dtype=np.int64)
+        self._bbox = np.array(bbox, dtype=np.float64).reshape(-1, 4)
+        self._left = np.array(left, dtype=np.int64)
+        self._right = np.array(right, dtype=np.int64)
+        self._axis = np.array(axis, dtype=np.int64)
+        self._split = np.array(split, dtype=np.float64)
+
+    def _min_sq_dist(self, queries, node):
+        """Squared distance from each query to the node's bounding box"""
+        x0, y0, x1, y1 = self._bbox[node]
+        dx = np.maximum(np.maximum(x0 - queries[:, 0], queries[:, 0] - x1), 0.0)
+        dy = np.maximum(np.maximum(y0 - queries[:, 1], queries[:, 1] - y1), 0.0)
+        return dx * dx + dy * dy
+
+    def _home_nodes(self, queries, k):
+        """The deepest node on each query's path holding at least k points"""
+        cur = np.zeros(len(queries), dtype=np.int64)
+        rows = np.arange(len(queries))
+        while True:
+            internal = self._left[cur] >= 0
+            if not internal.any():
+                break
+            side = queries[rows, self._axis[cur]] < self._split[cur]
+            child = np.where(side, self._left[cur], self._right[cur])
+            child = np.where(internal, child, cur)
+            go = internal & (self._stop[child] - self._start[child] >= k)
+            if not go.any():
+                break
+            cur = np.where(go, child, cur)
+        return cur
+
+    def _merge(self, best_d, best_i, qs, d, idx, k):
+        """Keeps the k smallest of the current and new candidates"""
+        cand_d = np.hstack((best_d[qs], d))
+        cand_i = np.hstack((best_i[qs], np.tile(idx, (len(qs), 1))))
+        if cand_d.shape[1] > k:
+            keep = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+            rows = np.arange(len(qs))[:, None]
+            cand_d = cand_d[rows, keep]
+            cand_i = cand_i[rows, keep]
+        best_d[qs] = cand_d
+        best_i[qs] = cand_i
+
+    def nearest(self, queries, k=1):
+        """
+        Returns (dist, idx), both (len(queries), k) and sorted nearest
+        first.  idx are positions in the indexed points (self.ids[idx]
+        for the ids); when there are fewer than k points the rest of each
+        row is inf and -1.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float64).reshape(-1, 2)
+        nq = len(queries)
+        k = int(k)
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        best_d = np.full((nq, k), np.inf)
+        best_i = np.full((nq, k), -1, dtype=np.int64)
+        if nq == 0 or len(self) == 0:
+            return best_d, best_i
+
+        # Start from every point of the query's home node - a bound on the
+        # kth distance before the tree is searched
+        home = self._home_nodes(queries, k)
+        order = np.argsort(home, kind='mergesort')
+        bounds = np.flatnonzero(np.concatenate(([True],
+                                                home[order][1:] != home[order][:-1])))
+        for first, last in zip(bounds, np.append(bounds[1:], nq)):
+            qs = order[first:last]
+            node = home[qs[0]]
+            idx = self.perm[self._start[node]:self._stop[node]]
+            self._merge(best_d, best_i, qs,
+                        _sq_dist(queries[qs], self.xy[idx]), idx, k)
+
+        # Then visit only the nodes that could beat the bound and are not
+        # already covered by the home node
+        home_start = self._start[home]
+        home_stop = self._stop[home]
+        stack = [(0, np.arange(nq))]
+        while stack:
+            node, qs = stack.pop()
+            s, e = self._start[node], self._stop[node]
+            bound = best_d[qs].max(axis=1)
+            near = self._min_sq_dist(queries[qs], node) < bound
+            near &= ~((home_start[qs] <= s) & (home_stop[qs] >= e))
+            qs = qs[near]
+            if len(qs) == 0:
+                continue
+            if self._left[node] < 0:
+                idx = self.perm[s:e]
+                self._merge(best_d, best_i, qs,
+                            _sq_dist(queries[qs], self.xy[idx]), idx, k)
+            else:
+                stack.append((self._right[node], qs))
+                stack.append((self._left[node], qs))
+
+        rows = np.arange(nq)[:, None]
+        order = np.argsort(best_d, axis=1, kind='mergesort')
+        return np.sqrt(best_d[rows, order]), best_i[rows, order]
+
+    def _radius_pairs(self, queries, radius):
+        """Yields (query positions, point positions, squared distances)
+           chunks for every pair within radius"""
+        r2 = float(radius) ** 2
+        stack = [(0, np.arange(len(queries)))] if len(self) else []
+        while stack:
+            node, qs = stack.pop()
+            qs = qs[self._min_sq_dist(queries[qs], node) <= r2]
+            if len(qs) == 0:
+                continue
+            if self._left[node] < 0:
+                idx = self.perm[self._start[node]:self._stop[node]]
+                d = _sq_dist(queries[qs], self.xy[idx])
+                qi, pi = np.nonzero(d <= r2)
+                if len(qi):
+                    yield qs[qi], idx[pi], d[qi, pi]
+            else:
+                stack.append((self._right[node], qs))
+                stack.append((self._left[node], qs))
+
+    def within(self, queries, radius):
+        """
+        Returns (offsets, idx, dist) - ragged arrays of every point within
+        radius of each query, nearest first, where the matches of query q
+        are idx[offsets[q]:offsets[q+1]]
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float64).reshape(-1, 2)
+        chunks = list(self._radius_pairs(queries, radius))
+        if chunks:
+            qi = np.concatenate([chunk[0] for chunk in chunks])
+            pi = np.concatenate([chunk[1] for chunk in chunks])
+            d2 = np.concatenate([chunk[2] for chunk in chunks])
+        else:
+            qi = pi = np.zeros(0, dtype=np.int64)
+            d2 = np.zeros(0)
+        order = np.lexsort((pi, d2, qi))
+        offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(qi, minlength=len(queries)), out=offsets[1:])
+        return offsets, pi[order], np.sqrt(d2[order])
+
+    def pairs(self, radius):
+        """
+        Returns (i, j, dist) for every pair of indexed points with i < j
+        no more than radius apart, sorted by i then j
+        """
+        chunks = [(qi, pi, d2) for qi, pi, d2 in
+                  self._radius_pairs(self.xy, radius)]
+        if not chunks:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        i = np.concatenate([chunk[0] for chunk in chunks])
+        j = np.concatenate([chunk[1] for chunk in chunks])
+        d2 = np.concatenate([chunk[2] for chunk in chunks])
+        keep = i < j
+        i, j, d2 = i[keep], j[keep], d2[keep]
+        order = np.lexsort((j, i))
+        return i[order], j[order], np.sqrt(d2[order])
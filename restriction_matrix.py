@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Restriction membership matrix for the Use Restrictions and NSO/CSU tools.
+
+The aggregate polygons come out of a Union of every dissolved criterion
+(plus the analysis area) run with join_attributes="ONLY_FID".  That union
+already records which inputs each piece came from - one FID_<input> field
+per input, -1 where the piece is outside it - so membership in a criterion
+is a field test, not a SelectLayerByLocation WITHIN per criterion:
+
+    arcpy.Union_analysis(inputs, union, "ONLY_FID")
+    lineage = lineage_fields(union, inputs)
+    ...
+    criteria = [(code, lineage[fc]) for code, fc in ...]
+    acre_field, tallies = populate_matrix(aggregate, criteria)
+
+populate_matrix stores the membership of each polygon as an integer
+bitmask - bit i of the CRITERIA field is criterion i, see code_table - and
+derives everything else from the masks with array operations: the acres of
+each criterion, of the whole analysis area and of the marked-up area, and
+the Summary string, which is built once per distinct combination of
+criteria rather than once per row.  Everything is written back in a single
+UpdateCursor sweep.  compact=True writes only the mask (and the acres) -
+the per-criterion text columns and the Summary are dropped and the code
+table is the key to the mask:
+
+    write_code_table(codes_table, [code for code, field in criteria])
+
+Zone breakdowns (the Alternative D ecoregions) come from one intersect of
+the markup with the zones and one cursor pass over it - zone_matrix tallies
+the total, restricted and per-criterion acres of every zone from the masks,
+write_zone_table writes them out and export_zones writes per-zone feature
+classes only when they are wanted.
+"""
+
+from __future__ import division
+import collections
+import numpy as np
+
+import acreage
+
+
+# Membership bitmask - LONG fields are signed, so 31 criteria per field and
+# CRITERIA2, CRITERIA3... when there are more
+MASK_FIELD = 'CRITERIA'
+MASK_BITS = 31
+
+SUMMARY_FIELD = 'Summary'
+
+
+# Functions
+def lineage_fields(union_fc, inputs):
+    """
+    Returns an OrderedDict of input: FID_ field for the output of a Union
+    run with join_attributes="ONLY_FID" - Union writes one FID_ field per
+    input, in input order (the names are truncated or suffixed when the
+    inputs share a name, so they are matched by position)
+    """
+    import arcpy
+    fields = [field.name for field in arcpy.ListFields(union_fc)
+              if field.name.upper().startswith('FID_')]
+    if len(fields) != len(inputs):
+        raise ValueError("{} has {} FID_ fields for {} inputs - was the union "
+                         "run with ONLY_FID?".format(union_fc, len(fields),
+                                                     len(inputs)))
+    return collections.OrderedDict(zip(inputs, fields))
+
+
+def mask_fields(ncriteria):
+    """Returns the names of the LONG mask fields for ncriteria criteria"""
+    nword = max(1, -(-ncriteria // MASK_BITS))
+    if nword == 1:
+        return [MASK_FIELD]
+    return [MASK_FIELD] + [MASK_FIELD + str(i + 1) for i in range(1, nword)]
+
+
+def code_table(codes):
+    """
+    Returns a structured array with one row per criterion code - the mask
+    field holding it, its bit and the value of that bit - the key to the
+    CRITERIA masks
+    """
+    fields = mask_fields(len(codes))
+    width = max([len(code) for code in codes] + [1])
+    table = np.zeros(len(codes), dtype=[('CODE', 'U{}'.format(width)),
+                                        ('MASK_FIELD', 'U{}'.format(
+                                            max(len(f) for f in fields))),
+                                        ('BIT', np.int32),
+                                        ('BIT_VALUE', np.int32)])
+    for i, code in enumerate(codes):
+        table[i] = (code, fields[i // MASK_BITS], i % MASK_BITS,
+                    1 << (i % MASK_BITS))
+    return table
+
+
+def pack_masks(member):
+    """
+    Packs an (N, ncriteria) boolean membership array into (N, nword)
+    int32 masks, MASK_BITS criteria per word
+    """
+    member = np.asarray(member, dtype=bool)
+    n, ncriteria = member.shape
+    nword = len(mask_fields(ncriteria))
+    masks = np.zeros((n, nword), dtype=np.int64)
+    for word in range(nword):
+        bits = member[:, word * MASK_BITS:(word + 1) * MASK_BITS]
+        weights = np.left_shift(1, np.arange(bits.shape[1], dtype=np.int64))
+        masks[:, word] = np.dot(bits.astype(np.int64), weights)
+    return masks.astype(np.int32)
+
+
+def unpack_masks(masks, ncriteria):
+    """Returns the (N, ncriteria) boolean membership held in masks"""
+    masks = np.asarray(masks, dtype=np.int64).reshape(-1, len(
+        mask_fields(ncriteria)))
+    i = np.arange(ncriteria)
+    return (np.right_shift(masks[:, i // MASK_BITS], i % MASK_BITS) & 1) == 1
+
+
+def criteria_acres(masks, acres, ncriteria):
+    """Returns the acres within each criterion - one matrix product"""
+    member = unpack_masks(masks, ncriteria)
+    return np.dot(np.asarray(acres, dtype=np.float64), member)
+
+
+def mask_groups(masks):
+    """
+    Returns (unique, inverse) - the distinct rows of masks and the index
+    of each row's combination, so per-combination values are computed once
+    and spread back with values[inverse]
+    """
+    masks = np.ascontiguousarray(masks, dtype=np.int32)
+    if len(masks) == 0:
+        return masks, np.zeros(0, dtype=np.int64)
+    rows = masks.view(np.dtype((np.void, masks.dtype.itemsize * masks.shape[1])))
+    keys, first, inverse = np.unique(rows.ravel(), return_index=True,
+                                     return_inverse=True)
+    return masks[first], inverse
+
+
+def summaries(masks, codes):
+    """
+    Returns the Summary string of every row of masks - the codes of its
+    criteria, space separated, in criteria order ('' when there are none)
+    """
+    unique, inverse = mask_groups(masks)
+    member = unpack_masks(unique, len(codes))
+    labels = [' '.join(code for code, bit in zip(codes, row) if bit)
+              for row in member]
+    return [labels[i] for i in inverse]
+
+
+def marked_clause(ncriteria):
+    """Where clause selecting the polygons within at least one criterion"""
+    return ' OR '.join('"{}" <> 0'.format(field)
+                       for field in mask_fields(ncriteria))
+
+
+def write_code_table(out_table, codes, acres=None):
+    """
+    Writes the code table of codes to out_table, with an ACRES column when
+    the per-criterion acres are given.  Returns out_table
+    """
+    import arcpy
+    from numpy.lib import recfunctions
+    table = code_table(codes)
+    if acres is not None:
+        table = recfunctions.append_fields(
+            table, 'ACRES', np.asarray(acres, dtype=np.float64),
+            usemask=False)
+    if arcpy.Exists(out_table):
+        arcpy.Delete_management(out_table)
+    arcpy.da.NumPyArrayToTable(table, out_table)
+    return out_table
+
+
+def populate_matrix(in_fc, criteria, field_length=20, compact=False):
+    """
+    Adds the CRITERIA mask field(s) and, unless compact, a text field for
+    every (code, lineage field) in criteria and the Summary field.  One
+    read gathers the geometry and the lineage, the masks, acres and
+    Summary strings are computed as arrays, and one UpdateCursor pass
+    writes them.  Returns (acre_field, tallies) where tallies holds
+        'criteria'  OrderedDict of code: acres, in criteria order
+        'total'     acres of every polygon
+        'markup'    acres of the polygons in at least one criterion
+    """
+    import arcpy
+    acre_field = acreage.find_acre_field(in_fc)
+    codes = [code for code, lineage in criteria]
+    lineage = [field for code, field in criteria]
+    masks_out = mask_fields(len(codes))
+    for field in masks_out:
+        arcpy.AddField_management(in_fc, field, "LONG")
+    text_out = []
+    if not compact:
+        for code in codes:
+            arcpy.AddField_management(in_fc, code, "Text", field_length=field_length)
+        arcpy.AddField_management(in_fc, SUMMARY_FIELD, "Text", field_length=255)
+        text_out = codes + [SUMMARY_FIELD]
+
+    measures = acreage.measure_features(in_fc, lineage)
+    area = measures['area']
+    member = np.zeros((len(area), len(codes)), dtype=bool)
+    for i, field in enumerate(lineage):
+        fids = np.array([-1 if fid is None else fid
+                         for fid in measures[field]], dtype=np.int64)
+        member[:, i] = fids >= 0
+    masks = pack_masks(member)
+
+    # The text columns only depend on the combination of criteria
+    unique, inverse = mask_groups(masks)
+    text_rows = []
+    if not compact:
+        for row in unpack_masks(unique, len(codes)):
+            values = [code if bit else '' for code, bit in zip(codes, row)]
+            values.append(' '.join(value for value in values if value))
+            text_rows.append(values)
+    position = dict((oid, i) for i, oid in
+                    enumerate(measures['oid'].tolist()))
+    mask_rows = masks.tolist()
+    inverse = inverse.tolist()
+    acres = area.tolist()
+
+    fields = ['OID@', acre_field] + masks_out + text_out
+    with arcpy.da.UpdateCursor(in_fc, fields) as cur:
+        for row in cur:
+            i = position[row[0]]
+            values = [row[0], acres[i]] + mask_rows[i]
+            if text_rows:
+                values += text_rows[inverse[i]]
+            cur.updateRow(values)
+
+    return acre_field, _tallies(codes, masks, area)
+
+
+def _tallies(codes, masks, area):
+    """The criteria, total and markup acres of a matrix"""
+    marked = masks.any(axis=1)
+    return {'criteria': collections.OrderedDict(
+                zip(codes, criteria_acres(masks, area, len(codes)).tolist())),
+            'total': float(area.sum()),
+            'markup': float(area[marked].sum())}
+
+
+def tally_matrix(in_fc, codes):
+    """
+    Rewrites the acres of a matrix that already has its CRITERIA masks -
+    after its polygons were reshaped, as when tiles are stitched - and
+    returns (acre_field, tallies) like populate_matrix
+    """
+    import arcpy
+    acre_field = acreage.find_acre_field(in_fc)
+    masks_out = mask_fields(len(codes))
+    measures = acreage.measure_features(in_fc, masks_out)
+    area = measures['area']
+    masks = np.zeros((len(area), len(masks_out)), dtype=np.int32)
+    for i, field in enumerate(masks_out):
+        masks[:, i] = [mask or 0 for mask in measures[field]]
+    acres = dict(zip(measures['oid'].tolist(), area.tolist()))
+    with arcpy.da.UpdateCursor(in_fc, ['OID@', acre_field]) as cur:
+        for oid, value in cur:
+            cur.updateRow([oid, acres.get(oid)])
+    return acre_field, _tallies(codes, masks, area)
+
+
+def zone_matrix(markup_fc, zones_fc, zone_field, codes, out_fc):
+    """
+    Intersects the markup with the zones (ecoregions) once into out_fc and
+    tallies it by zone in a single UpdateCursor pass, which also rewrites
+    the acres of the intersected pieces.  Returns an OrderedDict of zone:
+    {'total', 'markup', 'criteria' OrderedDict of code: acres}, in sorted
+    zone order - replaces a Split_analysis and a selection per zone
+    """
+    import arcpy
+    if arcpy.Exists(out_fc):
+        arcpy.Delete_management(out_fc)
+    arcpy.Intersect_analysis([markup_fc, zones_fc], out_fc, "NO_FID")
+    spatial_reference = arcpy.Describe(out_fc).spatialReference
+    if spatial_reference.type == 'Geographic':
+        raise ValueError("{} is in geographic coordinates - zone acres need "
+                         "a projected coordinate system".format(out_fc))
+    to_acres = spatial_reference.metersPerUnit**2 / acreage.AREA_UNITS['ACRES']
+    acre_field = acreage.find_acre_field(out_fc)
+    masks_in = mask_fields(len(codes))
+
+    areas = []
+    zones = []
+    masks = []
+    with arcpy.da.UpdateCursor(out_fc, ['SHAPE@AREA', acre_field, zone_field]
+                               + masks_in) as cur:
+        for row in cur:
+            acres = (row[0] or 0.0) * to_acres
+            cur.updateRow([row[0], acres] + list(row[2:]))
+            areas.append(acres)
+            zones.append(str(row[2]))
+            masks.append([mask or 0 for mask in row[3:]])
+
+    tallies = collections.OrderedDict()
+    if not areas:
+        return tallies
+    area = np.array(areas, dtype=np.float64)
+    masks = np.array(masks, dtype=np.int32).reshape(len(area), len(masks_in))
+    names, inverse = np.unique(np.array(zones), return_inverse=True)
+    marked = masks.any(axis=1)
+    total = np.bincount(inverse, weights=area, minlength=len(names))
+    markup = np.bincount(inverse, weights=area * marked, minlength=len(names))
+    member = unpack_masks(masks, len(codes))
+    by_zone = np.zeros((len(names), len(codes)))
+    np.add.at(by_zone, inverse, member * area[:, np.newaxis])
+    for i, name in enumerate(names.tolist()):
+        tallies[name] = {'total': float(total[i]), 'markup': float(markup[i]),
+                         'criteria': collections.OrderedDict(
+                             zip(codes, by_zone[i].tolist()))}
+    return tallies
+
+
+def write_zone_table(out_table, tallies, codes):
+    """
+    Writes the zone tallies of zone_matrix to out_table - one row per zone
+    with its total, restricted and unrestricted acres and the acres of
+    every criterion.  Returns out_table
+    """
+    import arcpy
+    width = max([len(zone) for zone in tallies] + [1])
+    table = np.zeros(len(tallies), dtype=[('ZONE', 'U{}'.format(width)),
+                                          ('TOTAL_ACRES', np.float64),
+                                          ('RESTRICTED_ACRES', np.float64),
+                                          ('UNRESTRICTED_ACRES', np.float64)]
+                     + [(str(code), np.float64) for code in codes])
+    for i, (zone, tally) in enumerate(tallies.items()):
+        table[i] = ((zone, tally['total'], tally['markup'],
+                     tally['total'] - tally['markup'])
+                    + tuple(tally['criteria'].values()))
+    if arcpy.Exists(out_table):
+        arcpy.Delete_management(out_table)
+    arcpy.da.NumPyArrayToTable(table, out_table)
+    return out_table
+
+
+def export_zones(zone_fc, zone_field, zones, out_workspace, prefix):
+    """
+    Writes a feature class per zone from the intersected markup of
+    zone_matrix - only for the zones asked for.  Returns the paths
+    """
+    import arcpy
+    field = arcpy.AddFieldDelimiters(zone_fc, zone_field)
+    text = arcpy.ListFields(zone_fc, zone_field)[0].type == 'String'
+    paths = []
+    for zone in zones:
+        out_fc = out_workspace + "\\" + arcpy.ValidateTableName(prefix + zone, out_workspace)
+        if arcpy.Exists(out_fc):
+            arcpy.Delete_management(out_fc)
+        value = "'{}'".format(zone.replace("'", "''")) if text else zone
+        arcpy.Select_analysis(zone_fc, out_fc, "{} = {}".format(field, value))
+        paths.append(out_fc)
+    return paths
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Raster estimate of the Use Restrictions and NSO/CSU acreages.
+
+For quick acreage figures per alternative, without the union and matrix:
+the analysis area and every dissolved criterion are rasterized to one
+shared grid (cell centers, at a chosen cell size) and each is kept as a
+packed bit plane - one bit per cell, eight cells to a byte:
+
+    estimate = raster_estimate(analysis_area, criteria_fcs, 30.0)
+    estimate['criteria']['NSO_WL']      # acres
+    estimate['bounds']['NSO_WL']        # +/- acres against the vector result
+
+Per-criterion acres are popcounts of (criterion & analysis area), the
+restricted acres a popcount of the OR of every plane, and ecoregion (or any
+zone) breakdowns a bincount of the zone index of the restricted cells.
+
+Error bound: a cell can only be counted differently from the vector answer
+if a polygon boundary crosses it.  A boundary of length P crosses at most
+sqrt(2) * P / cell + 4 cells per part, so each criterion is within
+(sqrt(2) * P / cell + 4 * parts) cell areas of its vector acres, P being
+the perimeter of the criterion and of the analysis area.  The bound is
+conservative - the real error is usually a small fraction of it, since
+boundary cells are gained and lost about equally.
+"""
+
+from __future__ import division
+import collections
+import csv
+import math
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import acreage
+
+
+# Set bits per byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# Functions
+def pack_plane(member):
+    """Packs a boolean grid into a flat uint8 bit plane"""
+    return np.packbits(np.asarray(member, dtype=bool).ravel())
+
+
+def unpack_plane(plane, ncell):
+    """Returns the flat boolean cells of a bit plane"""
+    return np.unpackbits(plane)[:ncell].astype(bool)
+
+
+def popcount(plane):
+    """Number of set cells in a bit plane"""
+    return int(_POPCOUNT[plane].sum(dtype=np.int64))
+
+
+def plane_tallies(area_plane, planes, codes, cell_acres):
+    """
+    Returns tallies like restriction_matrix.populate_matrix - the acres of
+    each criterion plane, of the analysis area and of the restricted area
+    (the OR of every plane), all inside area_plane
+    """
+    restricted = np.zeros_like(area_plane)
+    criteria = collections.OrderedDict()
+    for code, plane in zip(codes, planes):
+        inside = plane & area_plane
+        criteria[code] = popcount(inside) * cell_acres
+        restricted |= inside
+    return {'criteria': criteria,
+            'total': popcount(area_plane) * cell_acres,
+            'markup': popcount(restricted) * cell_acres,
+            'restricted': restricted}
+
+
+def zone_totals(plane, zones, names, cell_acres):
+    """
+    Returns an OrderedDict of zone name: acres of the set cells of plane,
+    where zones is the flat zone index of every cell (-1 outside every
+    zone) - one bincount
+    """
+    cells = unpack_plane(plane, len(zones)) & (zones >= 0)
+    counts = np.bincount(zones[cells], minlength=len(names))
+    return collections.OrderedDict(
+        (name, count * cell_acres) for name, count in zip(names, counts.tolist()))
+
+
+def error_bound(perimeter, parts, cell, cell_acres):
+    """Largest possible difference from the vector acres, in acres, for
+       boundaries of total length perimeter (in the cell units)"""
+    return (math.sqrt(2) * perimeter / cell + 4 * parts) * cell_acres
+
+
+def grid_spec(analysis_area, cell_size):
+    """
+    Returns the shared grid (xmin, ymin, ncols, nrows, cell) - the analysis
+    area extent grown to whole cells
+    """
+    import arcpy
+    e = arcpy.Describe(analysis_area).extent
+    cell = float(cell_size)
+    ncols = max(1, int(math.ceil((e.XMax - e.XMin) / cell)))
+    nrows = max(1, int(math.ceil((e.YMax - e.YMin) / cell)))
+    return e.XMin, e.YMin, ncols, nrows, cell
+
+
+def rasterize(in_fc, grid, scratch_folder):
+    """
+    Rasterizes in_fc to the grid by cell center and returns the (nrows,
+    ncols) OIDs of the polygon over each cell, -1 where there is none
+    (shapefile FIDs start at 0)
+    """
+    import arcpy
+    xmin, ymin, ncols, nrows, cell = grid
+    out_raster = os.path.join(scratch_folder, 'r{}.tif'.format(
+        len(os.listdir(scratch_folder))))
+    oid_field = arcpy.Describe(in_fc).OIDFieldName
+    extent = arcpy.env.extent
+    arcpy.env.extent = arcpy.Extent(xmin, ymin, xmin + ncols * cell,
+                                    ymin + nrows * cell)
+    try:
+        arcpy.PolygonToRaster_conversion(in_fc, oid_field, out_raster,
+                                         "CELL_CENTER", "", cell)
+    finally:
+        arcpy.env.extent = extent
+    values = arcpy.RasterToNumPyArray(out_raster, arcpy.Point(xmin, ymin),
+                                      ncols, nrows, -1)
+    arcpy.Delete_management(out_raster)
+    return values
+
+
+def raster_estimate(analysis_area, criteria_fcs, cell_size, zones_fc=None,
+                    zone_field=None, log=None):
+    """
+    Estimates the acres of every (code, feature class) criterion within
+    analysis_area on a grid of cell_size (in the analysis area's units).
+    Returns tallies like restriction_matrix.populate_matrix plus
+        'bounds'   OrderedDict of code: +/- acres, and 'markup' and 'total'
+        'zones'    OrderedDict of zone: restricted acres, when zones_fc
+                   and zone_field are given
+        'cell'     the cell size
+    """
+    import arcpy
+    log = log or (lambda message: None)
+    sr = arcpy.Describe(analysis_area).spatialReference
+    meters = sr.metersPerUnit
+    grid = grid_spec(analysis_area, cell_size)
+    xmin, ymin, ncols, nrows, cell = grid
+    cell_acres = (cell * meters)**2 / acreage.AREA_UNITS['ACRES']
+    log('      Raster grid {} x {} cells of {}'.format(ncols, nrows, cell))
+
+    def outline(fc):
+        measures = acreage.measure_features(fc, length_unit='METERS')
+        return float(measures['perimeter'].sum()) / meters, len(measures['oid'])
+
+    scratch_folder = tempfile.mkdtemp(prefix='raster_')
+    output_sr = arcpy.env.outputCoordinateSystem
+    arcpy.env.outputCoordinateSystem = sr
+    try:
+        area_plane = pack_plane(rasterize(analysis_area, grid, scratch_folder) >= 0)
+        area_perimeter, area_parts = outline(analysis_area)
+        codes = []
+        planes = []
+        bounds = collections.OrderedDict()
+        all_perimeter, all_parts = area_perimeter, area_parts
+        for code, fc in criteria_fcs:
+            planes.append(pack_plane(rasterize(fc, grid, scratch_folder) >= 0))
+            codes.append(code)
+            perimeter, parts = outline(fc)
+            bounds[code] = error_bound(perimeter + area_perimeter,
+                                       parts + area_parts, cell, cell_acres)
+            all_perimeter += perimeter
+            all_parts += parts
+            log('      Rasterized {}'.format(code))
+        tallies = plane_tallies(area_plane, planes, codes, cell_acres)
+
+        bounds['total'] = error_bound(area_perimeter, area_parts, cell,
+                                      cell_acres)
+        # The restricted area's boundary is made of the criteria boundaries
+        bounds['markup'] = error_bound(all_perimeter, all_parts, cell,
+                                       cell_acres)
+        tallies['bounds'] = bounds
+        tallies['cell'] = cell
+
+        if zones_fc and zone_field:
+            zone_oids = rasterize(zones_fc, grid, scratch_folder).ravel()
+            with arcpy.da.SearchCursor(zones_fc, ['OID@', zone_field]) as cur:
+                zone_names = dict((oid, str(name)) for oid, name in cur)
+            names = sorted(set(zone_names.values()))
+            index = dict((name, i) for i, name in enumerate(names))
+            lookup = np.full(max(zone_names.keys() or [0]) + 1, -1,
+                             dtype=np.int64)
+            for oid, name in zone_names.items():
+                lookup[oid] = index[name]
+            zones = np.where(zone_oids >= 0,
+                             lookup[np.maximum(zone_oids, 0)], -1)
+            tallies['zones'] = zone_totals(tallies['restricted'], zones,
+                                           names, cell_acres)
+    finally:
+        arcpy.env.outputCoordinateSystem = output_sr
+        shutil.rmtree(scratch_folder, ignore_errors=True)
+    del tallies['restricted']
+    return tallies
+
+
+def write_estimate_csv(out_csv, analysis_id, estimate):
+    """Writes a raster estimate to out_csv in the layout of the tools'
+       acreage reports, with the error bound of every figure"""
+    total = estimate['total']
+    with open(out_csv, 'wb') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(["Raster Estimate - Cell Size", estimate['cell']])
+        csvwriter.writerow(["Total Analysis Acres", round(total, 2),
+                            "+/-", round(estimate['bounds']['total'], 2)])
+        csvwriter.writerow(["", ""])
+        csvwriter.writerow(['Criteria', analysis_id+"_Raw_Acres",
+                            analysis_id+"_Rounded_Acres", "Raw_Percent",
+                            "Error_Bound_Acres"])
+        for code, acres in sorted(estimate['criteria'].items()):
+            csvwriter.writerow([code, round(acres, 2), round(acres, -2),
+                                (acres/total)*100 if total else 0.0,
+                                round(estimate['bounds'][code], 2)])
+        csvwriter.writerow(["", ""])
+        markup = estimate['markup']
+        csvwriter.writerow(["Total "+analysis_id+" Acres", round(markup, 2),
+                            round(markup, -2),
+                            (markup/total)*100 if total else 0.0,
+                            round(estimate['bounds']['markup'], 2)])
+        if estimate.get('zones'):
+            csvwriter.writerow(["", ""])
+            csvwriter.writerow(['Ecoregion', "Raw_Acres", "Rounded_Acres"])
+            for zone, acres in estimate['zones'].items():
+                csvwriter.writerow([zone, round(acres, 2), round(acres, -2)])
+    return out_csv
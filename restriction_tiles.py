@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled overlay of the Use Restrictions and NSO/CSU criteria.
+
+The aggregate Union of every criterion with the whole planning area is the
+most expensive and memory hungry call in those tools - it can run the
+in_memory workspace out of room.  tiled_overlay cuts the analysis area into
+tiles and runs the clip, union and matrix for each tile on its own, on a
+pool of worker processes, so peak memory follows the size of a tile rather
+than the planning area:
+
+    tiles, extent = make_tiles('QUADTREE', analysis_area, criteria_fcs)
+    acre_field, tallies = tiled_overlay(analysis_area, criteria_fcs,
+                                        aggregate, tiles, extent,
+                                        scratch_folder, workers=4)
+
+Tiles are either an n x n grid over the analysis area extent or a quadtree
+split until no tile holds more than MAX_TILE_VERTICES criteria vertices -
+dense areas get small tiles, empty range gets big ones.  Neighbouring tiles
+share their edges exactly, so no area is lost or counted twice.
+
+Stitching: the tile outputs are merged and the pieces cut by a seam (an
+inner tile edge) are dissolved back together on the criteria fields, one
+polygon per piece of matrix again.  The acres are then measured on the
+stitched polygons and logged beside the tile tallies and the analysis
+area itself as a check - the differences should be rounding.
+"""
+
+from __future__ import division
+import multiprocessing
+import os
+import numpy as np
+
+import acreage
+import restriction_matrix
+import mp_setup
+from scratch_workspace import ScratchWorkspace
+
+
+TILING_OPTIONS = ['NONE', 'GRID 2x2', 'GRID 4x4', 'GRID 8x8', 'QUADTREE']
+
+MAX_TILE_VERTICES = 250000
+MAX_DEPTH = 6
+
+
+# Functions
+def grid_tiles(extent, nx, ny=None):
+    """Returns an nx by ny grid of (xmin, ymin, xmax, ymax) tiles over
+       extent (xmin, ymin, xmax, ymax)"""
+    ny = ny or nx
+    xmin, ymin, xmax, ymax = extent
+    # Each edge is computed once, so neighbours share it exactly
+    xs = [xmin + (xmax - xmin) * i / nx for i in range(nx)] + [xmax]
+    ys = [ymin + (ymax - ymin) * j / ny for j in range(ny)] + [ymax]
+    return [(xs[i], ys[j], xs[i + 1], ys[j + 1])
+            for j in range(ny) for i in range(nx)]
+
+
+def quadtree_tiles(extent, xy, max_points=MAX_TILE_VERTICES,
+                   max_depth=MAX_DEPTH):
+    """
+    Returns the leaves of a quadtree over extent, splitting every tile
+    holding more than max_points of the (N, 2) points xy, at most
+    max_depth times
+    """
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    tiles = []
+    todo = [(tuple(extent), np.arange(len(xy)), 0)]
+    while todo:
+        tile, inside, depth = todo.pop()
+        if len(inside) <= max_points or depth >= max_depth:
+            tiles.append(tile)
+            continue
+        xmin, ymin, xmax, ymax = tile
+        xmid = (xmin + xmax) / 2.0
+        ymid = (ymin + ymax) / 2.0
+        # Points on a split line go to the upper/right tile
+        right = xy[inside, 0] >= xmid
+        top = xy[inside, 1] >= ymid
+        for quadrant, keep in (((xmin, ymin, xmid, ymid), ~right & ~top),
+                               ((xmid, ymin, xmax, ymid), right & ~top),
+                               ((xmin, ymid, xmid, ymax), ~right & top),
+                               ((xmid, ymid, xmax, ymax), right & top)):
+            todo.append((quadrant, inside[keep], depth + 1))
+    return tiles
+
+
+def seam_lines(tiles, extent):
+    """
+    Returns the inner tile edges as ((x0, y0), (x1, y1)) segments - every
+    tile edge that is not on the outside of extent
+    """
+    xmin, ymin, xmax, ymax = extent
+    seams = set()
+    for x0, y0, x1, y1 in tiles:
+        if x0 != xmin:
+            seams.add(((x0, y0), (x0, y1)))
+        if x1 != xmax:
+            seams.add(((x1, y0), (x1, y1)))
+        if y0 != ymin:
+            seams.add(((x0, y0), (x1, y0)))
+        if y1 != ymax:
+            seams.add(((x0, y1), (x1, y1)))
+    return sorted(seams)
+
+
+def parse_tiling(option):
+    """Returns ('GRID', n), ('QUADTREE', None) or None for a TILING_OPTIONS
+       value"""
+    option = (option or 'NONE').strip().upper()
+    if option == 'NONE':
+        return None
+    if option == 'QUADTREE':
+        return ('QUADTREE', None)
+    if option.startswith('GRID'):
+        return ('GRID', int(option.split()[1].split('X')[0]))
+    raise ValueError("Unknown tiling option: {}".format(option))
+
+
+def make_tiles(option, analysis_area, criteria_fcs):
+    """
+    Returns (tiles, extent) for a TILING_OPTIONS value - the quadtree is
+    split on the vertices of the criteria feature classes
+    """
+    import arcpy
+    tiling = parse_tiling(option)
+    if tiling is None:
+        return None, None
+    e = arcpy.Describe(analysis_area).extent
+    extent = (e.XMin, e.YMin, e.XMax, e.YMax)
+    kind, n = tiling
+    if kind == 'GRID':
+        return grid_tiles(extent, n), extent
+    sr = arcpy.Describe(analysis_area).spatialReference
+    vertices = [np.zeros((0, 2))]
+    for code, fc in criteria_fcs:
+        pnts = arcpy.da.FeatureClassToNumPyArray(
+            fc, ['SHAPE@X', 'SHAPE@Y'], spatial_reference=sr,
+            explode_to_points=True, skip_nulls=True)
+        vertices.append(np.column_stack([pnts['SHAPE@X'], pnts['SHAPE@Y']]))
+    return quadtree_tiles(extent, np.concatenate(vertices)), extent
+
+
+def overlay_tile(tile_id, tile, analysis_area, criteria_fcs, scratch_folder,
+                 compact=False, scratch=None):
+    """
+    Clips the analysis area and every (code, feature class) criterion to one
+    tile, unions them with ONLY_FID lineage and populates the matrix, into
+    scratch_folder\\tile_<id>.gdb\\tile_<id>.  scratch is the caller's
+    ScratchWorkspace when the tile runs in its process.  Returns (output,
+    tallies), or None when the tile misses the analysis area
+    """
+    import arcpy
+    arcpy.env.overwriteOutput = True
+    name = 'tile_{}'.format(tile_id)
+    sr = arcpy.Describe(analysis_area).spatialReference
+    xmin, ymin, xmax, ymax = tile
+    box = arcpy.Polygon(arcpy.Array([arcpy.Point(xmin, ymin),
+                                     arcpy.Point(xmin, ymax),
+                                     arcpy.Point(xmax, ymax),
+                                     arcpy.Point(xmax, ymin),
+                                     arcpy.Point(xmin, ymin)]), sr)
+    scratch_gdb = os.path.join(scratch_folder, name + '.gdb')
+    output = os.path.join(scratch_gdb, name)
+
+    # A worker's in_memory is its own - no budget to share there
+    with (scratch.scope() if scratch else ScratchWorkspace(memory_budget=None)) as workspace:
+        tile_area = workspace.feature_class('area_' + name)
+        arcpy.Clip_analysis(analysis_area, box, tile_area)
+        if int(arcpy.GetCount_management(tile_area).getOutput(0)) == 0:
+            return None
+
+        clipped = []
+        for i, (code, fc) in enumerate(criteria_fcs):
+            clip = workspace.feature_class('{}_{}'.format(name, i))
+            arcpy.Clip_analysis(fc, workspace.use(tile_area), clip)
+            clipped.append(clip)
+        # Size every input first - a later use never spills the ones before it
+        for fc in clipped + [tile_area]:
+            workspace.use(fc)
+        inputs = [workspace.use(fc) for fc in clipped + [tile_area]]
+        union = workspace.feature_class('union_' + name)
+        arcpy.Union_analysis(inputs, union, "ONLY_FID")
+        lineage = restriction_matrix.lineage_fields(union, inputs)
+
+        if not arcpy.Exists(scratch_gdb):
+            arcpy.CreateFileGDB_management(scratch_folder, name + '.gdb')
+        arcpy.MultipartToSinglepart_management(workspace.use(union), output)
+
+    drop = [field.name for field in arcpy.ListFields(output)
+            if not field.required and field.name not in lineage.values()]
+    if drop:
+        arcpy.DeleteField_management(output, drop)
+
+    criteria = [(code, lineage[clip])
+                for (code, fc), clip in zip(criteria_fcs, inputs)]
+    acre_field, tallies = restriction_matrix.populate_matrix(output, criteria,
+                                                             compact=compact)
+    arcpy.DeleteField_management(output, list(lineage.values()))
+    return output, tallies
+
+
+def overlay_tiles(tiles, analysis_area, criteria_fcs, scratch_folder,
+                  workers=1, compact=False, log=None, scratch=None):
+    """
+    Runs overlay_tile for every tile and returns a list of (output,
+    tallies) for the tiles that hold part of the analysis area.  workers > 1
+    uses a process pool, one tile per task; a single worker runs here,
+    under scratch.  Failures are logged and raised together as a
+    RuntimeError - a missing tile is a hole in the matrix.
+    """
+    log = log or (lambda message: None)
+    results = []
+    failures = []
+    workers = max(1, min(int(workers or 1), len(tiles)))
+
+    if workers == 1:
+        for tile_id, tile in enumerate(tiles):
+            result = overlay_tile(tile_id, tile, analysis_area, criteria_fcs,
+                                  scratch_folder, compact, scratch)
+            if result:
+                results.append(result)
+            log('      Tile {} of {}'.format(tile_id + 1, len(tiles)))
+        return results
+
+    mp_setup.set_executable()
+    # One tile per child - geoprocessing leaks memory
+    pool = multiprocessing.Pool(processes=workers, maxtasksperchild=1)
+    try:
+        jobs = [pool.apply_async(overlay_tile, [tile_id, tile, analysis_area,
+                                                criteria_fcs, scratch_folder,
+                                                compact])
+                for tile_id, tile in enumerate(tiles)]
+        for tile_id, job in enumerate(jobs):
+            try:
+                result = job.get()
+                if result:
+                    results.append(result)
+                log('      Tile {} of {}'.format(tile_id + 1, len(tiles)))
+            except Exception as e:
+                log('      Tile {} failed:\n{}'.format(tile_id, repr(e)))
+                failures.append(str(tile_id))
+    finally:
+        pool.close()
+        pool.join()
+    if failures:
+        raise RuntimeError('Tiles failed to overlay: {}'.format(
+            ', '.join(failures)))
+    return results
+
+
+def stitch_tiles(outputs, tiles, extent, out_fc, codes, scratch_folder,
+                 compact=False, scratch=None, log=None):
+    """
+    Merges the tile outputs into out_fc, dissolving the pieces that touch
+    a seam back together on the criteria fields.  The mask fields are the
+    lineage that means the same in every tile (the union FID_ fields are
+    per tile and already gone), so a polygon cut by a seam is one again.
+    The merge layer is named by scratch (a ScratchWorkspace) when given,
+    so concurrent runs never share it.  Returns (seam pieces, dissolved)
+    """
+    import arcpy
+    log = log or (lambda message: None)
+    scratch_gdb = os.path.join(scratch_folder, 'stitch.gdb')
+    if not arcpy.Exists(scratch_gdb):
+        arcpy.CreateFileGDB_management(scratch_folder, 'stitch.gdb')
+    merged = os.path.join(scratch_gdb, 'merged')
+    arcpy.Merge_management(outputs, merged)
+
+    seams = seam_lines(tiles, extent)
+    if not seams:
+        arcpy.CopyFeatures_management(merged, out_fc)
+        return 0, 0
+    sr = arcpy.Describe(merged).spatialReference
+    seam_fc = os.path.join(scratch_gdb, 'seams')
+    arcpy.CopyFeatures_management(
+        [arcpy.Polyline(arcpy.Array([arcpy.Point(*start), arcpy.Point(*end)]), sr)
+         for start, end in seams], seam_fc)
+
+    fields = restriction_matrix.mask_fields(len(codes))
+    if not compact:
+        fields = fields + list(codes) + [restriction_matrix.SUMMARY_FIELD]
+    workspace = scratch.scope() if scratch else ScratchWorkspace(memory_budget=None)
+    with workspace:
+        merged_layer = workspace.layer('merged')
+        arcpy.MakeFeatureLayer_management(merged, merged_layer)
+        arcpy.SelectLayerByLocation_management(merged_layer, "INTERSECT",
+                                               seam_fc, selection_type="NEW_SELECTION")
+        pieces = int(arcpy.GetCount_management(merged_layer).getOutput(0))
+        seam_pieces = os.path.join(scratch_gdb, 'seam_pieces')
+        arcpy.Dissolve_management(merged_layer, seam_pieces, fields,
+                                  multi_part="SINGLE_PART")
+        dissolved = int(arcpy.GetCount_management(seam_pieces).getOutput(0))
+        arcpy.SelectLayerByAttribute_management(merged_layer, "SWITCH_SELECTION")
+        arcpy.CopyFeatures_management(merged_layer, out_fc)
+        arcpy.Append_management(seam_pieces, out_fc, "NO_TEST")
+    log('      Dissolved {} seam pieces into {}'.format(pieces, dissolved))
+    return pieces, dissolved
+
+
+def tiled_overlay(analysis_area, criteria_fcs, out_fc, tiles, extent,
+                  scratch_folder, workers=1, compact=False, log=None,
+                  scratch=None):
+    """
+    The tiled replacement for the aggregate union, clip and matrix: writes
+    the matrix of every (code, feature class) criterion over analysis_area
+    to out_fc and returns (acre_field, tallies) like
+    restriction_matrix.populate_matrix, measured on the stitched polygons.
+    scratch is the caller's ScratchWorkspace, for the stitch layer names
+    """
+    log = log or (lambda message: None)
+    codes = [code for code, fc in criteria_fcs]
+    log('      {} tiles on {} worker(s)'.format(len(tiles), workers))
+    results = overlay_tiles(tiles, analysis_area, criteria_fcs,
+                            scratch_folder, workers, compact, log, scratch)
+    stitch_tiles([output for output, tallies in results], tiles, extent,
+                 out_fc, codes, scratch_folder, compact, scratch, log)
+    acre_field, tallies = restriction_matrix.tally_matrix(out_fc, codes)
+
+    # Check - the seams should only move acres by rounding
+    tile_total = sum(tile_tallies['total'] for output, tile_tallies in results)
+    area_total = float(acreage.measure_features(analysis_area)['area'].sum())
+    log('      Stitched acres {:.2f}, tile acres {:.2f}, analysis area acres '
+        '{:.2f}'.format(tallies['total'], tile_total, area_total))
+    return acre_field, tallies
@@ -13,6 +13,7 @@ def deleteInMemory and getErrors by Ben Zank
 """
 
 import arcpy, sys, os, traceback, datetime
+import duplicate_geometry
 from arcpy import env
 env.addOutputsToMap = False
 env.overwriteOutput = True
@@ -175,7 +176,9 @@ class Retention_Criteria_Analysis(object):
             #Make a feature layer for Geoprocessing
             arcpy.MakeFeatureLayer_management("in_memory\\_", "in_memory\\gp_target")
             # Make sure no duplicate spatial features
-            arcpy.DeleteIdentical_management("in_memory\\gp_target", ["SHAPE"])
+            duplicates = duplicate_geometry.delete_duplicates("in_memory\\gp_target")
+            for line in duplicate_geometry.format_report(duplicates):
+                arcpy.AddMessage(line)
                            
             # Make a geodatabase
             time_stamp = str(datetime.date.today())
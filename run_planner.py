@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-run cost estimates and execution strategy for the overlay tools.
+
+Samples every input before a run - feature count, vertex count (measured
+on the first SAMPLE_ROWS features and scaled up), extent overlap with the
+analysis area and size on disk - and predicts the runtime and peak memory
+of each way the Use Restrictions and NSO/CSU tools can run it:
+
+    serial     criteria dissolved one at a time, one union
+    parallel   criteria dissolved on a process pool, one union
+    tiled      the overlay clipped, unioned and matrixed tile by tile
+    raster     the raster acreage estimate (restriction_raster.py)
+
+    plan = plan_run(analysis_area, tasks, workers=4)
+    for line in format_plan(plan):
+        log(line)
+    plan['strategies'][plan['recommended']]['settings']
+
+The recommendation is the fastest vector strategy whose peak memory fits
+under memory_limit; raster only when none do, since it is an estimate.
+
+The cost model is deliberately simple - overlay tools cost a * V log2 V + b
+seconds for V input vertices, cursor passes a * V + b, a raster a * cells +
+b per criterion, and memory a * V + b bytes.  The default coefficients are
+rough; calibrate() fits the overlay and memory ones to the JSON-lines
+traces written by pipeline_profile - memory to the growth above the
+resident memory at the start of each call that raised the process peak -
+and the result is saved next to this module as MODEL_FILE and used from
+then on:
+
+    python run_planner.py T:\\...\\*_Profile.jsonl
+"""
+
+from __future__ import division
+import argparse
+import collections
+import glob
+import json
+import math
+import os
+import sys
+import numpy as np
+
+
+SAMPLE_ROWS = 1000
+
+# Peak memory a single ArcMap (32 bit) process can count on
+MEMORY_LIMIT = 1.5 * 1024**3
+
+# Grid tilings the planner considers, by tile count
+GRID_TILINGS = ((4, 'GRID 2x2'), (16, 'GRID 4x4'), (64, 'GRID 8x8'))
+
+# Raster estimates aim for about this many cells
+RASTER_CELLS = 2e7
+
+MODEL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'cost_model.json')
+
+DEFAULT_MODEL = {'overlay': {'a': 2.0e-6, 'b': 0.5},
+                 'matrix': {'a': 4.0e-6, 'b': 0.5},
+                 'raster': {'a': 5.0e-8, 'b': 2.0},
+                 'memory': {'a': 120.0, 'b': 150.0e6}}
+
+# Tools whose traced calls calibrate the overlay and memory coefficients
+OVERLAY_TOOLS = ('Union_analysis', 'Intersect_analysis', 'Clip_analysis',
+                 'Erase_analysis', 'Dissolve_management')
+
+
+# Functions
+def load_model(path=MODEL_FILE):
+    """The calibrated model at path, or the default model"""
+    model = dict((key, dict(value)) for key, value in DEFAULT_MODEL.items())
+    if os.path.exists(path):
+        with open(path) as f:
+            for key, value in json.load(f).items():
+                model.setdefault(key, {}).update(value)
+    return model
+
+
+def overlay_seconds(model, vertices):
+    v = max(float(vertices), 2.0)
+    return model['overlay']['a'] * v * math.log(v, 2) + model['overlay']['b']
+
+
+def matrix_seconds(model, vertices):
+    return model['matrix']['a'] * vertices + model['matrix']['b']
+
+
+def memory_bytes(model, vertices):
+    return model['memory']['a'] * vertices + model['memory']['b']
+
+
+def extent_overlap(extent, area_extent):
+    """Fraction of extent inside area_extent - 1.0 for degenerate extents"""
+    width = extent.XMax - extent.XMin
+    height = extent.YMax - extent.YMin
+    if width <= 0 or height <= 0:
+        return 1.0
+    overlap_x = min(extent.XMax, area_extent.XMax) - max(extent.XMin, area_extent.XMin)
+    overlap_y = min(extent.YMax, area_extent.YMax) - max(extent.YMin, area_extent.YMin)
+    return max(0.0, overlap_x) * max(0.0, overlap_y) / (width * height)
+
+
+def disk_bytes(path):
+    """Size of a shapefile and its sidecar files - None for geodatabase
+       feature classes, whose files are not named after them"""
+    if not os.path.isfile(path):
+        return None
+    return sum(os.path.getsize(name) for name in
+               glob.glob(os.path.splitext(path)[0] + '.*'))
+
+
+def sample_input(path, area_extent=None, sample_rows=SAMPLE_ROWS):
+    """
+    Returns {'path', 'features', 'vertices', 'overlap', 'disk_bytes'} for
+    one input.  Vertices are exact for up to sample_rows features and
+    scaled from the first sample_rows otherwise.
+    """
+    import arcpy
+    describe = arcpy.Describe(path)
+    features = int(arcpy.GetCount_management(path).getOutput(0))
+    sampled = 0
+    points = 0
+    with arcpy.da.SearchCursor(path, ['SHAPE@']) as cur:
+        for shape, in cur:
+            if sampled >= sample_rows:
+                break
+            sampled += 1
+            if shape is not None:
+                points += shape.pointCount
+    vertices = points * features / sampled if sampled else 0
+    overlap = 1.0
+    if area_extent is not None:
+        extent = describe.extent
+        if area_extent.spatialReference is not None:
+            try:
+                extent = extent.projectAs(area_extent.spatialReference)
+            except Exception:
+                pass
+        overlap = extent_overlap(extent, area_extent)
+    return {'path': path, 'features': features, 'vertices': vertices,
+            'overlap': overlap, 'disk_bytes': disk_bytes(path)}
+
+
+def _split(fc_list):
+    if isinstance(fc_list, (list, tuple)):
+        return list(fc_list)
+    return [path.strip().strip("'\"") for path in fc_list.split(';') if path.strip()]
+
+
+def profile_inputs(analysis_area, tasks, sample_rows=SAMPLE_ROWS):
+    """
+    Samples the analysis area and every (name, fc_list) criterion.  Returns
+    (area, criteria) - the analysis area sample and an OrderedDict of name:
+    {'inputs', 'features', 'vertices', 'clipped'}, clipped being the
+    vertices expected inside the analysis area
+    """
+    import arcpy
+    area_extent = arcpy.Describe(analysis_area).extent
+    area = sample_input(analysis_area, None, sample_rows)
+    area['extent'] = area_extent
+    criteria = collections.OrderedDict()
+    for name, fc_list in tasks:
+        inputs = [sample_input(path, area_extent, sample_rows)
+                  for path in _split(fc_list)]
+        criteria[name] = {
+            'inputs': inputs,
+            'features': sum(sample['features'] for sample in inputs),
+            'vertices': sum(sample['vertices'] for sample in inputs),
+            'clipped': sum(sample['vertices'] * sample['overlap'] for sample in inputs)}
+    return area, criteria
+
+
+def raster_cell_size(area_extent, cells=RASTER_CELLS):
+    """A round cell size giving about cells cells over area_extent"""
+    area = (area_extent.XMax - area_extent.XMin) * (area_extent.YMax - area_extent.YMin)
+    cell = math.sqrt(area / cells) if area > 0 else 1.0
+    magnitude = 10 ** math.floor(math.log10(cell)) if cell > 0 else 1.0
+    for step in (1, 2, 5, 10):
+        if step * magnitude >= cell:
+            return step * magnitude
+    return 10 * magnitude
+
+
+def estimate(area, criteria, workers=1, raster_cell=None, memory_limit=MEMORY_LIMIT,
+             model=None, tile_workers=None):
+    """
+    Returns an OrderedDict of strategy: {'seconds', 'peak_bytes', 'settings'}
+    from the samples of profile_inputs.  settings are the tool settings of
+    the strategy - workers, tiling and raster_cell.  workers dissolve the
+    criteria and tile_workers (workers by default) run the tiles.
+    """
+    model = model or load_model()
+    workers = max(1, int(workers or 1))
+    tile_workers = max(1, int(tile_workers or workers))
+    dissolves = [overlay_seconds(model, c['vertices']) for c in criteria.values()]
+    clips = sum(overlay_seconds(model, c['clipped'] + area['vertices'])
+                for c in criteria.values())
+    # The whole-area union takes every dissolved criterion in full, the tiles only
+    # what falls inside the analysis area
+    union_vertices = sum(c['vertices'] for c in criteria.values()) + area['vertices']
+    clipped_vertices = sum(c['clipped'] for c in criteria.values()) + area['vertices']
+    matrix = matrix_seconds(model, clipped_vertices)
+    overlay = overlay_seconds(model, union_vertices)
+
+    strategies = collections.OrderedDict()
+    strategies['serial'] = {
+        'seconds': sum(dissolves) + clips + overlay + matrix,
+        'peak_bytes': memory_bytes(model, union_vertices),
+        'settings': {'workers': 1, 'tiling': 'NONE', 'raster_cell': None}}
+    pooled = max(max(dissolves or [0]), sum(dissolves) / workers)
+    if workers > 1:
+        strategies['parallel'] = {
+            'seconds': pooled + clips + overlay + matrix,
+            'peak_bytes': memory_bytes(model, union_vertices),
+            'settings': {'workers': workers, 'tiling': 'NONE', 'raster_cell': None}}
+    for ntile, tiling in GRID_TILINGS:
+        tile_vertices = clipped_vertices / ntile
+        # Tiles run side by side; the stitch dissolves the pieces along the seams
+        seam_vertices = clipped_vertices * min(1.0, 2.0 * math.sqrt(ntile) / ntile)
+        tiled = {
+            'seconds': (pooled + clips
+                        + ntile * (overlay_seconds(model, tile_vertices)
+                                   + matrix_seconds(model, tile_vertices))
+                        / min(tile_workers, ntile)
+                        + overlay_seconds(model, seam_vertices)
+                        + matrix_seconds(model, clipped_vertices)),
+            'peak_bytes': max(memory_bytes(model, tile_vertices),
+                              memory_bytes(model, seam_vertices)),
+            'settings': {'workers': workers, 'tiling': tiling, 'raster_cell': None}}
+        strategies['tiled'] = tiled
+        if tiled['peak_bytes'] <= memory_limit:
+            break
+    cell = raster_cell or raster_cell_size(area['extent'])
+    extent = area['extent']
+    cells = ((extent.XMax - extent.XMin) / cell) * ((extent.YMax - extent.YMin) / cell)
+    strategies['raster'] = {
+        'seconds': (sum(dissolves) / workers
+                    + (len(criteria) + 1) * (model['raster']['a'] * cells
+                                             + model['raster']['b'])
+                    + matrix_seconds(model, clipped_vertices)),
+        'peak_bytes': model['memory']['b'] + 2 * cells,
+        'settings': {'workers': workers, 'tiling': 'NONE', 'raster_cell': cell}}
+    return strategies
+
+
+def recommend(strategies, memory_limit=MEMORY_LIMIT):
+    """The fastest vector strategy that fits memory_limit, else raster"""
+    fits = [(value['seconds'], name) for name, value in strategies.items()
+            if name != 'raster' and value['peak_bytes'] <= memory_limit]
+    return min(fits)[1] if fits else 'raster'
+
+
+def plan_run(analysis_area, tasks, workers=1, raster_cell=None,
+             memory_limit=MEMORY_LIMIT, model=None, sample_rows=SAMPLE_ROWS,
+             tile_workers=None):
+    """
+    Samples the inputs of a run and returns {'area', 'criteria',
+    'strategies', 'recommended'} - see estimate and recommend
+    """
+    area, criteria = profile_inputs(analysis_area, tasks, sample_rows)
+    strategies = estimate(area, criteria, workers, raster_cell, memory_limit, model,
+                          tile_workers)
+    return {'area': area, 'criteria': criteria, 'strategies': strategies,
+            'recommended': recommend(strategies, memory_limit)}
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def format_plan(plan):
+    """Returns the inputs, the estimate of every strategy and the
+       recommendation as printable lines"""
+    lines = ['{:<28} {:>10} {:>12} {:>8}'.format('Criterion', 'Features',
+                                                   'Vertices', 'Inside')]
+    for name, criterion in plan['criteria'].items():
+        inside = criterion['clipped'] / criterion['vertices'] if criterion['vertices'] else 1.0
+        lines.append('{:<28} {:>10} {:>12.0f} {:>7.0f}%'.format(
+            name[:28], criterion['features'], criterion['vertices'], 100 * inside))
+    lines.append('')
+    lines.append('{:<28} {:>10} {:>12}'.format('Strategy', 'Runtime', 'Peak MB'))
+    for name, value in plan['strategies'].items():
+        label = name
+        if value['settings']['tiling'] != 'NONE':
+            label += ' ({})'.format(value['settings']['tiling'])
+        if value['settings']['raster_cell']:
+            label += ' ({} cell size)'.format(value['settings']['raster_cell'])
+        lines.append('{:<28} {:>10} {:>12.0f}'.format(
+            label, _duration(value['seconds']), value['peak_bytes'] / 1024**2))
+    lines.append('Recommended: ' + plan['recommended'])
+    return lines
+
+
+def clip_estimate(analysis_area, paths, model=None, sample_rows=SAMPLE_ROWS):
+    """(seconds, peak bytes) of clipping every path to analysis_area - for
+       tools with a single clip and summarize strategy"""
+    model = model or load_model()
+    area, criteria = profile_inputs(analysis_area, [(path, [path]) for path in paths],
+                                    sample_rows)
+    seconds = sum(overlay_seconds(model, c['clipped'] + area['vertices'])
+                  + matrix_seconds(model, c['clipped']) for c in criteria.values())
+    peak = max([memory_bytes(model, c['clipped'] + area['vertices'])
+                for c in criteria.values()] or [model['memory']['b']])
+    return seconds, peak
+
+
+def _fit(x, y):
+    """Least squares a, b of y = a * x + b, both kept non-negative"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    design = np.column_stack([x, np.ones(len(x))])
+    (a, b), residuals, rank, singular = np.linalg.lstsq(design, y, rcond=-1)
+    if a <= 0:
+        a = float(np.dot(x, y) / np.dot(x, x)) if np.dot(x, x) else 0.0
+        b = 0.0
+    return {'a': max(float(a), 0.0), 'b': max(float(b), 0.0)}
+
+
+def calibrate(trace_paths, model=None):
+    """
+    Fits the overlay and memory coefficients to the calls of
+    pipeline_profile traces run with vertex counts.  The memory slope is
+    fitted to each call's rss_growth and the intercept is the typical
+    resident memory the calls started from.  Returns the model, with the
+    number of calls fitted under 'calibration'
+    """
+    model = model or load_model()
+    model.pop('calls', None)
+    vertices = []
+    walls = []
+    growths = []
+    traces = 0
+    for path in trace_paths:
+        traces += 1
+        with open(path) as f:
+            for line in f:
+                event = json.loads(line)
+                if (event.get('kind') != 'call' or event['name'] not in OVERLAY_TOOLS
+                        or event.get('error')):
+                    continue
+                counts = [sample.get('vertices') for sample in event.get('inputs', [])]
+                if not counts or None in counts:
+                    continue
+                vertices.append(max(float(sum(counts)), 2.0))
+                walls.append(event['wall'])
+                growths.append((event.get('rss_before'), event.get('rss_growth')))
+    known = [(vertex, before, growth) for vertex, (before, growth)
+             in zip(vertices, growths) if before and growth]
+    if len(vertices) >= 2:
+        v = np.array(vertices)
+        model['overlay'] = _fit(v * np.log2(v), walls)
+        if len(known) >= 2:
+            memory = _fit([vertex for vertex, before, growth in known],
+                          [growth for vertex, before, growth in known])
+            memory['b'] += float(np.median([before for vertex, before, growth in known]))
+            model['memory'] = memory
+    model['calibration'] = {'calls': len(vertices), 'memory_calls': len(known),
+                            'traces': traces}
+    return model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Calibrate the run planner cost model '
+                                                 'from pipeline_profile traces')
+    parser.add_argument('traces', nargs='+', help='*_Profile.jsonl files')
+    parser.add_argument('--out', default=MODEL_FILE)
+    args = parser.parse_args(argv)
+    paths = [path for pattern in args.traces for path in glob.glob(pattern)]
+    model = calibrate(paths, load_model(args.out))
+    with open(args.out, 'w') as f:
+        json.dump(model, f, indent=2, sort_keys=True)
+    sys.stdout.write('Fitted {} calls ({} for memory) from {} traces - saved {}\n'.format(
+        model['calibration']['calls'], model['calibration']['memory_calls'], len(paths),
+        args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Scoped scratch names for in_memory intermediates, with a memory budget.
+
+The tools used to write every intermediate to fixed names - in_memory\\_,
+in_memory\\clip, in_memory\\agg_union - and clear up with deleteInMemory,
+which lists and deletes everything in the workspace, theirs or not.  A
+ScratchWorkspace hands out unique names instead and only ever deletes its
+own:
+
+    with ScratchWorkspace(memory_budget=1024**3) as scratch:
+        union = scratch.feature_class('agg_union')
+        arcpy.Union_analysis(inputs, union)
+        arcpy.Clip_analysis(scratch.use(union), area, out_fc)
+        scratch.release(union)
+
+use() returns where an intermediate lives now and marks it as recently
+used.  Once more than one intermediate is live in memory, each is sized
+(its row count times the WKB and field bytes of a sample of rows - roughly
+what it holds in memory) and, when they add up to more than the budget,
+the least recently used ones are copied to a scratch file geodatabase and
+dropped from memory.  A lone intermediate is never sized - there is
+nothing else to spill for it.  Anything spilled is read from disk from
+then on, so always go through use() rather than holding on to the
+in_memory path.
+
+Closing the workspace (or leaving the with block) deletes its in_memory
+intermediates and layers by name and the whole spill geodatabase at once.
+scope() opens a child workspace that shares the budget but cleans up only
+its own intermediates.
+"""
+
+from __future__ import division
+import collections
+import itertools
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+
+# Default budget for in_memory intermediates - ArcMap is a 32 bit process
+MEMORY_BUDGET = 1024**3
+
+SPILL_GDB = 'scratch_spill.gdb'
+
+# Rows read to estimate the bytes per row of an intermediate
+SAMPLE_ROWS = 1000
+
+
+# Functions
+def dataset_bytes(path, sample=SAMPLE_ROWS):
+    """Approximate size of a feature class or table - the row count times
+       the WKB plus eight bytes per attribute value of the first sample rows"""
+    import arcpy
+    rows = int(arcpy.GetCount_management(path).getOutput(0))
+    if not rows:
+        return 0
+    describe = arcpy.Describe(path)
+    fields = [field.name for field in arcpy.ListFields(path)
+              if field.type not in ('Geometry', 'OID')]
+    has_shape = hasattr(describe, 'shapeType')
+    columns = (['SHAPE@WKB'] if has_shape else []) + fields
+    total = 0
+    read = 0
+    with arcpy.da.SearchCursor(path, columns or ['OID@']) as cur:
+        for row in cur:
+            total += 8 * len(fields)
+            if has_shape and row[0] is not None:
+                total += len(row[0])
+            read += 1
+            if read >= sample:
+                break
+    return int(total * rows / read) if read else 0
+
+
+def _label(text):
+    """A name fragment that is valid in a file geodatabase"""
+    return re.sub('[^0-9A-Za-z_]', '_', text)[:32]
+
+
+class ScratchWorkspace(object):
+    """
+    Unique, tracked in_memory intermediates.
+
+    memory_budget  - bytes of in_memory intermediates before the least
+                     recently used are spilled to disk (None for no limit)
+    folder         - where the spill geodatabase goes, a temporary folder
+                     by default
+    log            - called with a message for every spill
+    """
+
+    def __init__(self, memory_budget=MEMORY_BUDGET, folder=None, log=None,
+                 parent=None):
+        self.parent = parent
+        self.root = parent.root if parent else self
+        self.items = collections.OrderedDict()
+        self.layers = []
+        self.closed = False
+        if parent is None:
+            self.memory_budget = memory_budget
+            self.folder = folder
+            self.log = log or (lambda message: None)
+            self.prefix = 's' + uuid.uuid4().hex[:6]
+            self.counter = itertools.count(1)
+            self.spill_folder = None
+            self.registry = {}   # path: (workspace, item) of every open scope
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _name(self, label):
+        return '{}_{}_{}'.format(self.root.prefix, _label(label),
+                                 next(self.root.counter))
+
+    def feature_class(self, label='fc'):
+        """Returns a new unique in_memory path for an intermediate"""
+        name = self._name(label)
+        path = 'in_memory\\' + name
+        item = {'name': name, 'path': path, 'bytes': None, 'live': False,
+                'spilled': False, 'used': time.time()}
+        self.items[path] = item
+        self.root.registry[path] = (self, item)
+        return path
+
+    table = feature_class
+
+    def layer(self, label='layer'):
+        """Returns a new unique layer name, deleted when the workspace closes"""
+        name = self._name(label)
+        self.layers.append(name)
+        return name
+
+    def scope(self):
+        """A child workspace sharing this one's budget and spill geodatabase"""
+        return ScratchWorkspace(parent=self)
+
+    def use(self, path):
+        """
+        Returns the current location of an intermediate (the path itself
+        for anything this workspace did not hand out) and marks it used.
+        The first use marks it live and enforces the memory budget.
+        """
+        owner = self.root.registry.get(path)
+        if owner is None:
+            return path
+        item = owner[1]
+        item['used'] = time.time()
+        if not item['live'] and not item['spilled']:
+            import arcpy
+            if not arcpy.Exists(item['path']):
+                return item['path']
+            item['live'] = True
+            self.root._enforce(keep=path)
+        return item['path']
+
+    def memory_bytes(self):
+        """Estimated bytes of the sized in_memory intermediates across every
+           scope"""
+        return sum(item['bytes'] for owner, item in self.root.registry.values()
+                   if item['bytes'] and not item['spilled'])
+
+    def _spill_gdb(self):
+        import arcpy
+        if self.spill_folder is None:
+            self.spill_folder = tempfile.mkdtemp(prefix='scratch_', dir=self.folder)
+            arcpy.CreateFileGDB_management(self.spill_folder, SPILL_GDB)
+        return os.path.join(self.spill_folder, SPILL_GDB)
+
+    def _enforce(self, keep=None):
+        """Spills the least recently used in_memory intermediates until the
+           rest fit the budget - never keep, the one being used.  Nothing is
+           sized until more than one intermediate is live."""
+        import arcpy
+        if self.memory_budget is None:
+            return
+        live = [item for owner, item in self.registry.values()
+                if item['live'] and not item['spilled']]
+        if len(live) < 2:
+            return
+        for item in live:
+            if item['bytes'] is None:
+                item['bytes'] = dataset_bytes(item['path'])
+        total = self.memory_bytes()
+        candidates = sorted((item['used'], path) for path, (owner, item)
+                            in self.registry.items()
+                            if item['bytes'] and not item['spilled'] and path != keep)
+        for used, path in candidates:
+            if total <= self.memory_budget:
+                break
+            item = self.registry[path][1]
+            spilled = os.path.join(self._spill_gdb(), item['name'])
+            if hasattr(arcpy.Describe(item['path']), 'shapeType'):
+                arcpy.CopyFeatures_management(item['path'], spilled)
+            else:
+                arcpy.CopyRows_management(item['path'], spilled)
+            arcpy.Delete_management(item['path'])
+            item['path'] = spilled
+            item['spilled'] = True
+            total -= item['bytes']
+            self.log('      Spilled {} ({:.0f} MB) to disk'.format(
+                item['name'], item['bytes'] / 1024**2))
+
+    def release(self, path):
+        """Deletes an intermediate as soon as it is no longer needed"""
+        import arcpy
+        owner = self.root.registry.pop(path, None)
+        if owner is None:
+            return
+        workspace, item = owner
+        workspace.items.pop(path, None)
+        if arcpy.Exists(item['path']):
+            arcpy.Delete_management(item['path'])
+
+    def close(self):
+        """Deletes every intermediate and layer of this workspace - and, for
+           the root, the spill geodatabase in one go"""
+        import arcpy
+        if self.closed:
+            return
+        self.closed = True
+        for path in list(self.items):
+            try:
+                self.release(path)
+            except Exception:
+                pass
+        for name in self.layers:
+            try:
+                if arcpy.Exists(name):
+                    arcpy.Delete_management(name)
+            except Exception:
+                pass
+        self.layers = []
+        if self.parent is None and self.spill_folder:
+            try:
+                arcpy.Delete_management(self._spill_gdb())
+            except Exception:
+                pass
+            shutil.rmtree(self.spill_folder, ignore_errors=True)
+            self.spill_folder = None
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Stage completion markers for restartable Use Restrictions runs.
+
+Each stage of a run writes a marker row - the stage name, a fingerprint of
+its inputs and the completion time - to a table in the output geodatabase
+once everything it produces is on disk.  A rerun pointed at that
+geodatabase skips every stage whose marker matches and picks up at the
+first one that does not:
+
+    checkpoints = StageCheckpoints(output_path)
+    fingerprint = checkpoints.fingerprint('criteria', tasks, source_state(paths))
+    if not checkpoints.done('criteria', fingerprint):
+        ...
+        checkpoints.complete('criteria', fingerprint)
+
+Fingerprints are chained - each one includes the fingerprint of the stage
+before it - so changing an input invalidates its stage and everything
+downstream, and once one stage has to run every later stage runs too.
+Input state is the path, row count and file modification time of every
+source (see criteria_cache.modified_time), which is cheap enough to take on
+every run.
+
+The table also keeps run choices a resumed run has to repeat - the
+execution strategy AUTO picked, say - as JSON under a name of their own:
+
+    checkpoints.save('strategy', settings)
+    settings = checkpoints.saved('strategy')
+"""
+
+from __future__ import division
+import datetime
+import hashlib
+import json
+import os
+
+from criteria_cache import modified_time, split_inputs
+
+
+CHECKPOINT_TABLE = 'Stage_Checkpoints'
+
+
+# Functions
+def source_state(paths):
+    """Returns [path, row count, modification time] for every input path"""
+    import arcpy
+    state = []
+    for path in sorted(split_inputs(paths)):
+        state.append([os.path.normcase(os.path.abspath(path)),
+                      int(arcpy.GetCount_management(path).getOutput(0)),
+                      modified_time(path)])
+    return state
+
+
+class StageCheckpoints(object):
+    """The checkpoint table of an output geodatabase"""
+
+    def __init__(self, gdb):
+        import arcpy
+        self.table = os.path.join(gdb, CHECKPOINT_TABLE)
+        self.previous = ''
+        self.resuming = True
+        if not arcpy.Exists(self.table):
+            arcpy.CreateTable_management(gdb, CHECKPOINT_TABLE)
+            arcpy.AddField_management(self.table, 'STAGE', 'TEXT', field_length=64)
+            arcpy.AddField_management(self.table, 'FINGERPRINT', 'TEXT', field_length=40)
+            arcpy.AddField_management(self.table, 'COMPLETED', 'TEXT', field_length=32)
+        if not arcpy.ListFields(self.table, 'SETTINGS'):
+            arcpy.AddField_management(self.table, 'SETTINGS', 'TEXT', field_length=1024)
+        self.settings = {}
+        with arcpy.da.SearchCursor(self.table, ['STAGE', 'FINGERPRINT', 'SETTINGS']) as cur:
+            self.markers = {}
+            for stage, fingerprint, settings in cur:
+                if settings:
+                    self.settings[stage] = json.loads(settings)
+                else:
+                    self.markers[stage] = fingerprint
+
+    def fingerprint(self, stage, *inputs):
+        """
+        Returns the fingerprint of a stage - a SHA-1 of its name, its inputs
+        (anything JSON can write) and the fingerprint of the stage before
+        """
+        digest = hashlib.sha1()
+        digest.update(json.dumps([self.previous, stage, inputs],
+                                 sort_keys=True, default=str).encode('utf-8'))
+        self.previous = digest.hexdigest()
+        return self.previous
+
+    def done(self, stage, fingerprint):
+        """
+        True if the stage finished with these inputs on an earlier run and
+        no stage before it had to run again
+        """
+        self.resuming = self.resuming and self.markers.get(stage) == fingerprint
+        return self.resuming
+
+    def complete(self, stage, fingerprint):
+        """Writes (or replaces) the marker of a finished stage"""
+        import arcpy
+        completed = str(datetime.datetime.now()).split('.')[0]
+        with arcpy.da.UpdateCursor(self.table, ['STAGE']) as cur:
+            for row in cur:
+                if row[0] == stage:
+                    cur.deleteRow()
+        with arcpy.da.InsertCursor(self.table,
+                                   ['STAGE', 'FINGERPRINT', 'COMPLETED']) as cur:
+            cur.insertRow([stage, fingerprint, completed])
+        self.markers[stage] = fingerprint
+
+    def saved(self, name):
+        """The settings saved under name by an earlier run, or None"""
+        return self.settings.get(name)
+
+    def save(self, name, settings):
+        """Writes (or replaces) settings - anything JSON can write - under name"""
+        import arcpy
+        completed = str(datetime.datetime.now()).split('.')[0]
+        with arcpy.da.UpdateCursor(self.table, ['STAGE']) as cur:
+            for row in cur:
+                if row[0] == name:
+                    cur.deleteRow()
+        with arcpy.da.InsertCursor(self.table,
+                                   ['STAGE', 'COMPLETED', 'SETTINGS']) as cur:
+            cur.insertRow([name, completed, json.dumps(settings, sort_keys=True)])
+        self.settings[name] = settings
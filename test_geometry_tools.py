@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for geometry_tools.minRect against minRectByEdges, the
+O(n^2) reference that rotates every point to every edge angle.
+
+    python -m unittest test_geometry_tools
+
+Convex polygons (either way round) and rotated rectangles (four tied
+edges) must give the same angle, dx and dy.  Star shaped clockwise rings
+and random point clouds are never larger, and the same rectangle whenever
+the area is the same (minRectByEdges only tries the input edges, so it can
+miss a hull edge) - for point clouds the angle may be 180 degrees out.
+"""
+
+from __future__ import division
+import math
+import random
+import unittest
+
+import geometry_tools as gt
+
+
+TRIALS = 50
+
+CONVEX, CONVEX_CW, RECTANGLE, STAR, CLOUD = range(5)
+
+
+# Functions
+def make_points(kind, rnd):
+    """Returns a random test shape of one kind, or None when the draw
+       degenerates"""
+    N = rnd.randint(3, 60)
+    X0 = rnd.uniform(-5.0e5, 5.0e5)
+    Y0 = rnd.uniform(4.0e6, 4.5e6)
+    pnts = [[X0 + rnd.uniform(-1000, 1000), Y0 + rnd.uniform(-250, 250)]
+            for i in range(N)]
+    if kind in (CONVEX, CONVEX_CW):
+        pnts = gt.convexHull(pnts)
+        if len(pnts) < 3:
+            return None
+        if kind == CONVEX_CW:
+            pnts.reverse()
+    elif kind == RECTANGLE:
+        # A rotated rectangle run clockwise, closed
+        angle = rnd.choice([0.0, 90.0, rnd.uniform(-180.0, 180.0)])
+        dx = rnd.uniform(10, 1000)
+        dy = rnd.uniform(10, 1000)
+        cosA = math.cos(gt.degToRad*angle)
+        sinA = math.sin(gt.degToRad*angle)
+        pnts = [[X0 + X*cosA - Y*sinA, Y0 + X*sinA + Y*cosA]
+                for X, Y in [[0, 0], [0, dy], [dx, dy], [dx, 0], [0, 0]]]
+    elif kind == STAR:
+        # Star shaped around the average, run clockwise
+        pntCent = gt.pntAvgXY(pnts)
+        pnts.sort(key=lambda pnt: -math.atan2(pnt[1] - pntCent[1],
+                                              pnt[0] - pntCent[0]))
+    return pnts
+
+
+def compare_min_rect(kind, trials=TRIALS, seed=1):
+    """Returns [trial, old [angle, dx, dy], new [angle, dx, dy]] for every
+       trial where minRect and minRectByEdges disagree"""
+    rnd = random.Random(seed*10 + kind)
+    failures = []
+    for trial in range(trials):
+        pnts = make_points(kind, rnd)
+        if pnts is None:
+            continue
+        old = gt.minRectByEdges(pnts)
+        new = gt.minRect(pnts)
+        oldArea = old[2]*old[3]
+        newArea = new[2]*new[3]
+        tol = 1.0e-9*max(oldArea, 1.0)
+        if kind in (STAR, CLOUD):
+            bad = newArea > oldArea + tol
+        else:
+            bad = abs(oldArea - newArea) > tol
+        if not bad and abs(oldArea - newArea) <= tol:
+            # A point cloud has no direction - its edges may run either way
+            period = 180.0 if kind == CLOUD else 360.0
+            turn = abs(old[1] - new[1]) % period
+            bad = (min(turn, period - turn) > 1.0e-6 or
+                   abs(old[2] - new[2]) > 1.0e-6*max(old[2], 1.0) or
+                   abs(old[3] - new[3]) > 1.0e-6*max(old[3], 1.0))
+        if bad:
+            failures.append([trial, old[1:], new[1:]])
+    return failures
+
+
+class MinRectTest(unittest.TestCase):
+
+    def test_convex(self):
+        self.assertEqual(compare_min_rect(CONVEX), [])
+
+    def test_convex_clockwise(self):
+        self.assertEqual(compare_min_rect(CONVEX_CW), [])
+
+    def test_rotated_rectangle(self):
+        self.assertEqual(compare_min_rect(RECTANGLE), [])
+
+    def test_star_clockwise(self):
+        self.assertEqual(compare_min_rect(STAR), [])
+
+    def test_point_cloud(self):
+        self.assertEqual(compare_min_rect(CLOUD), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,7 +27,6 @@ Something like that..
 Log everything...
 
 Comments:
-def deleteInMemory by Ben Zank
 """
 
 
@@ -39,8 +38,17 @@ def deleteInMemory by Ben Zank
 
 from __future__ import division # Integer division is lame - use // instead
 
-import datetime, os, re, sys, traceback
+import datetime, multiprocessing, os, re, shutil, sys, tempfile, traceback
 import arcpy
+import acreage
+import restriction_matrix
+import restriction_tiles
+import restriction_raster
+import use_restrictions_workers
+import criteria_cache
+import criteria_generalize
+import duplicate_geometry
+import scratch_workspace
 from arcpy import env
 import getpass
 #import math
@@ -58,6 +66,10 @@ from collections import defaultdict
 env.addOutputsToMap = False
 env.overwriteOutput = True
 
+# Alternative D outputs are partitioned by these ecoregions
+ALT_D_ECOREGIONS = r'T:\CO\GIS\giswork\rgfo\projects\management_plans\ECRMP\Draft_RMP_EIS\1_Analysis\ECRMP_Outputs\boundaries\boundaries.gdb\ECRMP_HumanEcoregions_AltD_20160602'
+ALT_D_ECOREGION_FIELD = "Community_Landscape"
+
 
 #######################################################################################################################
 ##
@@ -144,28 +156,6 @@ class pyt_log(object):
 
 ##---Functions---------------------------------------------------------------------------------------------------------
 
-def deleteInMemory():
-    """Delete in memory tables and feature classes - reset to original worksapce when done"""
-
-    # get the original workspace location
-    orig_workspace = env.workspace
-    
-    # Set the workspace to in_memory
-    env.workspace = "in_memory"
-    # Delete all in memory feature classes
-    fcs = arcpy.ListFeatureClasses()
-    if len(fcs) > 0:
-        for fc in fcs:
-            arcpy.Delete_management(fc)
-    # Delete all in memory tables
-    tbls = arcpy.ListTables()
-    if len(tbls) > 0:
-        for tbl in tbls:
-            arcpy.Delete_management(tbl)
-
-    # Reset the workspace
-    env.workspace = orig_workspace
-    
 def buildWhereClauseFromList(table, field, valueList):
     """Takes a list of values and constructs a SQL WHERE
     clause to select those values within a given field and table."""
@@ -188,17 +178,9 @@ def get_acres(fc):
     """Check for an acres field in fc - create if exists or flag for calculation.
        Recalculate acres and return name of acre field"""
 
-    # Add ACRES field to analysis area - check if exists
-    field_list = [field.name for field in arcpy.ListFields(fc) if field.name.upper() == "ACRES"]
-
-    # If ACRES/Acres/acres exists in table, flag for calculation instead
-    if field_list:
-        acre_field = field_list[0] # select the suitable 'acres' variant
-    else:
-        arcpy.AddField_management(fc, "ACRES", "DOUBLE", 15, 2)
-        acre_field = "ACRES"
-
-    arcpy.CalculateField_management(fc, acre_field, "!shape.area@ACRES!", "PYTHON_9.3")
+    # Find or add the ACRES field and write every feature's planar acres
+    # from a single geometry read - see acreage.py
+    acre_field, acres = acreage.calculate_acres(fc)
     return acre_field
 
 ##---Variables---------------------------------------------------------------------------------------------------------
@@ -575,10 +557,66 @@ class Use_Restrictions(object):
             parameterType="Required",
             direction="Input")
 
+        # Keep only the CRITERIA bitmask - no per-criterion text columns or Summary
+        param35=arcpy.Parameter(
+            displayName="Compact Output (criteria bitmask only)",
+            name="Compact_Output",
+            datatype="Boolean",
+            parameterType="Optional",
+            direction="Input")
+
+        # Dissolved criteria are reused from here when their inputs have not changed
+        param36=arcpy.Parameter(
+            displayName="Criteria Cache Folder",
+            name="Criteria_Cache_Folder",
+            datatype="Folder",
+            parameterType="Optional",
+            direction="Input")
+
+        # Overlay the criteria tile by tile, side by side - for areas too big for one union
+        param37=arcpy.Parameter(
+            displayName="Overlay Tiling",
+            name="Overlay_Tiling",
+            datatype="String",
+            parameterType="Optional",
+            direction="Input")
+
+        # Quick raster acreage estimate at this cell size instead of the vector overlay
+        param38=arcpy.Parameter(
+            displayName="Raster Estimate Cell Size",
+            name="Raster_Estimate_Cell_Size",
+            datatype="Double",
+            parameterType="Optional",
+            direction="Input")
+
+        # Simplify the dissolved criteria under this tolerance (in data units) before the overlay
+        param39=arcpy.Parameter(
+            displayName="Generalization Tolerance",
+            name="Generalization_Tolerance",
+            datatype="Double",
+            parameterType="Optional",
+            direction="Input")
+
+        param40=arcpy.Parameter(
+            displayName="Generalization Method",
+            name="Generalization_Method",
+            datatype="String",
+            parameterType="Optional",
+            direction="Input")
+
+        # Alternative D - also write a feature class per ecoregion
+        param41=arcpy.Parameter(
+            displayName="Export Ecoregion Feature Classes",
+            name="Export_Ecoregion_Feature_Classes",
+            datatype="Boolean",
+            parameterType="Optional",
+            direction="Input")
+
         parameters = [param00, param01, param02, param03, param04, param05, param06, param07, param08, param09, param10,
                       param11, param12, param13, param14, param15, param16, param17, param18, param19, param20, param21,
                       param22, param23, param24, param25, param26, param27, param28, param29, param30, param31, param32,
-                      param33, param34]
+                      param33, param34, param35, param36, param37, param38,
+                      param39, param40, param41]
 
         return parameters
 
@@ -604,6 +642,19 @@ class Use_Restrictions(object):
         parameters[34].filter.list = ['Alternative B [ALT_B]', 'Alternative C [ALT_C]',
                                       'Alternative D [ALT_D] - will clip by ecoregion']
 
+        if not parameters[35].altered:
+            parameters[35].value = False
+
+        parameters[37].filter.type = "ValueList"
+        parameters[37].filter.list = restriction_tiles.TILING_OPTIONS
+        if not parameters[37].altered:
+            parameters[37].value = 'NONE'
+
+        parameters[40].filter.type = "ValueList"
+        parameters[40].filter.list = list(criteria_generalize.METHODS)
+        if not parameters[40].altered:
+            parameters[40].value = 'DOUGLAS_PEUCKER'
+
         return
 
 
@@ -622,11 +673,10 @@ class Use_Restrictions(object):
     def execute(self, parameters, messages):
         """The source code of the tool."""
 
+        # Every intermediate gets a unique in_memory name, deleted when the run ends
+        scratch = scratch_workspace.ScratchWorkspace(log=arcpy.AddMessage)
         try:
 
-            # Clear memory JIC
-            deleteInMemory()
-
             # Get the analysis ID
             analysis_id = (parameters[34].valueAsText.split("[")[1][:5])+"_"+\
                           (parameters[33].valueAsText.split("[")[1][:3])+"_"+\
@@ -634,6 +684,12 @@ class Use_Restrictions(object):
 
             # Get the alternative selection
             alternative = parameters[34].valueAsText.split("[")[1][:5]
+
+            # Bitmask only output schema
+            compact_output = bool(parameters[35].value)
+
+            # Overlay tiling - NONE runs one union over the whole analysis area
+            tiling = parameters[37].valueAsText
             
             # Make a directory
             parent_folder_path = os.path.join(os.path.dirname(parameters[1].valueAsText),
@@ -687,13 +743,16 @@ class Use_Restrictions(object):
             logger.log_all('\t'+output_path+"\n")
 
             # Secure a copy of the input analysis area
-            arcpy.MakeFeatureLayer_management(parameters[0].value, "in_memory\\_")
+            area_layer = scratch.layer('analysis_area')
+            arcpy.MakeFeatureLayer_management(parameters[0].value, area_layer)
 
             # Dissolve everything to prevent overlapping input polygons
             logger.console('Dissolving input polygon')
-            arcpy.Dissolve_management("in_memory\\_", "in_memory\\__")
+            area_dissolve = scratch.feature_class('analysis_dissolve')
+            arcpy.Dissolve_management(area_layer, area_dissolve)
             analysis_area = output_path+"\\"+analysis_id+"_Analysis_Area"
-            arcpy.CopyFeatures_management("in_memory\\__", analysis_area)
+            arcpy.CopyFeatures_management(scratch.use(area_dissolve), analysis_area)
+            scratch.release(area_dissolve)
 
             # Set the workspace to the output database
             arcpy.env.workspace = output_path
@@ -754,17 +813,43 @@ class Use_Restrictions(object):
             arcpy.CreateFeatureDataset_management(output_path, "Inputs", spatial_ref)
             arcpy.CreateFeatureDataset_management(output_path, "Results", spatial_ref)
 
-            # Function to copy the unioned layers and dissolve to input data - deletes attribute data!
-            def union_inputs(name, fc_list):
-                union_output = output_path+"\\Inputs\\"+name
-                arcpy.Union_analysis(fc_list, "in_memory\\dissolve")
-                arcpy.Dissolve_management("in_memory\\dissolve", union_output)
-                return
-            
-            # Iterate across sorted items and create union output
+            # Union and dissolve each criterion to input data - deletes attribute data!
+            tasks = [(id[2:], data[0]) for id, data in sorted_inputs]
             logger.console('Dissolving criteria unions        ---this will probably be slow---')
-            for id, data in sorted_inputs:
-                 union_inputs(id[2:], data[0])
+            scratch_folder = tempfile.mkdtemp(prefix='criteria_', dir=child_folder_path)
+            try:
+                def dissolve(todo):
+                    return use_restrictions_workers.dissolve_criteria(todo, scratch_folder,
+                                                                      scratch=scratch)
+                cache_folder = parameters[36].valueAsText
+                if cache_folder:
+                    # Only the criteria whose inputs changed are dissolved again
+                    logger.logfile('Criteria cache:', cache_folder)
+                    cache = criteria_cache.CriteriaCache(cache_folder, log=logger.console)
+                    dissolved, cache_keys = criteria_cache.cached_criteria(tasks, cache, dissolve,
+                                                                           logger.console)
+                    cache.evict(keep=cache_keys)
+                else:
+                    dissolved = dissolve(tasks)
+                for name, fc_list in tasks:
+                    arcpy.CopyFeatures_management(dissolved[name], output_path+"\\Inputs\\"+name)
+            finally:
+                shutil.rmtree(scratch_folder, ignore_errors=True)
+
+            # Fewer vertices for the union and matrix - see criteria_generalize.py
+            generalize_tolerance = parameters[39].value
+            if generalize_tolerance:
+                generalize_method = parameters[40].valueAsText or 'DOUGLAS_PEUCKER'
+                logger.console('Generalizing criteria - {} at {}'.format(generalize_method,
+                                                                        generalize_tolerance))
+                generalized = criteria_generalize.generalize_criteria(
+                    [(name, output_path+"\\Inputs\\"+name) for name, fc_list in tasks],
+                    generalize_tolerance, generalize_method, logger.console)
+                logger.report("\nGENERALIZATION - {} at {}:\n".format(generalize_method,
+                                                                      generalize_tolerance))
+                for line in criteria_generalize.format_report(generalized):
+                    logger.logfile(line)
+                    logger.report("\t"+line+"\n")
 
             # Write inputs to report
             for category in input_categories:
@@ -783,6 +868,29 @@ class Use_Restrictions(object):
                 all_fcs_list.append(fc)  
             logger.logfile('all_fcs_list', all_fcs_list)
 
+            # map the criteria to their categories
+            fc_id_map = defaultdict(str)
+            for key, value in sorted_inputs:
+                fc_id_map[key[2:]] = value[2]
+
+            # Raster estimate - acreage figures in seconds, no union or matrix
+            raster_cell = parameters[38].value
+            if raster_cell:
+                logger.console('Estimating acres on a {} cell raster'.format(raster_cell))
+                zones_fc, zone_field = None, None
+                if alternative == "ALT_D":
+                    zones_fc, zone_field = ALT_D_ECOREGIONS, ALT_D_ECOREGION_FIELD
+                estimate = restriction_raster.raster_estimate(
+                    analysis_area,
+                    [(fc_id_map[str(fc)], arcpy.Describe(fc).catalogPath) for fc in all_fcs_list],
+                    raster_cell, zones_fc, zone_field, logger.console)
+                outCSV = child_folder_path+"\\"+analysis_id_time_stamp+'_Raster_Estimate.csv'
+                restriction_raster.write_estimate_csv(outCSV, analysis_id, estimate)
+                logger.console('Estimated {:.2f} restricted acres +/- {:.2f}'.format(
+                    estimate['markup'], estimate['bounds']['markup']))
+                logger.log_all('\nSuccessful completion..')
+                return
+
             # For each fc in all_fcs_list,
             # dissolve the fc and out put as analysis_id + feature name
             for fc in all_fcs_list:
@@ -792,111 +900,103 @@ class Use_Restrictions(object):
                 output_fc_path = output_path+"\\Results\\"+output_fc_name
                 #output_fc_path = output_path+"\\"+output_fc_name
                 logger.logfile('output_fc_path', output_fc_path)
-                arcpy.Clip_analysis(analysis_area, fc, "in_memory\\clip")
+                clip = scratch.feature_class('clip')
+                arcpy.Clip_analysis(analysis_area, fc, clip)
                 # Dissolve the clips
-                arcpy.Dissolve_management("in_memory\\clip", output_fc_path)
+                arcpy.Dissolve_management(scratch.use(clip), output_fc_path)
+                scratch.release(clip)
                 
-            # map the criteria to their categories
-            fc_id_map = defaultdict(str)
-            for key, value in sorted_inputs:
-                fc_id_map[key[2:]] = value[2]
-
             # Collapse geometry union [will be slow with full input]
-            logger.console('Unioning all criteria inputs         ---this will probably be slow---')
             output_aggregate_feature = output_path+"\\Aggregate_Results"
-
-            # Add input analysis area to list of union and union it all
-            all_fcs_list_copy = copy.deepcopy(all_fcs_list)
-            ### Try actual path to Analysis_Area
-            #all_fcs_list_copy.append(u'Analysis_Area')
-            all_fcs_list_copy.append(analysis_area)
-            logger.logfile("all_fcs_list_copy", all_fcs_list_copy)
-            arcpy.Union_analysis(all_fcs_list_copy, "in_memory\\agg_union")
-
-            # Clip the union and output it
-            arcpy.Clip_analysis("in_memory\\agg_union", analysis_area, "in_memory\\clip_")
-
-            # Make sure everything is in single-part format for later analysis - JIC
-            arcpy.MultipartToSinglepart_management("in_memory\\clip_", output_aggregate_feature)
-
-            # Create the matrix
-            logger.console('Creating matrix            ---this will probably be slow---')
-
-            # Erase all the other fields - sometimes its easier to ask for forgiveness than permission [ietafftp]
-            erase_fields_lst = [field.name for field in arcpy.ListFields(output_aggregate_feature)]
-            for field in erase_fields_lst:
+            criteria_fcs = [(fc_id_map[str(fc)], arcpy.Describe(fc).catalogPath) for fc in all_fcs_list]
+            tiles, tile_extent = restriction_tiles.make_tiles(tiling, analysis_area, criteria_fcs)
+            if tiles:
+                # Clip, union and matrix per tile on a process pool, then stitch the tiles
+                logger.console('Overlaying criteria by tile         ---this will probably be slow---')
+                criteria = criteria_fcs
+                tile_folder = tempfile.mkdtemp(prefix='tiles_', dir=child_folder_path)
                 try:
-                    arcpy.DeleteField_management(output_aggregate_feature, field)
-                except:
-                    logger.logfile("Delete field failed:", field) # Should minimally fail on OID, Shape, Shape_area, and Shape_length
-
-            # Delete identical features within output_aggregate_feature to prevent double counting acres
-            try:
-                arcpy.DeleteIdentical_management(output_aggregate_feature, ["SHAPE"])
-                logger.logfile("Delete identical succeeded")
-            except:
-                logger.logfile("Delete identical failed") # This will usually fail - it's ok
-
-            # Calculate acres for output_aggregate_field and get acre field name
-            acre_field = get_acres(output_aggregate_feature)
+                    acre_field, tallies = restriction_tiles.tiled_overlay(analysis_area, criteria,
+                                                                          output_aggregate_feature,
+                                                                          tiles, tile_extent, tile_folder,
+                                                                          max(1, multiprocessing.cpu_count() - 1),
+                                                                          compact_output, logger.console,
+                                                                          scratch=scratch)
+                finally:
+                    shutil.rmtree(tile_folder, ignore_errors=True)
+            else:
+                logger.console('Unioning all criteria inputs         ---this will probably be slow---')
+
+                # Add input analysis area to list of union and union it all
+                all_fcs_list_copy = copy.deepcopy(all_fcs_list)
+                ### Try actual path to Analysis_Area
+                #all_fcs_list_copy.append(u'Analysis_Area')
+                all_fcs_list_copy.append(analysis_area)
+                logger.logfile("all_fcs_list_copy", all_fcs_list_copy)
+                # ONLY_FID keeps the lineage - one FID_ field per input, -1 where a piece is outside it
+                agg_union = scratch.feature_class('agg_union')
+                arcpy.Union_analysis(all_fcs_list_copy, agg_union, "ONLY_FID")
+                lineage = restriction_matrix.lineage_fields(scratch.use(agg_union), all_fcs_list_copy)
+
+                # Clip the union and output it
+                agg_clip = scratch.feature_class('agg_clip')
+                arcpy.Clip_analysis(scratch.use(agg_union), analysis_area, agg_clip)
+                scratch.release(agg_union)
+
+                # Make sure everything is in single-part format for later analysis - JIC
+                arcpy.MultipartToSinglepart_management(scratch.use(agg_clip), output_aggregate_feature)
+                scratch.release(agg_clip)
+
+                # Create the matrix
+                logger.console('Creating matrix            ---this will probably be slow---')
+
+                # Erase all the other fields - sometimes its easier to ask for forgiveness than permission [ietafftp]
+                erase_fields_lst = [field.name for field in arcpy.ListFields(output_aggregate_feature)
+                                    if field.name not in lineage.values()]
+                for field in erase_fields_lst:
+                    try:
+                        arcpy.DeleteField_management(output_aggregate_feature, field)
+                    except:
+                        logger.logfile("Delete field failed:", field) # Should minimally fail on OID, Shape, Shape_area, and Shape_length
+
+                # Delete identical features within output_aggregate_feature to prevent double counting acres
+                # - their lineage is kept on the surviving copy
+                duplicates = duplicate_geometry.delete_duplicates(output_aggregate_feature,
+                                                                  merge_fields=lineage.values())
+                for line in duplicate_geometry.format_report(duplicates):
+                    logger.logfile(line)
+
+                # Populate the matrix from the union lineage - every criterion column, the acres
+                # and the acreage tallies in one cursor sweep, no select by location per criterion
+                logger.console('Populating matrix')
+                criteria = [(fc_id_map[str(fc)], lineage[fc]) for fc in all_fcs_list]
+                acre_field, tallies = restriction_matrix.populate_matrix(output_aggregate_feature, criteria,
+                                                                         compact=compact_output)
+
+                # The lineage fields have done their job
+                arcpy.DeleteField_management(output_aggregate_feature, list(lineage.values()))
 
             # Create a defaultdict to store acreages - default dictionaries are awesome!
             acreage_counts = defaultdict(int)
-
-            # Iterate across all_fcs_list and add field, select by location and calculate field with ID, remove null
-            arcpy.MakeFeatureLayer_management(output_aggregate_feature, "in_memory\\mem_agg_layer")
-
-            # Create a list to store all added field ids
-            fc_field_list = []
-
-            logger.console('Populating matrix')
-            for fc in all_fcs_list:
-                fc_ID = fc_id_map[str(fc)]
-
-                # Copy the created fields for later use in fields summary
-                fc_field_list.append(fc_ID)
-
-                # Add field, select, and calculate
-                arcpy.AddField_management("in_memory\\mem_agg_layer", fc_ID, "Text", field_length=20)
-                arcpy.SelectLayerByLocation_management("in_memory\\mem_agg_layer", "WITHIN", fc, selection_type="NEW_SELECTION")
-                arcpy.CalculateField_management("in_memory\\mem_agg_layer", fc_ID, '"'+fc_ID+'"', "PYTHON_9.3")
-
-                # Get the acres
-                fc_acres = sum([row[0] for row in arcpy.da.SearchCursor("in_memory\\mem_agg_layer", acre_field)])
-
-                # Add key=fc_id and value=acreage to sweet default dictionary
+            for fc_ID, fc_acres in tallies['criteria'].items():
                 acreage_counts[fc_ID] = round(fc_acres, 2)
 
-                # Switch the selection
-                arcpy.SelectLayerByAttribute_management("in_memory\\mem_agg_layer", "SWITCH_SELECTION")
-
-                # Clean the table for readability - replace "Null" with ""
-                arcpy.CalculateField_management("in_memory\\mem_agg_layer", fc_ID, '"'+""+'"', "PYTHON_9.3")
-                arcpy.SelectLayerByAttribute_management("in_memory\\mem_agg_layer", "CLEAR_SELECTION")
+            # The key to the CRITERIA bitmask
+            restriction_matrix.write_code_table(output_path+"\\"+analysis_id+"_Criteria_Codes",
+                                                [code for code, field in criteria],
+                                                list(tallies['criteria'].values()))
 
             # Write the markup feature to disc
             output_aggregate_feature_markup = output_path+"\\"+analysis_id+"_Restrictions_Markup"
-            arcpy.CopyFeatures_management("in_memory\\mem_agg_layer", output_aggregate_feature_markup)
-
-            # Create a summary field and get list of other fields
-            arcpy.AddField_management(output_aggregate_feature_markup, "Summary", "Text", field_length=255)
-            fc_field_list.append('Summary')
-            num_of_fields = len(fc_field_list)
-            with arcpy.da.UpdateCursor(output_aggregate_feature_markup, fc_field_list) as cur:
-                for row in cur:
-                    # There's gotta be a better way to do this... this sucks... yes it does... super duper sucks.. def..
-                    row[num_of_fields-1] = re.sub('\s+', ' ', (reduce(lambda x,y: x+" "+y, [row[i] for i in range(num_of_fields-1)]))).strip()
-                    cur.updateRow(row)
-
-            # Get the total analysis acreage
-            arcpy.MakeFeatureLayer_management(output_aggregate_feature_markup, "in_memory\\_markup")
-            total_analysis_acres = sum([row[0] for row in arcpy.da.SearchCursor("in_memory\\_markup", acre_field)])
+            arcpy.CopyFeatures_management(output_aggregate_feature, output_aggregate_feature_markup)
+
+            # Get the total analysis acreage - tallied with the matrix
+            total_analysis_acres = tallies['total']
             logger.logfile("Total analysis acres", total_analysis_acres)
 
-            # Get the total marked-up acreage
+            # Get the total marked-up acreage - every polygon within at least one criterion
             logger.console('Creating markup output')
-            arcpy.SelectLayerByAttribute_management("in_memory\\_markup", "NEW_SELECTION", """ "Summary" <> '' """)
-            total_markup_acres = sum([row[0] for row in arcpy.da.SearchCursor("in_memory\\_markup", acre_field)])
+            total_markup_acres = tallies['markup']
             logger.logfile("Total markup acres", total_markup_acres)
 
             # Delete the lingering unmarked output - comment out if you want to keep original with original fields
@@ -906,39 +1006,27 @@ class Use_Restrictions(object):
             logger.logfile("alternative", alternative)
             if alternative == "ALT_D":
                 
-                # Partition the data sets by ecoregion and write outputs to csv
+                # Tally the markup by ecoregion - one intersect and one cursor pass
                 logger.console('Partitioning outputs by ecoregions')
-                ecoregions = r'T:\CO\GIS\giswork\rgfo\projects\management_plans\ECRMP\Draft_RMP_EIS\1_Analysis\ECRMP_Outputs\boundaries\boundaries.gdb\ECRMP_HumanEcoregions_AltD_20160602'
+                codes = list(tallies['criteria'])
+                ecoregion_fc = output_path+"\\"+analysis_id+"_Markup_Ecoregions"
+                ecoregion_tallies = restriction_matrix.zone_matrix(output_aggregate_feature_markup,
+                                                                   ALT_D_ECOREGIONS, ALT_D_ECOREGION_FIELD,
+                                                                   codes, ecoregion_fc)
+                logger.logfile("Ecoregion_list", list(ecoregion_tallies))
+                restriction_matrix.write_zone_table(output_path+"\\"+analysis_id+"_Ecoregion_Acres",
+                                                    ecoregion_tallies, codes)
 
                 # Create a default dict to hold the values
                 ecoregion_markup_acres = defaultdict(int)
+                for ecoregion, tally in ecoregion_tallies.items():
+                    ecoregion_markup_acres[analysis_id+"__"+ecoregion] = round(tally['markup'], 2)
 
-                # Get a list of ecoregions
-                ecoregion_field = "Community_Landscape"
-                ecoregion_list = [str(row[0]) for row in arcpy.da.SearchCursor(ecoregions, ecoregion_field)]
-                logger.logfile("Ecoregion_list", ecoregion_list)
-                
-                # these will be created by split
-                ecoregion_out_names = [output_path+"\\"+er for er in ecoregion_list]
-                # Rename to these:
-                ecoregion_rename = [output_path+"\\"+analysis_id+"__"+er for er in ecoregion_list]
-                logger.logfile("Ecoregion_out_names", ecoregion_out_names)
-                
-                arcpy.Split_analysis(output_aggregate_feature_markup, ecoregions, ecoregion_field, output_path)
-               
-                # Rename the ecoregion split outputs
-                for old_name, new_name in zip(ecoregion_out_names, ecoregion_rename):
-                    arcpy.Rename_management(old_name, new_name) 
-                
-                for ecoregion_fc in ecoregion_rename:
-                    # Get the acres
-                    acre_field = get_acres(ecoregion_fc)
-                    arcpy.MakeFeatureLayer_management(ecoregion_fc, "in_memory\\ecoregion")
-                    arcpy.SelectLayerByAttribute_management("in_memory\\ecoregion", "NEW_SELECTION", """ "Summary" <> '' """)
-                    ecoregion_acres = sum([row[0] for row in arcpy.da.SearchCursor("in_memory\\ecoregion", acre_field)])
-
-                    # Add key=fc_id and value=acreage to sweet default dictionary
-                    ecoregion_markup_acres[os.path.basename(ecoregion_fc)] = round(ecoregion_acres, 2)
+                # A feature class per ecoregion only when asked for
+                if parameters[41].value:
+                    logger.logfile("Ecoregion exports", restriction_matrix.export_zones(
+                        ecoregion_fc, ALT_D_ECOREGION_FIELD, list(ecoregion_tallies),
+                        output_path, analysis_id+"__"))
 
             # Write outputs acreages to csv
             logger.console('Creating csv')
@@ -1003,7 +1091,7 @@ class Use_Restrictions(object):
                 del(logger)
             except:
                 pass
-            deleteInMemory()
+            scratch.close()
 
 
 #######################################################################################################################
\ No newline at end of file
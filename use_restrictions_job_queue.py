@@ -9,13 +9,294 @@ Created on Fri Feb 10 10:34:45 2017
 import os
 import csv
 import sys
+import time
+import shutil
+import argparse
+import tempfile
+import collections
+import multiprocessing
 import arcpy
 import traceback
 
-    
-def job_queue(toolbox_path, tool_name, tool_alias, csv_path, start=0, stop=None):
+import criteria_cache
+import use_restrictions_workers
+import mp_setup
+from job_ledger import JobLedger, FAILED
+
+
+# Job columns that are not criteria inputs
+SETTING_FIELDS = ('Analysis_Area', 'Out_Location', 'Use_Restriction_Type',
+                  'Analysis_Area_Type', 'Alternative', 'Enable_Logging',
+                  'Criteria_Workers', 'Compact_Output', 'Criteria_Cache_Folder',
+                  'Overlay_Tiling', 'Raster_Estimate_Cell_Size', 'Profile_Run',
+                  'Resume_Previous_Run', 'Execution_Strategy',
+                  'Generalization_Tolerance', 'Generalization_Method',
+                  'Export_Ecoregion_Feature_Classes')
+
+# Retry failures that look like a lock or network hiccup, waiting
+# BACKOFF_SECONDS * 2**(attempt - 1) between attempts - 000464 cannot get a
+# schema lock, 000601 cannot delete (locked), 000210 cannot create output
+TRANSIENT_ERRORS = ('ERROR 000464', 'ERROR 000601', 'ERROR 000210',
+                    'Cannot acquire a lock', 'timed out',
+                    'network name is no longer available',
+                    'network path was not found')
+RETRIES = 2
+BACKOFF_SECONDS = 30
+POLL_SECONDS = 1
+# A job process that has not come back by then is hung
+JOB_TIMEOUT_SECONDS = 12 * 3600
+
+
+def plan_jobs(params):
+    """Plan a list of jobs as a DAG of intermediate products - the dissolved union of
+       every criterion - keyed on their inputs, so a product shared by any number of
+       jobs is only computed once.  Analysis areas are not products: every tool run
+       dissolves its own and clips the criteria to it.
+       Returns a dict:
+           products  OrderedDict of key: (kind, name, inputs) for every distinct product
+           depends   for each job, the list of product keys it needs
+           refs      Counter of kind: product references across all jobs"""
+    products = collections.OrderedDict()
+    depends = []
+    refs = collections.Counter()
+    for param in params:
+        needs = []
+        for field, value in sorted(param.items()):
+            if field in SETTING_FIELDS or not value:
+                continue
+            paths = criteria_cache.split_inputs(value)
+            if not paths:
+                continue
+            key = ('criterion', tuple(sorted(os.path.normcase(path) for path in paths)))
+            if key not in products:
+                products[key] = ('criterion', 'criterion_{}'.format(len(products)), value)
+            needs.append(key)
+        for key in needs:
+            refs[key[0]] += 1
+        depends.append(needs)
+    return {'products': products, 'depends': depends, 'refs': refs}
+
+
+def dedup_report(plan):
+    """Describe how much work the plan shares between jobs - the criterion dissolves
+       the tools read back from the criteria cache instead of computing"""
+    distinct = len(plan['products'])
+    total = plan['refs']['criterion']
+    saved = total - distinct
+    return '\n'.join(['{} jobs'.format(len(plan['depends'])),
+                      'criterion dissolves: {} needed, {} distinct - {} saved ({:.0f}%)'.format(
+                          total, distinct, saved, 100.0 * saved / total if total else 0.0)])
+
+
+def build_products(plan, cache_folder, workers=1, log=None):
+    """Compute every distinct product of the plan once, into the criteria cache the
+       tools read with Criteria_Cache_Folder."""
+    log = log or (lambda message: None)
+    tasks = [(name, inputs) for kind, name, inputs in plan['products'].values()
+             if kind == 'criterion']
+    scratch_folder = tempfile.mkdtemp(prefix='criteria_', dir=cache_folder)
+    try:
+        def dissolve(todo):
+            return use_restrictions_workers.dissolve_criteria(todo, scratch_folder, workers, log)
+        cache = criteria_cache.CriteriaCache(cache_folder, log=log)
+        dissolved, keys = criteria_cache.cached_criteria(tasks, cache, dissolve, log)
+        cache.evict(keep=keys)
+    finally:
+        shutil.rmtree(scratch_folder, ignore_errors=True)
+
+
+def job_label(param):
+    """The Alternative, Analysis_Area_Type and Use_Restriction_Type of a job"""
+    return ' '.join(param.get(field, '') for field in
+                    ('Alternative', 'Analysis_Area_Type', 'Use_Restriction_Type'))
+
+
+def is_transient(trace):
+    """True if a failure looks worth retrying"""
+    trace = trace.lower()
+    return any(pattern.lower() in trace for pattern in TRANSIENT_ERRORS)
+
+
+def run_job(toolbox_path, tool_alias, tool_name, param):
+    """Runs one job - in a worker process, so the toolbox is imported here.
+       Returns (outputs, None), or (None, traceback) when the tool fails - an
+       arcpy ExecuteError does not always survive the trip back to the parent."""
+    try:
+        toolbox = arcpy.ImportToolbox(toolbox_path, tool_alias)
+        result = getattr(toolbox, tool_name)(**param)
+        outputs = []
+        if result is not None:
+            outputs = [result.getOutput(i) for i in range(result.outputCount)]
+        return outputs or [param.get('Out_Location', '')], None
+    except:
+        return None, traceback.format_exc()
+
+
+class _Finished(object):
+    """A job run in this process, dressed like a _Job"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+    def stop(self):
+        pass
+
+
+def _job_process(sender, toolbox_path, tool_alias, tool_name, param):
+    """Runs one job in a _Job process and sends the result back"""
+    sender.send(run_job(toolbox_path, tool_alias, tool_name, param))
+    sender.close()
+
+
+class _Job(object):
+    """
+    A job running in its own process.  Not a pool worker: those are
+    daemonic and may not have children, and the tool starts its own
+    criteria and tile pools.  One job per process - geoprocessing leaks
+    memory.
+    """
+
+    def __init__(self, args):
+        self.receiver, sender = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(target=_job_process,
+                                               args=[sender] + list(args))
+        self.process.start()
+        sender.close()
+        self.value = None
+
+    def ready(self):
+        if self.value is None and self.receiver.poll():
+            try:
+                self.value = self.receiver.recv()
+            except EOFError:
+                self.process.join()
+        return self.value is not None or not self.process.is_alive()
+
+    def get(self):
+        self.process.join()
+        if self.value is None and self.receiver.poll():
+            try:
+                self.value = self.receiver.recv()
+            except EOFError:
+                pass
+        self.receiver.close()
+        if self.value is None:
+            return None, 'The job process exited with code {} before returning a result'.format(
+                self.process.exitcode)
+        return self.value
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.receiver.close()
+
+
+def run_jobs(toolbox_path, tool_name, tool_alias, params, ledger, workers=1,
+             resume=False, retries=RETRIES, backoff=BACKOFF_SECONDS, log=None,
+             keys=None, timeout=JOB_TIMEOUT_SECONDS):
+    """Runs params on up to workers child processes at a time, one job per process,
+       recording every start, finish and failure in ledger.  keys are the ledger keys of params, as
+       registered by the caller - by default params are registered as they are.
+       Identical rows share a key and run once.
+       With resume, jobs the ledger already has as DONE are skipped.  Transient
+       failures are retried up to retries times with exponential backoff.  A job
+       process that dies without a result, or runs longer than timeout seconds and
+       is stopped, is recorded as failed.
+       Returns [label, traceback] for every failed job.
+       Each tool run writes its own timestamped geodatabase, so parallel jobs only
+       collide if two with the same analysis id start in the same minute."""
+    log = log or (lambda message: None)
+    labels = [job_label(param) for param in params]
+    if keys is None:
+        keys = ledger.register(params, labels)
+    # Identical rows are the same job with the same output - run it once
+    jobs = {}
+    names = {}
+    for i, key in enumerate(keys):
+        if key in jobs:
+            log('Skipping job {} - a duplicate of {}'.format(i + 1, names[key]))
+            continue
+        jobs[key] = params[i]
+        names[key] = labels[i]
+    keys = [key for i, key in enumerate(keys) if key not in keys[:i]]
+    todo = ledger.pending(keys, resume)
+    if resume:
+        log('Resuming - {} of {} jobs already done'.format(len(keys) - len(todo), len(keys)))
+    else:
+        ledger.reset(todo)
+    workers = max(1, min(int(workers or 1), len(todo) or 1))
+
+    if workers > 1:
+        mp_setup.set_executable()
+
+    waiting = [(0, i, key) for i, key in enumerate(todo)]  # (earliest start, csv order, key)
+    running = {}
+    started = {}
+    attempts = {}
+    try:
+        while waiting or running:
+            now = time.time()
+            for item in sorted(waiting):
+                if len(running) >= workers or item[0] > now:
+                    break
+                waiting.remove(item)
+                key = item[2]
+                attempts[key] = ledger.start(key)
+                log('Starting {} (attempt {})'.format(names[key], attempts[key]))
+                args = [toolbox_path, tool_alias, tool_name, jobs[key]]
+                started[key] = time.time()
+                if workers == 1:
+                    running[key] = _Finished(run_job(*args))
+                else:
+                    running[key] = _Job(args)
+
+            finished = [key for key, result in running.items() if result.ready()]
+            for key in finished:
+                outputs, trace = running.pop(key).get()
+                if trace is None:
+                    ledger.finish(key, outputs)
+                    log('Finished {}'.format(names[key]))
+                elif attempts[key] <= retries and is_transient(trace):
+                    delay = backoff * 2 ** (attempts[key] - 1)
+                    ledger.fail(key, trace, retry=True)
+                    waiting.append((time.time() + delay, todo.index(key), key))
+                    log('{} failed - retrying in {}s:\n{}'.format(names[key], delay, trace))
+                else:
+                    ledger.fail(key, trace)
+                    log('FAILURE: {}:\n{}'.format(names[key], trace))
+
+            now = time.time()
+            for key in [key for key in running if now - started[key] > timeout]:
+                running.pop(key).stop()
+                trace = 'No result after {}s - the job was stopped'.format(int(timeout))
+                ledger.fail(key, trace)
+                log('FAILURE: {}:\n{}'.format(names[key], trace))
+            if not finished:
+                time.sleep(POLL_SECONDS)
+    finally:
+        for job in running.values():
+            job.stop()
+
+    log('Jobs: ' + ', '.join('{} {}'.format(count, status) for status, count in
+                             sorted(ledger.summary(keys).items())))
+    return [['FAILURE: ' + label, trace] for label, trace in ledger.failures(keys)]
+
+
+def job_queue(toolbox_path, tool_name, tool_alias, csv_path, start=0, stop=None,
+              cache_folder=None, workers=1, ledger_path=None, resume=False,
+              retries=RETRIES, log=None):
     """Read a csv for a list of job parameters between start and stop (non-inclusinve),
-       convert to dict, and hand off to a python toolbox."""
+       convert to dict, and hand off to a python toolbox.
+       With a cache_folder the jobs are planned together first (see plan_jobs) and every
+       shared product is computed once - the tool must take a Criteria_Cache_Folder.
+       The jobs run on workers processes (see run_jobs), tracked in a SQLite ledger next
+       to the csv unless ledger_path says otherwise."""
 
     # Make sure everything makes sense
     assert os.path.exists(toolbox_path), "Toolbox not found"
@@ -25,9 +306,6 @@ def job_queue(toolbox_path, tool_name, tool_alias, csv_path, start=0, stop=None)
         assert type(stop) == int, "Invalid stop row (must be int)"
         assert stop > start, "Invalid start-stop sequence"
     
-    # Import the toolbox and get the alias
-    toolbox = arcpy.ImportToolbox(toolbox_path, tool_alias)
-    
     # Open and read csv within 'start' and 'stop' - get header and zip rows 
     # (tuple) with header  and convert to dict as {header: value}
     # get a list of dicts representing the parameter inputs, i.e. jobs
@@ -37,37 +315,68 @@ def job_queue(toolbox_path, tool_name, tool_alias, csv_path, start=0, stop=None)
         params = [dict(zip(header, row)) for row in csv_reader][start:stop]
     assert params, "No Records Returned"
 
-    tool_exec = eval('toolbox'+"."+tool_name)
-    errors = []
-    for param in params:
-        try:
-            exc = tool_exec(**param)
-        except:
-            err_info = sys.exc_info()[1]
-            error_param = 'FAILURE: ' + \
-                          param['Alternative'] + ' ' +\
-                          param['Analysis_Area_Type'] + ' ' + \
-                          param['Use_Restriction_Type']
-            errors.append([error_param, err_info])            
-            
+    log = log or (lambda message: sys.stdout.write(message + '\n'))
+
+    ledger = JobLedger(ledger_path or os.path.splitext(csv_path)[0] + '.sqlite')
+    try:
+        # Key the jobs on their csv rows, before any parameter is added
+        keys = ledger.register(params, [job_label(param) for param in params])
+
+        # Compute the shared products of the jobs left to run once and point
+        # every job at them
+        if cache_folder:
+            todo = set(ledger.pending(keys, resume))
+            plan = plan_jobs([param for i, (key, param) in enumerate(zip(keys, params))
+                              if key in todo and key not in keys[:i]])
+            if plan['depends']:
+                log(dedup_report(plan))
+                build_products(plan, cache_folder, workers, log)
+            params = [dict(param, Criteria_Cache_Folder=cache_folder) for param in params]
+
+        errors = run_jobs(toolbox_path, tool_name, tool_alias, params, ledger,
+                          workers=workers, resume=resume, retries=retries, log=log,
+                          keys=keys)
+    finally:
+        ledger.close()
+
     return errors
 
 
-def main(start=0, stop=None):
+def main(start=0, stop=None, cache_folder=None, workers=1, resume=False,
+         retries=RETRIES):
     
     tpath = r'T:\CO\GIS\giswork\rgfo\projects\management_plans\ECRMP\Draft_RMP_EIS'\
-            r'\1_Analysis\ECRMP_Working\_Development\Use_Restrictions.pyt'
+            r'\1_Analysis\ECRMP_Working\_Development\Use_Restrictions_v2.pyt'
     cpath = r'T:\CO\GIS\giswork\rgfo\projects\management_plans\ECRMP\Draft_RMP_EIS'\
             r'\1_Analysis\ECRMP_Working\_Development\Use_Restrictions_Params.csv'
    
     jobs = job_queue(
                toolbox_path=tpath,
-               tool_name='UseRestrictions',
-               tool_alias='useRestrictionTools',
+               tool_name='Use_Restrictions_v2',
+               tool_alias='Use_Restrictions_v2',
                csv_path=cpath,
                start=start,
-               stop=stop)
+               stop=stop,
+               cache_folder=cache_folder,
+               workers=workers,
+               resume=resume,
+               retries=retries)
     
     return jobs if jobs else "Completed Successfully"
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the Use Restrictions job queue')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stop', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--cache-folder', default=None,
+                        help='plan the jobs together and share their products here')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the jobs the ledger has as done')
+    parser.add_argument('--retries', type=int, default=RETRIES)
+    args = parser.parse_args()
+    print(main(args.start, args.stop, args.cache_folder, args.workers, args.resume,
+               args.retries))
+
     
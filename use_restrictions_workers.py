@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Process pool helpers for the Use Restrictions tools.
+
+Each criterion's inputs are unioned and dissolved independently, so they are
+run on a pool of worker processes, each criterion into its own scratch file
+geodatabase - file gdbs do not take concurrent writers, and the workers no
+longer fight over a single in_memory\\dissolve name.  The caller copies the
+results into the Inputs feature dataset afterwards.
+
+Like working_mp_GIS_example.py, the worker functions live in this importable
+module - a .pyt (or the toolbox class itself) cannot be pickled.
+"""
+
+from __future__ import division
+import multiprocessing
+import os
+import arcpy
+
+import mp_setup
+from scratch_workspace import ScratchWorkspace
+
+
+# Functions
+def dissolve_criterion(name, fc_list, scratch_folder, scratch=None):
+    """
+    Unions the feature classes of one criterion (a ';' delimited string or
+    a list) and dissolves them into scratch_folder\\<name>.gdb\\<name>.
+    scratch is the caller's ScratchWorkspace when this runs in its process,
+    so the union counts against its budget.  Returns the output path
+    """
+    arcpy.env.overwriteOutput = True
+    scratch_gdb = os.path.join(scratch_folder, name + '.gdb')
+    if not arcpy.Exists(scratch_gdb):
+        arcpy.CreateFileGDB_management(scratch_folder, name + '.gdb')
+    output = os.path.join(scratch_gdb, name)
+    # A worker's in_memory is its own - no budget to share there
+    with (scratch.scope() if scratch else ScratchWorkspace(memory_budget=None)) as workspace:
+        union = workspace.feature_class('union_' + name)
+        arcpy.Union_analysis(fc_list, union)
+        arcpy.Dissolve_management(workspace.use(union), output)
+    return output
+
+
+def dissolve_criteria(tasks, scratch_folder, workers=1, log=None, scratch=None):
+    """
+    Runs dissolve_criterion for every (name, fc_list) task and returns a
+    dictionary of name: dissolved feature class.  workers > 1 uses a process
+    pool, one criterion per task, so the stage takes about as long as the
+    slowest criterion; a single worker runs here, under scratch.  Every failure is logged and then raised together as
+    a RuntimeError - the matrix is wrong if a criterion is missing.
+    """
+    log = log or (lambda message: None)
+    outputs = {}
+    failures = []
+    workers = max(1, min(int(workers or 1), len(tasks)))
+
+    if workers == 1:
+        for name, fc_list in tasks:
+            log('      Dissolving {}'.format(name))
+            outputs[name] = dissolve_criterion(name, fc_list, scratch_folder, scratch)
+        return outputs
+
+    mp_setup.set_executable()
+    # One criterion per child - geoprocessing leaks memory
+    pool = multiprocessing.Pool(processes=workers, maxtasksperchild=1)
+    try:
+        jobs = {}
+        for name, fc_list in tasks:
+            jobs[name] = pool.apply_async(dissolve_criterion,
+                                          [name, fc_list, scratch_folder])
+        for name, fc_list in tasks:
+            try:
+                outputs[name] = jobs[name].get()
+                log('      Dissolved {}'.format(name))
+            except Exception as e:
+                log('      {} failed:\n{}'.format(name, repr(e)))
+                failures.append(name)
+    finally:
+        pool.close()
+        pool.join()
+    if failures:
+        raise RuntimeError('Criteria failed to dissolve: {}'.format(
+            ', '.join(failures)))
+    return outputs